@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+'''
+In-process interface to the Triqler pipeline. In contrast to
+triqler.runTriqler, it does not read or write any files (apart from an
+optional input file), does not modify the params that are passed in, raises
+errors.TriqlerError instead of exiting and uses its own random state. This
+allows multiple analyses to run concurrently in one long-lived process.
+'''
+
+from __future__ import print_function
+
+import os
+import multiprocessing
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from . import parsers
+from . import triqler
+from . import diff_exp
+from . import hyperparameters
+from . import multiprocessing_pool as pool
+from .errors import TriqlerError
+
+# proteins are in the order of triqler's protein output rows, the posterior
+# arrays are None unless params['returnPosteriors'] is set and contain NaNs
+# for proteins that were not quantified. comparisons maps (groupId1, groupId2)
+# to a diff_exp.ProteinComparison
+TriqlerResults = namedtuple("TriqlerResults", "runIds groupLabels hyperparameters proteins proteinIdPEPs proteinQuantCandidates proteinDiffCandidates proteinPosteriors groupPosteriors foldChangePosteriors comparisons")
+
+def getDefaultParams():
+  params = dict()
+  params['warningFilter'] = "ignore"
+  params['foldChangeEval'] = 1.0
+  params['t-test'] = False
+  params['minSamples'] = 2
+  params['decoyPattern'] = "decoy_"
+  params['numThreads'] = multiprocessing.cpu_count()
+  params['executor'] = 'process'
+  params['startMethod'] = None
+  params['hyperparameterSample'] = 0
+  params['hyperparameterTolerance'] = 0.05
+  params['returnPosteriors'] = False
+  params['engine'] = 'grid'
+  params['laplaceMaxSkewness'] = 0.5
+  params['laplaceMaxRunDeviation'] = 0.05
+  params['coarseGridStep'] = 0.0
+  params['engineCheckSample'] = 0
+  params['maxChunkMemory'] = 256.0
+  params['splitProteinCost'] = 50000
+  return params
+
+# triqlerInput can be a Triqler input file, a mapping of column names in
+# parsers.TriqlerInputRowHeaders or parsers.TriqlerSimpleInputRowHeaders to
+# equally long sequences, e.g. a pandas DataFrame, or an iterable of
+# parsers.TriqlerInputRow. The latter are taken to have link PEPs unless
+# params['hasLinkPEPs'] is False. params['warningFilter'] applies to the 
+# worker processes, the warnings of the calling process follow the caller's 
+# warning filters, as warnings.catch_warnings is not thread-safe
+def quantify(triqlerInput, params = None, seed = None):
+  params = dict(getDefaultParams(), **(params if params is not None else dict()))
+  if params['minSamples'] < 2:
+    raise TriqlerError("ERROR: minSamples should be >= 2")
+  
+  if params['hyperparameterSample'] < 0:
+    raise TriqlerError("ERROR: hyperparameterSample should be >= 0")
+  
+  # executor can also be a concurrent.futures.Executor, e.g. of a cluster
+  if isinstance(params['executor'], str) and params['executor'] not in pool.executorTypes:
+    raise TriqlerError("ERROR: executor should be one of %s or a concurrent.futures.Executor" % ", ".join(pool.executorTypes))
+  
+  # the file writing options of the command line interface do not apply here
+  params['writeSpectrumQuants'] = False
+  params['proteinPosteriorsOutput'], params['groupPosteriorsOutput'], params['foldChangePosteriorsOutput'] = '', '', ''
+  params.pop('perfReport', None)
+  params['rng'] = np.random.RandomState(seed)
+  
+  triqlerInputRows, params['hasLinkPEPs'] = getTriqlerInputRows(triqlerInput, params.get('hasLinkPEPs', True))
+  peptQuantRows = triqler.convertTriqlerInputToPeptQuantRows(None, None, params, triqlerInputRows)
+  
+  qvalMethod = 'pvalues' if params['t-test'] else 'avg_pep'
+  selectComparison = lambda proteinOutputRows, comparisonKey : triqler.selectComparisonBayes(proteinOutputRows, comparisonKey, params['t-test'])
+  proteinOutputRows, comparisons = diff_exp.getDiffExpResults(params, peptQuantRows, triqler.doPickedProteinQuantification, selectComparison, qvalMethod)
+  
+  return getTriqlerResults(proteinOutputRows, comparisons, params)
+
+# returns the prepared Triqler input rows and whether they contain link PEPs
+def getTriqlerInputRows(triqlerInput, hasLinkPEPs = True):
+  if isinstance(triqlerInput, str):
+    if not os.path.isfile(triqlerInput):
+      raise TriqlerError("Could not locate input file %s. Check if the path is correct." % triqlerInput)
+    return parsers.parseTriqlerInputFile(triqlerInput), parsers.hasLinkPEPs(triqlerInput)
+  elif hasattr(triqlerInput, 'keys'):
+    hasLinkPEPs = 'linkPEP' in triqlerInput.keys()
+    headers = parsers.TriqlerInputRowHeaders if hasLinkPEPs else parsers.TriqlerSimpleInputRowHeaders
+    missingHeaders = [header for header in headers if header not in triqlerInput.keys()]
+    if len(missingHeaders) > 0:
+      raise TriqlerError("ERROR: Missing input columns: %s" % ", ".join(missingHeaders))
+    
+    numRows = len(triqlerInput['run'])
+    columns = [triqlerInput[header] if header in triqlerInput.keys() else [0]*numRows for header in parsers.TriqlerInputRowHeaders[:-1]]
+    proteins = ([x] if isinstance(x, str) else list(x) for x in triqlerInput['proteins'])
+    triqlerInputRows = (parsers.TriqlerInputRow(*(row + (proteinList,))) for row, proteinList in zip(zip(*columns), proteins))
+    return parsers.prepareTriqlerInputRows(triqlerInputRows, hasLinkPEPs), hasLinkPEPs
+  else:
+    return parsers.prepareTriqlerInputRows(triqlerInput, hasLinkPEPs), hasLinkPEPs
+
+def getTriqlerResults(proteinOutputRows, comparisons, params):
+  numProteins = len(proteinOutputRows)
+  proteins = [row[1] for row in proteinOutputRows]
+  proteinIdPEPs = np.array([row[5] for row in proteinOutputRows])
+  
+  proteinPosteriors, groupPosteriors, foldChangePosteriors = None, None, None
+  if params['returnPosteriors']:
+    numRuns, numGroups = len(params['fileList']), len(params['groups'])
+    numQuants, numDiffs = len(params['proteinQuantCandidates']), len(params['proteinDiffCandidates'])
+    proteinPosteriors = np.full((numProteins, numRuns, numQuants), np.nan)
+    groupPosteriors = np.full((numProteins, numGroups, numQuants), np.nan)
+    foldChangePosteriors = OrderedDict((comparisonKey, np.full((numProteins, numDiffs), np.nan)) for comparisonKey, _ in comparisons)
+    for i, row in enumerate(proteinOutputRows):
+      posteriorDists = row[7]
+      if posteriorDists:
+        pProteinQuantsList, pProteinGroupQuants, pProteinGroupDiffs = posteriorDists
+        proteinPosteriors[i] = pProteinQuantsList
+        groupPosteriors[i] = pProteinGroupQuants
+        for comparisonKey in foldChangePosteriors:
+          foldChangePosteriors[comparisonKey][i] = pProteinGroupDiffs[comparisonKey]
+  
+  fittedHyperparameters = dict((varName, params[varName]) for varName, _ in hyperparameters.hyperparameterScales if varName in params)
+  
+  return TriqlerResults(parsers.getRunIds(params), list(params['groupLabels']), fittedHyperparameters, proteins, proteinIdPEPs, params['proteinQuantCandidates'], params['proteinDiffCandidates'], proteinPosteriors, groupPosteriors, foldChangePosteriors, OrderedDict(comparisons))
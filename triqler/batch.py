@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+'''
+Batch mode, triqler batch MANIFEST, which processes many datasets in a single
+process with one persistent pool of worker processes. Each non-empty line of
+the manifest that does not start with # holds the command line arguments of
+one Triqler run, e.g.
+
+  --fold_change_eval 0.8 --out_file exp1/proteins.tsv exp1/triqler_input.tsv
+
+Several datasets are processed concurrently, so that the parsing and fitting
+stages of one dataset, which run in the main process, overlap with the
+posterior calculations of another dataset in the worker processes. The output
+of each dataset is written to a log file next to its output file.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import shlex
+import threading
+import warnings
+import traceback
+from collections import namedtuple
+from timeit import default_timer as timer
+
+from . import triqler
+from . import multiprocessing_pool as pool
+from .errors import TriqlerError
+
+BatchDataset = namedtuple("BatchDataset", "lineNumber args params inputFile logFile")
+
+def main(argv):
+  args = parseArgs(argv)
+  datasets = parseManifest(args.manifest)
+  
+  print("Processing %d datasets from %s with %d worker processes, at most %d datasets at a time" % (len(datasets), args.manifest, args.num_threads, args.max_concurrent_datasets))
+  
+  warnings.simplefilter("ignore")
+  sharedPool = pool.MyPool(processes = args.num_threads, warningFilter = "ignore", executor = args.executor, startMethod = args.start_method)
+  failedDatasets = runDatasets(datasets, sharedPool, args.num_threads, args.max_concurrent_datasets)
+  sharedPool.close()
+  
+  if len(failedDatasets) > 0:
+    sys.exit("ERROR: %d of %d datasets failed, on manifest lines %s" % (len(failedDatasets), len(datasets), ", ".join(str(x.lineNumber) for x in failedDatasets)))
+  print("All %d datasets were processed successfully" % len(datasets))
+
+def parseArgs(argv):
+  import argparse, multiprocessing
+  apars = argparse.ArgumentParser(prog = "triqler batch",
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  
+  apars.add_argument('manifest', metavar = "MANIFEST",
+                     help='Text file with the command line arguments of one Triqler run per line, lines starting with # are ignored. The --num_threads option of the runs is replaced by the one of the batch mode.')
+  
+  apars.add_argument('--num_threads', type=int, default=multiprocessing.cpu_count(), metavar='N',
+                     help='Number of worker processes shared by all datasets.')
+  
+  apars.add_argument('--executor', default = 'process', metavar='X', choices = pool.executorTypes,
+                     help='Backend of the workers shared by all datasets, see triqler --help. The --executor and --start_method options of the runs are replaced by the ones of the batch mode.')
+  
+  apars.add_argument('--start_method', default = None, metavar='S', choices = ['fork', 'forkserver', 'spawn'],
+                     help='Start method of the worker processes of the "process" and "futures" executors. By default, the platform default is used.')
+  
+  apars.add_argument('--max_concurrent_datasets', type=int, default=2, metavar='D',
+                     help='Maximum number of datasets that are processed at the same time.')
+  
+  args = apars.parse_args(argv)
+  
+  if args.num_threads < 1:
+    sys.exit("ERROR: --num_threads should be >= 1")
+  
+  if args.max_concurrent_datasets < 1:
+    sys.exit("ERROR: --max_concurrent_datasets should be >= 1")
+  
+  if args.start_method is not None and args.executor not in ['process', 'futures']:
+    sys.exit("ERROR: --start_method can only be used with --executor process or futures")
+  
+  return args
+
+# all lines are validated before any dataset is processed
+def parseManifest(manifestFile):
+  if not os.path.isfile(manifestFile):
+    sys.exit("ERROR: Could not locate manifest file %s. Check if the path is correct." % manifestFile)
+  
+  datasets = list()
+  with open(manifestFile, 'r') as f:
+    for lineNumber, line in enumerate(f, 1):
+      if len(line.strip()) == 0 or line.strip().startswith("#"):
+        continue
+      
+      try:
+        args, params = triqler.parseArgs(shlex.split(line), prog = "triqler (manifest line %d)" % lineNumber)
+      except SystemExit as e:
+        if isinstance(e.code, int): # argparse already printed the error
+          sys.exit("ERROR: invalid arguments on line %d of %s" % (lineNumber, manifestFile))
+        else:
+          sys.exit("%s (line %d of %s)" % (e.code, lineNumber, manifestFile))
+      
+      params['warningFilter'] = "ignore"
+      inputFile = args.in_file if params['converter'] is None else getattr(args, 'from_' + params['converter'])
+      datasets.append(BatchDataset(lineNumber, args, params, inputFile, args.out_file + ".log"))
+  
+  outFiles = [x.args.out_file for x in datasets]
+  duplicateOutFiles = sorted(set(x for x in outFiles if outFiles.count(x) > 1))
+  if len(duplicateOutFiles) > 0:
+    sys.exit("ERROR: the output file %s is used by multiple lines of %s" % (duplicateOutFiles[0], manifestFile))
+  
+  return datasets
+
+# returns the datasets that failed
+def runDatasets(datasets, sharedPool, numThreads, maxConcurrentDatasets):
+  datasetQueue = list(reversed(datasets))
+  queueLock = threading.Lock()
+  # datasets with the same input file write the same intermediate files and
+  # are therefore not processed at the same time
+  inputLocks = dict((x.inputFile, threading.Lock()) for x in datasets)
+  failedDatasets = list()
+  
+  stdoutRouter = ThreadOutputRouter(sys.stdout)
+  sys.stdout = stdoutRouter
+  
+  def processDatasets():
+    while True:
+      with queueLock:
+        if len(datasetQueue) == 0:
+          return
+        dataset = datasetQueue.pop()
+      
+      with inputLocks[dataset.inputFile]:
+        if not runDataset(dataset, sharedPool, numThreads, stdoutRouter):
+          with queueLock:
+            failedDatasets.append(dataset)
+  
+  threads = [threading.Thread(target = processDatasets) for _ in range(min([maxConcurrentDatasets, len(datasets)]))]
+  try:
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      while thread.is_alive():
+        thread.join(1.0) # allows KeyboardInterrupt in the main thread
+  except (KeyboardInterrupt, SystemExit):
+    print("Caught KeyboardInterrupt, terminating workers")
+    sharedPool.pool.terminate()
+    sharedPool.pool.join()
+    raise
+  finally:
+    sys.stdout = stdoutRouter.stream
+  
+  return sorted(failedDatasets, key = lambda x : x.lineNumber)
+
+# returns True if the dataset was processed successfully
+def runDataset(dataset, sharedPool, numThreads, stdoutRouter):
+  stdoutRouter.stream.write("Starting dataset on line %d: %s, log file: %s\n" % (dataset.lineNumber, dataset.inputFile, dataset.logFile))
+  
+  params = dict(dataset.params)
+  params['numThreads'] = numThreads
+  params['sharedPool'] = sharedPool
+  params['executor'] = sharedPool.executor
+  
+  start = timer()
+  success = True
+  with open(dataset.logFile, 'w') as logFile:
+    stdoutRouter.register(logFile)
+    try:
+      print('Triqler version %s\n%s' % (triqler.__version__, triqler.__copyright__))
+      triqler.runFromArgs(dataset.args, params)
+    except TriqlerError as e:
+      print(str(e))
+      success = False
+    except SystemExit as e: # would otherwise silently end the dataset thread
+      if not isinstance(e.code, int):
+        print(e.code)
+      success = False
+    except Exception:
+      traceback.print_exc(file = logFile)
+      success = False
+    finally:
+      stdoutRouter.unregister()
+  
+  stdoutRouter.stream.write("%s dataset on line %d: %s after %.1f seconds\n" % ("Finished" if success else "FAILED", dataset.lineNumber, dataset.inputFile, timer() - start))
+  return success
+
+# sends the output of each dataset thread to its own log file and the output
+# of all other threads to the original stream
+class ThreadOutputRouter:
+  def __init__(self, stream):
+    self.stream = stream
+    self.logFiles = dict()
+  
+  def register(self, logFile):
+    self.logFiles[threading.current_thread().ident] = logFile
+  
+  def unregister(self):
+    self.logFiles.pop(threading.current_thread().ident, None)
+  
+  def write(self, text):
+    self.logFiles.get(threading.current_thread().ident, self.stream).write(text)
+  
+  def flush(self):
+    self.logFiles.get(threading.current_thread().ident, self.stream).flush()
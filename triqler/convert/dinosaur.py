@@ -17,13 +17,15 @@ from __future__ import print_function
 import os
 import sys
 import glob
-import numpy as np
 import collections
 
-from .. import parsers
 from ..triqler import __version__, __copyright__
+from ..lazy_import import lazyImport
+from ..errors import TriqlerError
 
-from . import helpers
+np = lazyImport("numpy")
+parsers = lazyImport("..parsers", __package__)
+helpers = lazyImport(".helpers", __package__)
 
 def main():
   print('Triqler.convert.dinosaur version %s\n%s' % (__version__, __copyright__))
@@ -35,7 +37,10 @@ def main():
   if len(args.in_file) == 1 and '*' in args.in_file[0]:
     args.in_file = glob.glob(args.in_file[0])
   
-  convertDinosaurToTriqler(args.file_list_file, args.in_file, args.psm_files.split(","), args.out_file, params)
+  try:
+    convertDinosaurToTriqler(args.file_list_file, args.in_file, args.psm_files.split(","), args.out_file, params)
+  except TriqlerError as e:
+    sys.exit(str(e))
 
 def parseArgs():
   import argparse
@@ -76,17 +81,22 @@ def parseArgs():
   return args, params
   
 def convertDinosaurToTriqler(fileListFile, mappedPrecursorFiles, psmsOutputFiles, triqlerInputFile, params):
+  triqlerInputRows = convertDinosaurToTriqlerInputRows(fileListFile, mappedPrecursorFiles, psmsOutputFiles, params)
+  
+  helpers.writeTriqlerInputRows(triqlerInputFile, triqlerInputRows, params)
+
+def convertDinosaurToTriqlerInputRows(fileListFile, mappedPrecursorFiles, psmsOutputFiles, params):
   fileInfoList = parsers.parseFileList(fileListFile)
   
   peptideToFeatureMap = parseDinosaurMapFiles(mappedPrecursorFiles, fileInfoList, psmsOutputFiles)
   
   rTimeArrays, factorArrays = helpers.getNormalizationFactorArrays(peptideToFeatureMap, fileInfoList, params)
   
-  helpers.writeTriqlerInputFile(triqlerInputFile, peptideToFeatureMap, rTimeArrays, factorArrays, params)
+  return helpers.getTriqlerInputRows(peptideToFeatureMap, rTimeArrays, factorArrays, params)
 
 def parseDinosaurMapFiles(mappedPrecursorFiles, fileInfoList, psmsOutputFiles):
   fileList, _, _, _ = zip(*fileInfoList)
-  specToPeptideMap = helpers.parsePsmsPoutFiles(psmsOutputFiles, key = lambda psm : (psm.filename, psm.scannr))
+  psmLookup = helpers.PsmLookup(psmsOutputFiles, byFile = True)
   
   linkPEP = 0.0
   peptideToFeatureMap = collections.defaultdict(list)
@@ -99,8 +109,9 @@ def parseDinosaurMapFiles(mappedPrecursorFiles, fileInfoList, psmsOutputFiles):
     
     fileIdx = fileList.index(fileName)
     run, condition, sample, fraction = fileInfoList[fileIdx]
-    for spMap in parsers.parseMappedPrecursorFile(mappedPrecursorFile):
-      peptide, proteins, svmScore, charge = specToPeptideMap((fileIdx, spMap.scanNr))
+    spMaps = list(parsers.parseMappedPrecursorFile(mappedPrecursorFile))
+    peptideHits = psmLookup.getPeptideHits([spMap.scanNr for spMap in spMaps], fileIdx)
+    for spMap, (peptide, proteins, svmScore, charge) in zip(spMaps, peptideHits):
       if peptide != helpers.getDefaultPeptideHit()[0]:
         key = (peptide, charge)
         if key in peptideToFeatureMap:
@@ -1,31 +1,82 @@
 from __future__ import print_function
 
-import collections
-
 import numpy as np
 
 from .. import parsers
 from . import normalize_intensities as normalize
 from . import percolator
 
-def parsePsmsPoutFiles(psmsOutputFiles, key = lambda psm : psm.scannr):
-  specToPeptideMap = collections.defaultdict(list)
-  for psmsOutputFile in psmsOutputFiles:
-    for psm in percolator.parsePsmsPout(psmsOutputFile):
-      specToPeptideMap[key(psm)] = (psm.peptide, psm.proteins, psm.svm_score, psm.charge)
-  return lambda spectrumIdx : specToPeptideMap.get(spectrumIdx, getDefaultPeptideHit())
+# looks up the (peptide, proteins, svm_score, charge) of the PSMs in Percolator
+# output files by scan number or, if byFile is set, by file name and scan 
+# number. The keys are kept in a sorted array, so that batches of spectra are
+# looked up with a binary search instead of keeping a dict entry per PSM. If
+# a spectrum has multiple PSMs, the last one in psmsOutputFiles is used
+class PsmLookup:
+  def __init__(self, psmsOutputFiles, byFile = False):
+    self.byFile = byFile
+    self.fileCodeMap = dict()
+    fileCodes, scannrs, charges, svmScores = [np.zeros(0, dtype = int)], [np.zeros(0, dtype = int)], [np.zeros(0, dtype = int)], [np.zeros(0)]
+    self.peptides, self.proteins = list(), list()
+    for psmsOutputFile in psmsOutputFiles:
+      psms = percolator.parsePsmsPoutColumns(psmsOutputFile)
+      globalFileCodes = np.array([self.fileCodeMap.setdefault(filename, len(self.fileCodeMap)) for filename in psms.filenames], dtype = int)
+      fileCodes.append(globalFileCodes[psms.fileCodes] if self.byFile else np.zeros_like(psms.fileCodes))
+      scannrs.append(psms.scannrs)
+      charges.append(psms.charges)
+      svmScores.append(psms.svmScores)
+      self.peptides.extend(psms.peptides)
+      self.proteins.extend(psms.proteins)
+    self.charges, self.svmScores = np.concatenate(charges), np.concatenate(svmScores)
+    
+    # the sort is stable, so that the last of the PSMs with the same key is kept
+    order = np.lexsort((np.concatenate(scannrs), np.concatenate(fileCodes)))
+    fileCodes, scannrs = np.concatenate(fileCodes)[order], np.concatenate(scannrs)[order]
+    isLast = np.ones(len(order), dtype = bool)
+    isLast[:-1] = (fileCodes[1:] != fileCodes[:-1]) | (scannrs[1:] != scannrs[:-1])
+    self.psmIdxs, self.fileCodes, self.scannrs = order[isLast], fileCodes[isLast], scannrs[isLast]
+  
+  # returns a list with the (peptide, proteins, svm_score, charge) tuple of 
+  # each scan number of filename, or getDefaultPeptideHit() if there is no PSM
+  # for it. The filename is ignored unless byFile is set
+  def getPeptideHits(self, scannrs, filename = None):
+    fileCode = self.fileCodeMap.get(filename) if self.byFile else 0
+    if fileCode is None:
+      return [getDefaultPeptideHit() for _ in scannrs]
+    
+    start, end = np.searchsorted(self.fileCodes, fileCode, side = 'left'), np.searchsorted(self.fileCodes, fileCode, side = 'right')
+    if start == end:
+      return [getDefaultPeptideHit() for _ in scannrs]
+    
+    scannrs = np.asarray(scannrs)
+    positions = start + np.minimum(np.searchsorted(self.scannrs[start:end], scannrs), end - start - 1)
+    psmIdxs = np.where(self.scannrs[positions] == scannrs, self.psmIdxs[positions], -1)
+    
+    peptides, proteins = self.peptides, self.proteins
+    return [(peptides[i], proteins[i], svmScore, charge) if i >= 0 else getDefaultPeptideHit() for i, svmScore, charge in zip(psmIdxs.tolist(), self.svmScores[psmIdxs].tolist(), self.charges[psmIdxs].tolist())]
 
 def getDefaultPeptideHit():
   return ("NA", ["NA"], np.nan, -1) # psm.peptide, psm.PEP, psm.proteins, psm.svm_score, psm.charge
   
 def getNormalizationFactorArrays(peptideToFeatureMap, fileInfoList, params):
+  getFactorPairs = lambda fraction, minRunsObservedIn : normalize.getIntensityFactorPairs(peptideToFeatureMap.values(), sortKey = lambda x : (x[2], x[0].run, -1*x[0].intensity, x[1]), minRunsObservedIn = minRunsObservedIn, fraction = fraction)
+  return _getNormalizationFactorArrays(getFactorPairs, fileInfoList, params)
+
+# columnar version of getNormalizationFactorArrays, with one entry per feature
+# in featureClusterIdxs, runs, fractions, intensities and rTimes
+def getNormalizationFactorArraysFromColumns(featureClusterIdxs, runs, fractions, intensities, rTimes, fileInfoList, params):
+  def getFactorPairs(fraction, minRunsObservedIn):
+    isFraction = np.array([x == fraction for x in fractions], dtype = bool)
+    return normalize.getIntensityFactorPairsFromArrays(featureClusterIdxs[isFraction], np.array(runs, dtype = object)[isFraction], intensities[isFraction], rTimes[isFraction], minRunsObservedIn)
+  return _getNormalizationFactorArrays(getFactorPairs, fileInfoList, params)
+
+def _getNormalizationFactorArrays(getFactorPairs, fileInfoList, params):
   _, _, sampleList, fractionList = zip(*fileInfoList)
   rTimeArrays, factorArrays = dict(), dict()
   if not params['skipNormalization']:
     print("Applying retention-time dependent intensity normalization")
     minRunsObservedIn = len(set(sampleList)) / 3 + 1
     for fraction in sorted(list(set(fractionList))):
-      factorPairs = normalize.getIntensityFactorPairs(peptideToFeatureMap.values(), sortKey = lambda x : (x[2], x[0].run, -1*x[0].intensity, x[1]), minRunsObservedIn = minRunsObservedIn, fraction = fraction)
+      factorPairs = getFactorPairs(fraction, minRunsObservedIn)
       print("Fraction:", fraction, "#runs:", len(factorPairs))
       if params['plotScatter']:
         normalize.plotFactorScatter(factorPairs)
@@ -34,23 +85,41 @@ def getNormalizationFactorArrays(peptideToFeatureMap, fileInfoList, params):
       
       rTimeArrays[fraction], factorArrays[fraction] = dict(), dict()
       for key in rTimeFactorArrays:
-        rTimeArrays[fraction][key], factorArrays[fraction][key] = zip(*rTimeFactorArrays[key])
+        rTimeArrays[fraction][key], factorArrays[fraction][key] = rTimeFactorArrays[key]
   else:
     print("Skipping retention-time dependent intensity normalization")
   
   return rTimeArrays, factorArrays
 
 def writeTriqlerInputFile(triqlerInputFile, peptideToFeatureMap, rTimeArrays, factorArrays, params):
+  writeTriqlerInputRows(triqlerInputFile, getTriqlerInputRows(peptideToFeatureMap, rTimeArrays, factorArrays, params), params)
+
+def writeTriqlerInputRows(triqlerInputFile, triqlerInputRows, params):
   writer = parsers.getTsvWriter(triqlerInputFile)
   if params['simpleOutputFormat']:
     writer.writerow(parsers.TriqlerSimpleInputRowHeaders)
+    writer.writerows(row.toSimpleList() for row in triqlerInputRows)
   else:
     writer.writerow(parsers.TriqlerInputRowHeaders)
-  
+    writer.writerows(row.toList() for row in triqlerInputRows)
+
+def getTriqlerInputRows(peptideToFeatureMap, rTimeArrays, factorArrays, params):
+  featureClusters = list()
   for featureClusterIdx, featureCluster in enumerate(peptideToFeatureMap.values()):
     if featureClusterIdx % 50000 == 0:
       print("Processing feature group", featureClusterIdx + 1)
-    newRows = selectBestScorePerRun(featureCluster)
+    featureClusters.append(selectBestScorePerRun(featureCluster))
+  
+  # normalize the intensities of all selected features at once
+  if not params['skipNormalization']:
+    rows = [x for newRows in featureClusters for x in newRows]
+    rTimeArraysFlat = dict(((fraction, run), rTimeArray) for fraction in rTimeArrays for run, rTimeArray in rTimeArrays[fraction].items())
+    factorArraysFlat = dict(((fraction, run), factorArray) for fraction in factorArrays for run, factorArray in factorArrays[fraction].items())
+    normalizedIntensities = iter(normalize.getNormalizedIntensities(rTimeArraysFlat, factorArraysFlat, [(fraction, row.run) for row, _, fraction in rows], [rTime for _, rTime, _ in rows], [row.intensity for row, _, _ in rows]))
+  
+  for newRows in featureClusters:
+    if not params['skipNormalization']:
+      newRows = [(row._replace(intensity = next(normalizedIntensities)), rTime, fraction) for row, rTime, fraction in newRows]
     
     if not params['skipMBR']:
       searchScores = [x[0].searchScore for x in newRows if not np.isnan(x[0].searchScore)]
@@ -59,20 +128,12 @@ def writeTriqlerInputFile(triqlerInputFile, peptideToFeatureMap, rTimeArrays, fa
       worstSearchScore = np.min(searchScores)
     
     for (row, rTime, fraction) in newRows:
-      if not params['skipNormalization']:
-        newIntensity = normalize.getNormalizedIntensity(rTimeArrays[fraction][row.run], factorArrays[fraction][row.run], rTime, row.intensity)
-        row = row._replace(intensity = newIntensity)
-      
       if np.isnan(row.searchScore):
         if not params['skipMBR']:
           row = row._replace(searchScore = worstSearchScore)
         else:
           continue
-      
-      if params['simpleOutputFormat']:
-        writer.writerow(row.toSimpleList())
-      else:
-        writer.writerow(row.toList())
+      yield row
 
 def selectBestScorePerRun(rows):
   newRows = list()
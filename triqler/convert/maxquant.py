@@ -7,13 +7,20 @@ from __future__ import print_function
 
 import sys
 import os
+import io
+import csv
 import collections
+import multiprocessing
 
-import numpy as np
-
-from .. import parsers
 from ..triqler import __version__, __copyright__
-from . import helpers
+from ..lazy_import import lazyImport
+from ..errors import TriqlerError
+
+np = lazyImport("numpy")
+parsers = lazyImport("..parsers", __package__)
+pool = lazyImport("..multiprocessing_pool", __package__)
+helpers = lazyImport(".helpers", __package__)
+normalize = lazyImport(".normalize_intensities", __package__)
 
 def main():
   print('Triqler.convert.maxquant version %s\n%s' % (__version__, __copyright__))
@@ -21,7 +28,10 @@ def main():
   
   args, params = parseArgs()
   
-  convertMqToTriqler(args.file_list_file, args.in_file, args.out_file, params)
+  try:
+    convertMqToTriqler(args.file_list_file, args.in_file, args.out_file, params)
+  except TriqlerError as e:
+    sys.exit(str(e))
 
 def parseArgs():
   import argparse
@@ -50,6 +60,9 @@ def parseArgs():
                      help='Skips the match-between-runs rows in the output.',
                      action='store_true')
   
+  apars.add_argument('--num_threads', type=int, default=multiprocessing.cpu_count(), metavar='N',
+                     help='Number of threads for parsing blocks of the evidence.txt file in parallel.')
+  
   # ------------------------------------------------
   args = apars.parse_args()
   
@@ -58,68 +71,203 @@ def parseArgs():
   params['skipNormalization'] = args.skip_normalization
   params['skipMBR'] =  args.skip_mbr_rows
   params['plotScatter'] = False
+  params['numThreads'] = args.num_threads
   
   return args, params
   
 def convertMqToTriqler(fileListFile, mqEvidenceFile, triqlerInputFile, params):
+  columns, proteins = convertMqToTriqlerInputColumns(fileListFile, mqEvidenceFile, params)
+  
+  writeTriqlerInputFile(triqlerInputFile, columns, proteins, params)
+
+def convertMqToTriqlerInputRows(fileListFile, mqEvidenceFile, params):
+  columns, proteins = convertMqToTriqlerInputColumns(fileListFile, mqEvidenceFile, params)
+  
+  return (parsers.TriqlerInputRow(*(row + (proteinList,))) for row, proteinList in zip(zip(*columns), proteins))
+
+# returns the columns of the Triqler input file up to the peptide column and 
+# the list of proteins per row
+def convertMqToTriqlerInputColumns(fileListFile, mqEvidenceFile, params):
   fileInfoList = parsers.parseFileList(fileListFile)
   
-  peptideToFeatureMap = parseMqEvidenceFile(mqEvidenceFile, fileInfoList, params)
+  evidence = parseMqEvidenceFile(mqEvidenceFile, fileInfoList, params)
   
-  rTimeArrays, factorArrays = helpers.getNormalizationFactorArrays(peptideToFeatureMap, fileInfoList, params)
+  rTimeArrays, factorArrays = helpers.getNormalizationFactorArraysFromColumns(evidence.featureClusterIdxs, evidence.samples, evidence.fractions, evidence.intensities, evidence.rTimes, fileInfoList, params)
   
-  helpers.writeTriqlerInputFile(triqlerInputFile, peptideToFeatureMap, rTimeArrays, factorArrays, params)
+  return getTriqlerInputColumns(evidence, rTimeArrays, factorArrays, params)
+
+# the accepted rows of the evidence.txt file in columnar format. The peptide
+# and charge of a row are stored per feature cluster, the proteins per unique
+# "Leading proteins" entry
+MqEvidence = collections.namedtuple("MqEvidence", "samples conditions fractions spectrumIds featureClusterIdxs searchScores intensities rTimes clusterPeptides clusterCharges proteinIdxs proteins")
 
-def parseMqEvidenceFile(mqEvidenceFile, fileInfoList, params):
+# local dictionary encoding of the string columns of a block of rows
+MqEvidenceChunk = collections.namedtuple("MqEvidenceChunk", "numRows uniqueValues codes isAccepted searchScores intensities rTimes")
+
+MqEvidenceColumns = ['Raw file', 'Modified sequence', 'Charge', 'Leading proteins', 'Experiment', 'Intensity', 'Score', 'Retention time']
+
+def parseMqEvidenceFile(mqEvidenceFile, fileInfoList, params, chunkBytes = 64*1024*1024):
   fileList, _, _, _ = zip(*fileInfoList)
   reader = parsers.getTsvReader(mqEvidenceFile)
   headers = next(reader) # save the header
   
-  peptCol = headers.index('Modified sequence')
-  idCol = headers.index('MS/MS scan number')
-  fileCol = headers.index('Raw file')
-  chargeCol = headers.index('Charge')
-  intensityCol = headers.index('Intensity')
-  proteinCol = headers.index('Leading proteins')
-  scoreCol = headers.index('Score')
-  postErrCol = headers.index('PEP')
-  rtCol = headers.index('Retention time')
-  
+  colIdxs = [headers.index(col) for col in MqEvidenceColumns]
   fractionCol = headers.index('Fraction') if 'Fraction' in headers else -1
-  experimentCol = headers.index('Experiment')
   
   print("Parsing MaxQuant evidence.txt file")
-  peptideToFeatureMap = collections.defaultdict(list)
-  for lineIdx, row in enumerate(reader):
-    if lineIdx % 500000 == 0:
-      print("  Reading line", lineIdx)
-    
-    proteins = row[proteinCol].split(";")
-    
-    linkPEP = 0.0
-    key = (row[peptCol], row[chargeCol])
-    
-    if not row[fileCol] in fileList:
-      print("Warning: Could not find %s in the specified file list, skipping row" % row[fileCol])
-      continue
-    
-    fileIdx = fileList.index(row[fileCol])
-    run, condition, sample, fraction = fileInfoList[fileIdx]
+  byteRanges = getByteRanges(mqEvidenceFile, chunkBytes)
+  numThreads = params.get('numThreads', 1)
+  if numThreads > 1 and len(byteRanges) > 1:
+    processingPool = pool.MyPool(processes = min([numThreads, len(byteRanges)]))
+    for start, end in byteRanges:
+      processingPool.applyAsync(parseMqEvidenceChunk, [mqEvidenceFile, start, end, colIdxs, fractionCol])
+    chunks = processingPool.checkPool()
+  else:
+    chunks = [parseMqEvidenceChunk(mqEvidenceFile, start, end, colIdxs, fractionCol) for start, end in byteRanges]
+  
+  # map the local codes of the chunks to global codes, raw files are mapped
+  # to their index in the file list and to -1 if they are not in the list
+  fileIdxMap = dict((fileName, fileIdx) for fileIdx, fileName in enumerate(fileList))
+  valueMaps = [dict() for _ in range(4)] # keys, proteins, experiments, fractions
+  columns = collections.defaultdict(list)
+  lineIdxOffset = 0
+  for chunk in chunks:
+    chunkFiles = chunk.uniqueValues[0]
+    fileIdxs = np.array([fileIdxMap.get(x, -1) for x in chunkFiles] + [-1], dtype = int)[chunk.codes[0]]
+    for rowIdx in np.nonzero(fileIdxs == -1)[0]:
+      print("Warning: Could not find %s in the specified file list, skipping row" % chunkFiles[chunk.codes[0][rowIdx]])
+  
+    isAccepted = chunk.isAccepted & (fileIdxs != -1)
+    columns['lineIdxs'].append(np.nonzero(isAccepted)[0] + lineIdxOffset)
+    columns['fileIdxs'].append(fileIdxs[isAccepted])
+    for i, (valueMap, values, codes) in enumerate(zip(valueMaps, chunk.uniqueValues[1:], chunk.codes[1:])):
+      globalCodes = np.array([valueMap.setdefault(x, len(valueMap)) for x in values] + [-1], dtype = int)
+      columns[i].append(globalCodes[codes[isAccepted]])
+    for name in ['searchScores', 'intensities', 'rTimes']:
+      columns[name].append(getattr(chunk, name)[isAccepted])
+    lineIdxOffset += chunk.numRows
+  
+  lineIdxs, fileIdxs, searchScores, intensities, rTimes = [np.concatenate(columns[name]) for name in ['lineIdxs', 'fileIdxs', 'searchScores', 'intensities', 'rTimes']]
+  keyIdxs, proteinIdxs, experimentIdxs, fractionIdxs = [np.concatenate(columns[i]) for i in range(4)]
+  keys, proteins, experiments, fractions = [sorted(valueMap, key = valueMap.get) for valueMap in valueMaps]
+  
+  # feature clusters are numbered in order of the first accepted row of a key
+  uniqueKeyIdxs, firstRowIdxs, keyIdxs = np.unique(keyIdxs, return_index = True, return_inverse = True)
+  clusterRanks = np.zeros(len(uniqueKeyIdxs), dtype = int)
+  clusterRanks[np.argsort(firstRowIdxs)] = np.arange(len(uniqueKeyIdxs))
+  featureClusterIdxs = clusterRanks[keyIdxs]
+  clusterKeys = [keys[keyIdx] for keyIdx in uniqueKeyIdxs[np.argsort(clusterRanks)]]
+  
+  samples, conditions, rowFractions = list(), list(), list()
+  for fileIdx, experimentIdx, fractionIdx in zip(fileIdxs.tolist(), experimentIdxs.tolist(), fractionIdxs.tolist()):
+    _, condition, sample, fraction = fileInfoList[fileIdx]
     if fraction == -1 and fractionCol != -1:
-      sample, fraction = row[experimentCol], row[fractionCol]
-    
-    if key in peptideToFeatureMap:
-      featureClusterIdx = peptideToFeatureMap[key][0][0].featureClusterId
-    else:
-      featureClusterIdx = len(peptideToFeatureMap)
-    
-    if row[intensityCol] == "" or float(row[scoreCol]) <= 0:
-      continue
-    
-    triqlerRow = parsers.TriqlerInputRow(sample, condition, row[chargeCol], lineIdx, linkPEP, featureClusterIdx, np.log(float(row[scoreCol])), float(row[intensityCol]), row[peptCol], proteins)
-    peptideToFeatureMap[key].append((triqlerRow, float(row[rtCol]), fraction))
-  
-  return peptideToFeatureMap
+      sample, fraction = experiments[experimentIdx], fractions[fractionIdx]
+    samples.append(sample)
+    conditions.append(condition)
+    rowFractions.append(fraction)
+  
+  with np.errstate(invalid = 'ignore'):
+    searchScores = np.log(searchScores)
+  
+  return MqEvidence(samples, conditions, rowFractions, lineIdxs, featureClusterIdxs, searchScores, intensities, rTimes, [key[0] for key in clusterKeys], [key[1] for key in clusterKeys], proteinIdxs, [x.split(";") for x in proteins])
+
+# splits the rows after the header line into blocks of approximately
+# chunkBytes bytes that start and end at a line break. Note that this assumes
+# that fields do not contain quoted line breaks, which MaxQuant does not write
+def getByteRanges(inputFile, chunkBytes):
+  byteRanges = list()
+  with open(inputFile, 'rb') as f:
+    f.readline() # skip the header
+    start = f.tell()
+    fileSize = os.fstat(f.fileno()).st_size
+    while start < fileSize:
+      f.seek(max([start, start + chunkBytes - 1]))
+      f.readline()
+      end = min([f.tell(), fileSize])
+      byteRanges.append((start, end))
+      start = end
+  if len(byteRanges) == 0:
+    byteRanges.append((start, start))
+  return byteRanges
+
+def parseMqEvidenceChunk(mqEvidenceFile, start, end, colIdxs, fractionCol):
+  with open(mqEvidenceFile, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+  
+  # Python 3
+  if sys.version_info[0] >= 3:
+    reader = csv.reader(io.StringIO(data.decode('utf-8'), newline = ''), delimiter = '\t')
+  # Python 2
+  else:
+    reader = csv.reader(io.BytesIO(data), delimiter = '\t')
+  rows = list(reader)
+  
+  fileCol, peptCol, chargeCol, proteinCol, experimentCol, intensityCol, scoreCol, rtCol = colIdxs
+  
+  # dictionary encode the raw files, (peptide, charge) keys, proteins,
+  # experiments and fractions of the rows
+  uniqueValues, codes = list(), list()
+  for values in [(row[fileCol] for row in rows), ((row[peptCol], row[chargeCol]) for row in rows), (row[proteinCol] for row in rows), (row[experimentCol] for row in rows), (row[fractionCol] if fractionCol != -1 else -1 for row in rows)]:
+    valueMap = dict()
+    codes.append(np.array([valueMap.setdefault(x, len(valueMap)) for x in values], dtype = int))
+    uniqueValues.append(sorted(valueMap, key = valueMap.get))
+  
+  # rows without intensity or with a score <= 0 are skipped, only the numeric
+  # fields of the remaining rows are parsed
+  searchScores, intensities, rTimes = np.full(len(rows), np.nan), np.full(len(rows), np.nan), np.full(len(rows), np.nan)
+  hasIntensity = np.array([row[intensityCol] != "" for row in rows], dtype = bool)
+  rowIdxs = np.nonzero(hasIntensity)[0].tolist()
+  searchScores[rowIdxs] = [float(rows[i][scoreCol]) for i in rowIdxs]
+  with np.errstate(invalid = 'ignore'):
+    isAccepted = hasIntensity & ~(searchScores <= 0)
+  rowIdxs = np.nonzero(isAccepted)[0].tolist()
+  intensities[rowIdxs] = [float(rows[i][intensityCol]) for i in rowIdxs]
+  rTimes[rowIdxs] = [float(rows[i][rtCol]) for i in rowIdxs]
+  
+  return MqEvidenceChunk(len(rows), uniqueValues, codes, isAccepted, searchScores, intensities, rTimes)
+
+# columnar version of helpers.getTriqlerInputRows
+def getTriqlerInputColumns(evidence, rTimeArrays, factorArrays, params):
+  # every row has a unique spectrumId, so helpers.selectBestScorePerRun keeps
+  # all rows and only sorts them by run and spectrumId within each cluster
+  uniqueSamples, sampleIdxs = np.unique(np.array(evidence.samples, dtype = object), return_inverse = True)
+  order = np.lexsort((evidence.spectrumIds, sampleIdxs, evidence.featureClusterIdxs))
+  featureClusterIdxs, searchScores, intensities = evidence.featureClusterIdxs[order], evidence.searchScores[order], evidence.intensities[order]
+  samples, fractions = [evidence.samples[i] for i in order], [evidence.fractions[i] for i in order]
+  
+  if not params['skipNormalization']:
+    rTimeArraysFlat = dict(((fraction, run), rTimeArray) for fraction in rTimeArrays for run, rTimeArray in rTimeArrays[fraction].items())
+    factorArraysFlat = dict(((fraction, run), factorArray) for fraction in factorArrays for run, factorArray in factorArrays[fraction].items())
+    intensities = np.array(normalize.getNormalizedIntensities(rTimeArraysFlat, factorArraysFlat, list(zip(fractions, samples)), evidence.rTimes[order], intensities))
+  
+  # rows with a NaN score get the worst score of their feature cluster, or
+  # are skipped with skipMBR
+  isValid = ~np.isnan(searchScores)
+  if not params['skipMBR']:
+    clusterStarts = np.nonzero(np.concatenate(([True], np.diff(featureClusterIdxs) != 0)))[0]
+    clusterSizes = np.diff(np.append(clusterStarts, len(featureClusterIdxs)))
+    worstSearchScores = np.repeat(np.fmin.reduceat(searchScores, clusterStarts), clusterSizes) if len(clusterStarts) > 0 else searchScores
+    isValid = ~np.isnan(worstSearchScores)
+    searchScores = np.where(np.isnan(searchScores), worstSearchScores, searchScores)
+  
+  rowIdxs = np.nonzero(isValid)[0]
+  columns = [[samples[i] for i in rowIdxs], [evidence.conditions[i] for i in order[rowIdxs]], [evidence.clusterCharges[i] for i in featureClusterIdxs[rowIdxs]]]
+  columns += [evidence.spectrumIds[order[rowIdxs]].tolist(), [0.0]*len(rowIdxs), featureClusterIdxs[rowIdxs].tolist()]
+  columns += [searchScores[rowIdxs].tolist(), intensities[rowIdxs].tolist(), [evidence.clusterPeptides[i] for i in featureClusterIdxs[rowIdxs]]]
+  proteins = [evidence.proteins[i] for i in evidence.proteinIdxs[order[rowIdxs]]]
+  return columns, proteins
+
+# columnar version of helpers.writeTriqlerInputRows
+def writeTriqlerInputFile(triqlerInputFile, columns, proteins, params):
+  writer = parsers.getTsvWriter(triqlerInputFile)
+  if params['simpleOutputFormat']:
+    writer.writerow(parsers.TriqlerSimpleInputRowHeaders)
+    columns = columns[:3] + columns[6:]
+  else:
+    writer.writerow(parsers.TriqlerInputRowHeaders)
+  writer.writerows(row + proteinList for row, proteinList in zip(map(list, zip(*columns)), proteins))
 
 if __name__ == "__main__":
    main()
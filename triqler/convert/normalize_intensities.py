@@ -1,8 +1,10 @@
 from __future__ import print_function
 
+import os
 import sys
 import csv
 import bisect
+import itertools
 from collections import defaultdict
 
 import numpy as np
@@ -10,6 +12,12 @@ import numpy as np
 from .. import parsers
 
 def normalizeIntensitiesRtimeBased(clusterQuantExtraFile, clusterQuantExtraNormalizedFile, minRunsObservedIn, plotScatter = False, plotRunningAverage = False):
+  rTimeFactorArrays = getRtimeFactorArrays(clusterQuantExtraFile, minRunsObservedIn, plotScatter, plotRunningAverage)
+  normalizeIntensitiesWithFactorArrays(clusterQuantExtraFile, rTimeFactorArrays, clusterQuantExtraNormalizedFile)
+
+# computes the normalization factors in a single pass over the feature groups,
+# returns (rTimes, factors) arrays per run
+def getRtimeFactorArrays(clusterQuantExtraFile, minRunsObservedIn, plotScatter = False, plotRunningAverage = False):
   featureGroups = parsers.parseFeatureClustersFile(clusterQuantExtraFile)
   factorPairs = getIntensityFactorPairs(featureGroups, sortKey = lambda x : (1, x.fileName, -1.0 * x.intensity, x.rTime), minRunsObservedIn = minRunsObservedIn)
   
@@ -21,44 +29,118 @@ def normalizeIntensitiesRtimeBased(clusterQuantExtraFile, clusterQuantExtraNorma
   if plotRunningAverage:
     plotFactorRunningAverage(rTimeFactorArrays)
   
-  normalizeIntensitiesWithFactorArrays(clusterQuantExtraFile, rTimeFactorArrays, clusterQuantExtraNormalizedFile)
+  return rTimeFactorArrays
+
+def getFactorArraysFile(clusterQuantExtraFile):
+  return os.path.splitext(clusterQuantExtraFile)[0] + ".normalization_factors.tsv"
+
+# the factor arrays file has one row per (run, rTime) pair, floats are written
+# with full precision, such that reusing the file gives identical results
+def writeFactorArraysFile(factorArraysFile, rTimeFactorArrays):
+  writer = parsers.getTsvWriter(factorArraysFile)
+  writer.writerow(["run", "rTime", "factor"])
+  for key in sorted(rTimeFactorArrays.keys()):
+    rTimes, factors = rTimeFactorArrays[key]
+    writer.writerows([key, rTime, factor] for rTime, factor in zip(np.asarray(rTimes).tolist(), np.asarray(factors).tolist()))
+
+def parseFactorArraysFile(factorArraysFile):
+  reader = parsers.getTsvReader(factorArraysFile)
+  next(reader) # headers
+  rTimeFactorPairs = defaultdict(list)
+  for row in reader:
+    rTimeFactorPairs[row[0]].append((float(row[1]), float(row[2])))
+  
+  rTimeFactorArrays = dict()
+  for key, pairs in rTimeFactorPairs.items():
+    rTimes, factors = zip(*pairs)
+    rTimeFactorArrays[key] = (np.array(rTimes), np.array(factors))
+  return rTimeFactorArrays
 
+# applies the normalization factors to the features of a stream of feature 
+# groups, processing chunkSize feature groups at a time
+def normalizeFeatureClusters(featureClusters, rTimeFactorArrays, chunkSize = 10000):
+  rTimeArrays, factorArrays = dict(), dict()
+  for key in rTimeFactorArrays:
+    rTimeArrays[key], factorArrays[key] = rTimeFactorArrays[key]
+  
+  chunk = list()
+  for featureCluster in itertools.chain(featureClusters, [None]):
+    if featureCluster is not None:
+      chunk.append(featureCluster)
+      if len(chunk) < chunkSize:
+        continue
+    
+    rows = [row for precCluster in chunk for row in precCluster]
+    normalizedIntensities = iter(getNormalizedIntensities(rTimeArrays, factorArrays, [row.fileName for row in rows], [row.rTime for row in rows], [row.intensity for row in rows]))
+    for precCluster in chunk:
+      yield [parsers.PrecursorCandidate(row.fileIdx, row.fileName, row.precMz, row.charge, row.rTime, next(normalizedIntensities), row.peptLinkPEPs) for row in precCluster]
+    chunk = list()
+
+# returns a dictionary with for each run an array with (rTime, factor) rows,
+# in the order of the feature groups. For each feature group observed in at 
+# least minRunsObservedIn runs, the most intense feature per run is selected 
+# and its factor is its log2 intensity minus the mean over the selected features
 def getIntensityFactorPairs(featureGroups, sortKey, minRunsObservedIn, fraction = 1):
-  factorPairs = defaultdict(list)
+  groupIdxs, runKeys, intensities, rTimes = list(), list(), list(), list()
   for i, featureGroup in enumerate(featureGroups):
-    localFactorPairs = dict()
-    sortedFeatures = sorted(featureGroup, key = sortKey)
-    for row in sortedFeatures:
+    for row in featureGroup:
       rowFraction, fileName, intensity, rTime = sortKey(row)
-      intensity *= -1.0
-      if fraction == rowFraction and not np.isnan(intensity) and fileName not in localFactorPairs:
-        localFactorPairs[fileName] = (np.log2(intensity), rTime)
-    
-    if len(localFactorPairs) >= minRunsObservedIn:
-      keys = sorted(localFactorPairs.keys())
-      masterKey = keys[0]
-      factor0 = sum([localFactorPairs[masterKey][0] - x[0] for x in localFactorPairs.values()]) / len(keys)
-      factorPairs[masterKey].append((localFactorPairs[masterKey][1], factor0))
-      for key in keys[1:]:
-        factori = factorPairs[masterKey][-1][1] - (localFactorPairs[masterKey][0] - localFactorPairs[key][0])
-        factorPairs[key].append((localFactorPairs[key][1], factori))
-    #if (i+1) % 100000 == 0:
-    #  print("Processing cluster", i+1)
+      if fraction == rowFraction:
+        groupIdxs.append(i)
+        runKeys.append(fileName)
+        intensities.append(-1.0 * intensity)
+        rTimes.append(rTime)
+  return getIntensityFactorPairsFromArrays(groupIdxs, runKeys, intensities, rTimes, minRunsObservedIn)
+
+# array version of getIntensityFactorPairs, with one entry per feature
+def getIntensityFactorPairsFromArrays(groupIdxs, runKeys, intensities, rTimes, minRunsObservedIn):
+  factorPairs = dict()
+  groupIdxs, intensities, rTimes = np.array(groupIdxs, dtype = int), np.array(intensities, dtype = float), np.array(rTimes, dtype = float)
+  isValid = ~np.isnan(intensities)
+  if np.count_nonzero(isValid) == 0:
+    return factorPairs
+  
+  runs, runIdxs = np.unique(np.array(runKeys, dtype = object)[isValid], return_inverse = True)
+  groupIdxs, intensities, rTimes = groupIdxs[isValid], intensities[isValid], rTimes[isValid]
+  
+  # most intense feature per (feature group, run), ties resolved by retention time
+  order = np.lexsort((rTimes, -1.0 * intensities, runIdxs, groupIdxs))
+  groupIdxs, runIdxs, intensities, rTimes = groupIdxs[order], runIdxs[order], intensities[order], rTimes[order]
+  isFirst = np.ones(len(order), dtype = bool)
+  isFirst[1:] = (np.diff(groupIdxs) != 0) | (np.diff(runIdxs) != 0)
+  groupIdxs, runIdxs, logIntensities, rTimes = groupIdxs[isFirst], runIdxs[isFirst], np.log2(intensities[isFirst]), rTimes[isFirst]
+  
+  groupStarts = np.nonzero(np.concatenate(([True], np.diff(groupIdxs) != 0)))[0]
+  groupSizes = np.diff(np.append(groupStarts, len(groupIdxs)))
+  isObserved = np.repeat(groupSizes >= minRunsObservedIn, groupSizes)
+  
+  # the first run of each feature group is the master run
+  masterLogIntensities = np.repeat(logIntensities[groupStarts], groupSizes)
+  diffs = masterLogIntensities - logIntensities
+  
+  # sum the differences one run at a time, which gives the same result as 
+  # summing them sequentially per feature group
+  diffSums = np.zeros(len(groupStarts))
+  positions = np.arange(len(groupIdxs)) - np.repeat(groupStarts, groupSizes)
+  for position in range(np.max(groupSizes)):
+    isPosition = positions == position
+    diffSums[np.nonzero(groupSizes > position)[0]] += diffs[isPosition]
+  factors0 = np.repeat(diffSums / groupSizes, groupSizes)
+  factors = np.where(positions == 0, factors0, factors0 - diffs)
+  
+  for runIdx, run in enumerate(runs):
+    isRun = (runIdxs == runIdx) & isObserved
+    if np.count_nonzero(isRun) > 0:
+      factorPairs[run] = np.column_stack((rTimes[isRun], factors[isRun]))
   return factorPairs
 
-# returns running averages of factors
+# returns running averages of factors as (rTimes, factors) arrays per run
 def getFactorArrays(factorPairs, N = 2000):
-  factorArrays = defaultdict(list)
+  factorArrays = dict()
   for i, key in enumerate(sorted(factorPairs.keys())):
     print("Calculating normalization factors for run", i+1, "using", len(factorPairs[key]), "precursors")
-    #medianFactor = np.median([x[1] for x in factorPairs[key]])
-    #print("Calculating normalization factors for run", i+1, "using", len(factorPairs[key]), "precursors", medianFactor)
-    factorPairs[key] = sorted(factorPairs[key], key = lambda x : x[0])
-    rTimes = [x[0] for x in factorPairs[key]]
-    factors = [x[1] for x in factorPairs[key]]
-    #factors = [medianFactor for x in factorPairs[key]]
-    runningMeans = runningMean(factors, N)
-    factorArrays[key] = zip(rTimes, runningMeans)
+    pairs = factorPairs[key][np.argsort(factorPairs[key][:, 0], kind = 'mergesort')]
+    factorArrays[key] = (pairs[:, 0], runningMean(pairs[:, 1], N))
   return factorArrays
 
 def runningMean(x, N):
@@ -69,18 +151,16 @@ def runningMean(x, N):
     rm = (cumsum[N:] - cumsum[:-N]) / N 
     return np.concatenate(([rm[0]]*int(N/2), rm, [rm[-1]]*int(N/2)))
   
+# streams the feature groups, normalizing chunks of them at a time, so that
+# the feature groups do not have to be kept in memory
 def normalizeIntensitiesWithFactorArrays(clusterQuantExtraFile, rTimeFactorArrays, clusterQuantExtraNormalizedFile):
-  rTimeArrays, factorArrays = dict(), dict()
-  for key in rTimeFactorArrays:
-    rTimeArrays[key], factorArrays[key] = zip(*rTimeFactorArrays[key])
+  featureClusters = normalizeFeatureClusters(parsers.parseFeatureClustersFile(clusterQuantExtraFile), rTimeFactorArrays)
+  
   print("Writing", clusterQuantExtraNormalizedFile)
   writer = parsers.getTsvWriter(clusterQuantExtraNormalizedFile)
-  precClusters = parsers.parseFeatureClustersFile(clusterQuantExtraFile)
-  for i, precCluster in enumerate(precClusters):
+  for i, precCluster in enumerate(featureClusters):
     for row in precCluster:
-      outRow = list(row[1:])
-      outRow[4] = getNormalizedIntensity(rTimeArrays[row.fileName], factorArrays[row.fileName], row.rTime, row.intensity)
-      writer.writerow(outRow)
+      writer.writerow(row[1:])
     writer.writerow([])
     if (i+1) % 50000 == 0:
       print("Writing cluster", i+1)
@@ -89,6 +169,24 @@ def getNormalizedIntensity(rTimeArray, factorArray, rTime, intensity):
   rTimeIndex = min([bisect.bisect_left(rTimeArray, rTime), len(rTimeArray) - 1])
   return intensity / (2 ** factorArray[rTimeIndex])
 
+# vectorized version of getNormalizedIntensity, applies the normalization 
+# factors with a single searchsorted per run. runKeys can be any hashable 
+# key into rTimeArrays and factorArrays. Returns a list of python floats
+def getNormalizedIntensities(rTimeArrays, factorArrays, runKeys, rTimes, intensities):
+  keyIdxMap = dict()
+  keyIdxs = np.array([keyIdxMap.setdefault(key, len(keyIdxMap)) for key in runKeys], dtype = int)
+  rTimes, intensities = np.array(rTimes, dtype = float), np.array(intensities, dtype = float)
+  
+  normalizedIntensities = np.zeros(len(intensities))
+  order = np.argsort(keyIdxs, kind = 'mergesort')
+  keyStarts = np.searchsorted(keyIdxs[order], np.arange(len(keyIdxMap) + 1))
+  for key, keyIdx in keyIdxMap.items():
+    rowIdxs = order[keyStarts[keyIdx]:keyStarts[keyIdx+1]]
+    rTimeArray, factorArray = np.asarray(rTimeArrays[key]), np.asarray(factorArrays[key])
+    rTimeIdxs = np.minimum(np.searchsorted(rTimeArray, rTimes[rowIdxs], side = 'left'), len(rTimeArray) - 1)
+    normalizedIntensities[rowIdxs] = intensities[rowIdxs] / np.power(2.0, factorArray[rTimeIdxs])
+  return normalizedIntensities.tolist()
+
 def plotFactorScatter(factorPairs):
   from . import scatter
   import matplotlib.pyplot as plt
@@ -116,7 +214,7 @@ def plotFactorRunningAverage(factorArrays):
     plt.xlabel("Retention time")
     plt.ylabel("log2(int0/int1)")
     plt.ylim([-2,2])
-    plt.plot(*zip(*factorArrays[key]))
+    plt.plot(*factorArrays[key])
   plt.show()
 
 if __name__ == "__main__":
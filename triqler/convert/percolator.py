@@ -8,8 +8,11 @@ from __future__ import print_function
 
 import sys
 import csv
+import array
 import collections
 
+import numpy as np
+
 from .. import parsers
 
 PercolatorPoutPsmsBase = collections.namedtuple("PercolatorPoutPsms", "id filename scannr charge svm_score qvalue PEP peptide proteins")
@@ -60,6 +63,65 @@ def parsePsmsPout(poutFile, qThresh = 1.0, proteinMap = None, parseId = True, fi
     else:
       break
 
+# PSMs of a Percolator output file as columns, filenames holds the distinct
+# file names and fileCodes the index into filenames of each PSM
+PercolatorPsmColumns = collections.namedtuple("PercolatorPsmColumns", "filenames fileCodes scannrs charges svmScores peptides proteins")
+
+# faster and more compact alternative to parsePsmsPout for large files, which 
+# does not create a PercolatorPoutPsms per PSM and splits each PSMId only once
+def parsePsmsPoutColumns(poutFile, qThresh = 1.0, fixScannr = False):
+  reader = parsers.getTsvReader(poutFile)
+  headers = next(reader) # save the header
+  
+  cruxOutput = True if "percolator score" in headers else False
+  if cruxOutput:
+    proteinCol = headers.index('protein id')
+    fileIdxCol = headers.index('file_idx')
+    scanCol = headers.index('scan')
+    chargeCol = headers.index('charge')
+    scoreCol = headers.index('percolator score')
+    qvalCol = headers.index('percolator q-value')
+    peptideCol = headers.index('sequence')
+    terminalsCol = headers.index('flanking aa')
+  else:
+    qvalCol = headers.index('q-value')
+  
+  fixScannr = "_msfragger" in poutFile or "_moda" in poutFile or "_msgf" in poutFile or fixScannr
+  numIdFields = 6 if fixScannr else 3
+  
+  # the numeric columns are collected in typed arrays to save memory
+  fileCodeMap = dict()
+  fileCodes, scannrs, charges, svmScores = array.array('l'), array.array('l'), array.array('l'), array.array('d')
+  peptides, proteins = list(), list()
+  for row in reader:
+    if float(row[qvalCol]) > qThresh:
+      break
+    
+    if cruxOutput:
+      fileCodes.append(fileCodeMap.setdefault(int(row[fileIdxCol]), len(fileCodeMap)))
+      scannrs.append(int(row[scanCol]))
+      charges.append(int(row[chargeCol]))
+      svmScores.append(float(row[scoreCol]))
+      peptides.append(row[terminalsCol][0] + "." + row[peptideCol] + "." + row[terminalsCol][1])
+      proteins.append(list(set(row[proteinCol].split(','))))
+    else:
+      # PSMId = <filename>_<scannr>_<charge>_<rank>, see getFileName, getId 
+      # and getCharge
+      idFields = row[0].rsplit('_', numIdFields)
+      fileCodes.append(fileCodeMap.setdefault(idFields[0], len(fileCodeMap)))
+      scannrs.append(int(idFields[-3]))
+      charges.append(int(idFields[-2]))
+      svmScores.append(float(row[1]))
+      peptides.append(row[4])
+      proteins.append(row[5:])
+  
+  scannrs = np.array(scannrs, dtype = int)
+  if fixScannr and not cruxOutput:
+    scannrs = scannrs / 100
+  
+  filenames = sorted(fileCodeMap, key = fileCodeMap.get)
+  return PercolatorPsmColumns(filenames, np.array(fileCodes, dtype = int), scannrs, np.array(charges, dtype = int), np.array(svmScores, dtype = float), peptides, proteins)
+
 def toList(psm):
   l = list(psm)
   return l[:-1] + l[-1]
@@ -16,14 +16,16 @@ from __future__ import print_function
 
 import os
 import sys
-import numpy as np
 import collections
 
-from .. import parsers
 from ..triqler import __version__, __copyright__
+from ..lazy_import import lazyImport
+from ..errors import TriqlerError
 
-from . import normalize_intensities as normalize
-from . import helpers
+np = lazyImport("numpy")
+parsers = lazyImport("..parsers", __package__)
+normalize = lazyImport(".normalize_intensities", __package__)
+helpers = lazyImport(".helpers", __package__)
 
 def main():
   print('Triqler.convert.quandenser version %s\n%s' % (__version__, __copyright__))
@@ -31,7 +33,10 @@ def main():
   
   args, params = parseArgs()
   
-  convertQuandenserToTriqler(args.file_list_file, args.in_file, args.psm_files.split(","), args.out_file, params)
+  try:
+    convertQuandenserToTriqler(args.file_list_file, args.in_file, args.psm_files.split(","), args.out_file, params)
+  except TriqlerError as e:
+    sys.exit(str(e))
 
 def parseArgs():
   import argparse
@@ -80,54 +85,80 @@ def parseArgs():
   return args, params
   
 def convertQuandenserToTriqler(fileListFile, clusterQuantFile, psmsOutputFiles, peptQuantRowFile, params):
+  triqlerInputRows = convertQuandenserToTriqlerInputRows(fileListFile, clusterQuantFile, psmsOutputFiles, params)
+  
+  helpers.writeTriqlerInputRows(peptQuantRowFile, triqlerInputRows, params)
+
+def convertQuandenserToTriqlerInputRows(fileListFile, clusterQuantFile, psmsOutputFiles, params):
   fileInfoList = parsers.parseFileList(fileListFile)
   
+  rTimeFactorArrays = None
   if not params['skipNormalization']:
-    clusterQuantFileNormalized = clusterQuantFile.replace(".tsv", ".normalized.tsv")
-    if not os.path.isfile(clusterQuantFileNormalized):
+    factorArraysFile = normalize.getFactorArraysFile(clusterQuantFile)
+    if not os.path.isfile(factorArraysFile) or os.path.getmtime(factorArraysFile) < os.path.getmtime(clusterQuantFile):
       print("Applying retention-time dependent intensity normalization")
       minRunsObservedIn = len(fileInfoList) / 3 + 1
-      normalize.normalizeIntensitiesRtimeBased(clusterQuantFile, clusterQuantFileNormalized, minRunsObservedIn, plotScatter = params['plotScatter'])
+      rTimeFactorArrays = normalize.getRtimeFactorArrays(clusterQuantFile, minRunsObservedIn, plotScatter = params['plotScatter'])
+      print("Writing normalization factors to", factorArraysFile)
+      normalize.writeFactorArraysFile(factorArraysFile, rTimeFactorArrays)
     else:
-      print("Reusing previously generated normalized feature group file:", clusterQuantFileNormalized, ". Remove this file to redo normalization")
-    clusterQuantFile = clusterQuantFileNormalized
+      print("Reusing previously generated normalization factors file:", factorArraysFile, ". Remove this file to redo normalization")
+      rTimeFactorArrays = normalize.parseFactorArraysFile(factorArraysFile)
   else:
     print("Skipping retention-time dependent intensity normalization")
   
-  specToPeptideMap = helpers.parsePsmsPoutFiles(psmsOutputFiles)
-  
-  printTriqlerInputFile(fileInfoList, clusterQuantFile, peptQuantRowFile, specToPeptideMap, params)
+  psmLookup = helpers.PsmLookup(psmsOutputFiles)
   
+  return getTriqlerInputRows(fileInfoList, clusterQuantFile, psmLookup, params, rTimeFactorArrays)
+
 def parsePeptideLinkPEP(peptLinkPEP):
   spectrumIdx, linkPEP = peptLinkPEP.split(";")
   return int(spectrumIdx), float(linkPEP)
 
-def printTriqlerInputFile(fileInfoList, clusterQuantFile, quantRowFile, specToPeptideMap, params):
+def printTriqlerInputFile(fileInfoList, clusterQuantFile, quantRowFile, psmLookup, params, rTimeFactorArrays = None):
+  helpers.writeTriqlerInputRows(quantRowFile, getTriqlerInputRows(fileInfoList, clusterQuantFile, psmLookup, params, rTimeFactorArrays), params)
+
+# returns the (precursor candidate, spectrumIdx, linkPEP, peptide hit) tuples 
+# of each feature cluster, the PSMs of the spectra of chunkSize feature 
+# clusters are looked up at once
+def getFeatureClusterPeptideHits(featureClusters, psmLookup, chunkSize = 10000):
+  def lookupChunk(chunk):
+    peptideHits = iter(psmLookup.getPeptideHits([spectrumIdx for matches in chunk for _, spectrumIdx, _ in matches]))
+    return [[(pc, spectrumIdx, linkPEP, next(peptideHits)) for pc, spectrumIdx, linkPEP in matches] for matches in chunk]
+  
+  chunk = list()
+  for featureCluster in featureClusters:
+    chunk.append([(pc,) + parsePeptideLinkPEP(peptLinkPEP) for pc in featureCluster for peptLinkPEP in pc.peptLinkPEPs.split(",")])
+    if len(chunk) == chunkSize:
+      for matches in lookupChunk(chunk):
+        yield matches
+      chunk = list()
+  
+  for matches in lookupChunk(chunk):
+    yield matches
+
+# the intensities are normalized on the fly if rTimeFactorArrays is given
+def getTriqlerInputRows(fileInfoList, clusterQuantFile, psmLookup, params, rTimeFactorArrays = None):
   print("Parsing cluster quant file")
   
-  writer = parsers.getTsvWriter(quantRowFile)
-  if params['simpleOutputFormat']:
-    writer.writerow(parsers.TriqlerSimpleInputRowHeaders)
-  else:
-    writer.writerow(parsers.TriqlerInputRowHeaders)
-  
   featureClusterRows = list()
   spectrumToFeatureMatch = dict() # stores the best peptideQuantRow per (peptide, spectrumIdx)-pair
-  for featureClusterIdx, featureCluster in enumerate(parsers.parseFeatureClustersFile(clusterQuantFile)):
+  featureClusters = parsers.parseFeatureClustersFile(clusterQuantFile)
+  if rTimeFactorArrays is not None:
+    featureClusters = normalize.normalizeFeatureClusters(featureClusters, rTimeFactorArrays)
+  
+  for featureClusterIdx, matches in enumerate(getFeatureClusterPeptideHits(featureClusters, psmLookup)):
     if featureClusterIdx % 50000 == 0:
       print("Processing feature group", featureClusterIdx + 1)
     
     rows = list()
-    for pc in featureCluster:
+    for pc, spectrumIdx, linkPEP, (peptide, proteins, searchScore, charge) in matches:
       fileIdx = int(pc.fileName)
-      for peptLinkPEP in pc.peptLinkPEPs.split(","):
-        spectrumIdx, linkPEP = parsePeptideLinkPEP(peptLinkPEP)
-        peptide, proteins, searchScore, charge = specToPeptideMap(spectrumIdx)
-        if pc.intensity > 0.0 and linkPEP < 1.0 and (params["retainUnidentified"] or peptide != "NA"):
-          # run condition charge spectrumId linkPEP featureClusterId search_score intensity peptide proteins
-          run, condition, sample, fraction = fileInfoList[fileIdx]
-          row = parsers.TriqlerInputRow(sample, condition, charge, spectrumIdx, linkPEP, featureClusterIdx, searchScore, pc.intensity, peptide, proteins)
-          rows.append(row)
+      if pc.intensity > 0.0 and linkPEP < 1.0 and (params["retainUnidentified"] or peptide != "NA"):
+        # run condition charge spectrumId linkPEP featureClusterId search_score intensity peptide proteins
+        run, condition, sample, fraction = fileInfoList[fileIdx]
+        row = parsers.TriqlerInputRow(sample, condition, charge, spectrumIdx, linkPEP, featureClusterIdx, searchScore, pc.intensity, peptide, proteins)
+        rows.append(row)
     
     newRows = list()
     rows = sorted(rows, key = lambda x : (x.run, x.spectrumId, x.linkPEP, -1*x.searchScore, -1*x.intensity))
@@ -143,10 +174,7 @@ def printTriqlerInputFile(fileInfoList, clusterQuantFile, quantRowFile, specToPe
         prevKey = (row.run, row.spectrumId)
     
     for row in newRows:
-      if params['simpleOutputFormat']:
-        writer.writerow(row.toSimpleList())
-      else:
-        writer.writerow(row.toList())
+      yield row
 
 if __name__ == "__main__":
    main()
@@ -2,43 +2,74 @@
 
 from __future__ import print_function
 
+import io
+import sys
+import csv
+import os
 import itertools
+import tempfile
+from collections import namedtuple
 
 import numpy as np
 from scipy.stats import f_oneway, kruskal
 
 from . import parsers
 from . import qvality
+from . import perf_report
+
+# protein table of a pairwise comparison of treatment groups, sorted by 
+# posterior error probability. observedQValues is None unless the true 
+# concentrations are known (params['trueConcentrationsDict'])
+ProteinComparison = namedtuple("ProteinComparison", "headers qValues observedQValues posteriorErrorProbs proteins numPeptides proteinIdPEPs log2FoldChanges diffExpProbs quants peptides numSignificant")
 
 def doDiffExp(params, peptQuantRows, outputFile, proteinQuantificationMethod, selectComparison, qvalMethod):    
-  proteinModifier, getEvalFeatures, evalFunctions = getEvalFunctions(outputFile, params)
+  # the posterior distributions are passed to params['posteriorWriter'] as 
+  # soon as a protein is completed, see triqler.getPosteriors
+  if params['returnPosteriors']:
+    params['posteriorWriter'] = PosteriorWriter(params)
   
-  proteinOutputRows = proteinQuantificationMethod(peptQuantRows, params, proteinModifier, getEvalFeatures)
+  proteinOutputRows, comparisons = getDiffExpResults(params, peptQuantRows, proteinQuantificationMethod, selectComparison, qvalMethod)
   
-  if len(params['proteinPosteriorsOutput']) > 0:
-    printProteinPosteriors(proteinOutputRows, params)
-    
-  if len(params['groupPosteriorsOutput']) > 0:
-    printGroupPosteriors(proteinOutputRows, params)
-  
-  if len(params['foldChangePosteriorsOutput']) > 0:
-    printFoldChangePosteriors(proteinOutputRows, params)
+  if params['returnPosteriors']:
+    with perf_report.stage(params, "output_writing") as stage:
+      numOutputFiles = params.pop('posteriorWriter').finish(proteinOutputRows)
+      perf_report.addItems(stage, numOutputFiles * len(proteinOutputRows))
   
   numGroups = len(params['groups'])
-  for groupId1, groupId2 in itertools.combinations(range(numGroups), 2):
+  for (groupId1, groupId2), proteinComparison in comparisons:
     if numGroups == 2:
       proteinOutputFile = outputFile
     else:
       proteinOutputFile = getOutputFile(outputFile, groupId1, groupId2)
     
-    print("Comparing", params['groupLabels'][groupId1], "to", params['groupLabels'][groupId2])
+    print("Writing comparison of", params['groupLabels'][groupId1], "to", params['groupLabels'][groupId2])
     print("  output file:", proteinOutputFile)
+    with perf_report.stage(params, "output_writing") as stage:
+      writeProteinComparison(proteinComparison, proteinOutputFile)
+      perf_report.addItems(stage, len(proteinComparison.proteins))
+
+# returns the protein output rows and a list of ((groupId1, groupId2), 
+# ProteinComparison) tuples for all pairs of treatment groups
+def getDiffExpResults(params, peptQuantRows, proteinQuantificationMethod, selectComparison, qvalMethod):
+  proteinModifier, getEvalFeatures, evalFunctions = getEvalFunctions(None, params)
+  
+  proteinOutputRows = proteinQuantificationMethod(peptQuantRows, params, proteinModifier, getEvalFeatures)
+  
+  comparisons = list()
+  numGroups = len(params['groups'])
+  for groupId1, groupId2 in itertools.combinations(range(numGroups), 2):
+    print("Comparing", params['groupLabels'][groupId1], "to", params['groupLabels'][groupId2])
     
-    proteinOutputRowsGroup = selectComparison(proteinOutputRows, (groupId1, groupId2))
-    if "trueConcentrationsDict" in params and len(params["trueConcentrationsDict"]) > 0:
-      evalFunctions = [lambda protein, evalFeatures : evalTruePositiveTtest(params["trueConcentrationsDict"], protein, groupId1, groupId2, evalFeatures[-2], params)]
-    
-    printProteinQuantRows(proteinOutputRowsGroup, qvalMethod, evalFunctions, proteinOutputFile, params)
+    with perf_report.stage(params, "comparison_selection") as stage:
+      proteinOutputRowsGroup = selectComparison(proteinOutputRows, (groupId1, groupId2))
+      
+      if "trueConcentrationsDict" in params and len(params["trueConcentrationsDict"]) > 0:
+        evalFunctions = [lambda protein, evalFeatures : evalTruePositiveTtest(params["trueConcentrationsDict"], protein, groupId1, groupId2, evalFeatures[-2], params)]
+      
+      comparisons.append(((groupId1, groupId2), getProteinComparison(proteinOutputRowsGroup, qvalMethod, evalFunctions, params)))
+      perf_report.addItems(stage, len(proteinOutputRowsGroup))
+  
+  return proteinOutputRows, comparisons
 
 def getOutputFileExtension(outputFile):
   fileName = outputFile.split("/")[-1]
@@ -122,21 +153,22 @@ def getFc(quants, params, groupId1, groupId2):
   return np.log2(np.mean([quants[x] for x in params['groups'][groupId1]]) / np.mean([quants[x] for x in params['groups'][groupId2]]))
   
 def printProteinQuantRows(proteinOutputRows, qvalMethod, evalFunctions, outputFile, params, qvalThreshold = 0.05):
-  writer = parsers.getTsvWriter(outputFile)
-  
+  writeProteinComparison(getProteinComparison(proteinOutputRows, qvalMethod, evalFunctions, params, qvalThreshold), outputFile)
+
+def getProteinComparison(proteinOutputRows, qvalMethod, evalFunctions, params, qvalThreshold = 0.05):
   evalHeaders = ["log2_fold_change", "diff_exp_prob_" + str(params['foldChangeEval'])]
   if 'pvalues' in qvalMethod:
     evalHeaders[1] = "diff_exp_pval_" + str(params['foldChangeEval'])
     targetPvalues = [x[4] for x in proteinOutputRows]
-    reportedQvalsPval, reportedPEPsPval = qvality.getQvaluesFromPvalues(targetPvalues, includePEPs = True)
+    reportedQvalsPval, reportedPEPsPval = qvality.getQvaluesFromPvalues(targetPvalues, includePEPs = True, rng = params.get('rng'))
   
   protOutputHeaders = ["posterior_error_prob", "protein", "num_peptides", "protein_id_posterior_error_prob"] + evalHeaders + parsers.getRunIds(params) + ["peptides"]
   checkCalibration = len(evalFunctions) > 0
   if checkCalibration:
     evalTruePositives = evalFunctions[0]
-    writer.writerow(["observed_q_value", "reported_q_value"] + protOutputHeaders)
+    headers = ["observed_q_value", "reported_q_value"] + protOutputHeaders
   else:
-    writer.writerow(["q_value"] + protOutputHeaders)
+    headers = ["q_value"] + protOutputHeaders
   
   outRows = list()
   observedQvals, reportedQvals, reportedPEPs = list(), list(), list()
@@ -179,52 +211,100 @@ def printProteinQuantRows(proteinOutputRows, qvalMethod, evalFunctions, outputFi
     if 'pvalues' in qvalMethod:
       combinedPEP = reportedPEPsPval[i]
     
-    outRows.append(["%.4g" % combinedPEP, protein, numPeptides, "%.4g" % proteinIdPEP] + ["%.4g" % x for x in evalFeatures] + ["%.4g" % x for x in quants] + [x.peptide for x in quantRows])
+    outRows.append((combinedPEP, protein, numPeptides, proteinIdPEP, evalFeatures[-2], evalFeatures[-1], quants, [x.peptide for x in quantRows]))
   
   if checkCalibration:
-    observedQvals = qvality.fdrsToQvals(observedQvals)
-    for outRow, observedQval, reportedQval in zip(outRows, observedQvals, reportedQvals):
-      writer.writerow(["%.4g" % (observedQval), "%.4g" % (reportedQval)] + outRow)
+    observedQvals = np.array(qvality.fdrsToQvals(observedQvals))
   else:
-    for outRow, reportedQval in zip(outRows, reportedQvals):
-      writer.writerow(["%.4g" % (reportedQval)] + outRow)
+    observedQvals = None
   
   print("  Found", numSignificant, "target proteins as differentially abundant at", str(int(qvalThreshold * 100)) + "% FDR")
+  
+  posteriorErrorProbs, proteins, numPeptides, proteinIdPEPs, log2FoldChanges, diffExpProbs, quants, peptides = [list(x) for x in zip(*outRows)] if len(outRows) > 0 else [list() for _ in range(8)]
+  return ProteinComparison(headers, np.array(reportedQvals), observedQvals, np.array(posteriorErrorProbs), proteins, np.array(numPeptides, dtype = int), np.array(proteinIdPEPs), np.array(log2FoldChanges), np.array(diffExpProbs), np.array(quants), peptides, numSignificant)
 
-def printProteinPosteriors(proteinOutputRows, params):
-  print("Writing protein posteriors to", params['proteinPosteriorsOutput'])
-  writer = parsers.getTsvWriter(params['proteinPosteriorsOutput'])
+def writeProteinComparison(proteinComparison, outputFile):
+  writer = parsers.getTsvWriter(outputFile)
+  writer.writerow(proteinComparison.headers)
   
-  writer.writerow(["protein", "group:run"] + ['%.4g' % x for x in params['proteinQuantCandidates']])
-  for i, (_, protein, _, _, _, _, _, posteriorDists) in enumerate(proteinOutputRows):
-    if posteriorDists:
-      pProteinQuantsList, _, _ = posteriorDists
-      for run, posterior in zip(parsers.getRunIds(params), pProteinQuantsList):
-        writer.writerow([protein, run] + ['%.4g' % p for p in posterior])
-    
-def printGroupPosteriors(proteinOutputRows, params):
-  print("Writing treatment group posteriors to", params['groupPosteriorsOutput'])
-  writer = parsers.getTsvWriter(params['groupPosteriorsOutput'])
-  
-  writer.writerow(["protein", "group"] + ['%.4g' % x for x in params['proteinQuantCandidates']])
-  for i, (_, protein, _, _, _, _, _, posteriorDists) in enumerate(proteinOutputRows):
-    if posteriorDists:
-      _, pProteinGroupQuants, _ = posteriorDists
-
-      numGroups = len(params['groups'])
-      for groupId, posterior in zip(range(numGroups), pProteinGroupQuants):
-        writer.writerow([protein, params['groupLabels'][groupId]] + ['%.4g' % p for p in posterior])
-
-def printFoldChangePosteriors(proteinOutputRows, params):
-  print("Writing fold change posteriors to", params['foldChangePosteriorsOutput'])
-  writer = parsers.getTsvWriter(params['foldChangePosteriorsOutput'])
-  
-  writer.writerow(["protein", "comparison"] + ['%.4g' % x for x in params['proteinDiffCandidates']])
-  for i, (_, protein, _, _, _, _, _, posteriorDists) in enumerate(proteinOutputRows):
-    if posteriorDists:
-      _, _, pProteinGroupDiffs = posteriorDists
-      numGroups = len(params['groups'])
-      if numGroups >= 2:
-        for groupId1, groupId2 in itertools.combinations(range(numGroups), 2):
-          writer.writerow([protein, params['groupLabels'][groupId1] + "_vs_" + params['groupLabels'][groupId2]] + ['%.4g' % p for p in pProteinGroupDiffs[(groupId1, groupId2)]])
+  qvalColumns = [proteinComparison.qValues] if proteinComparison.observedQValues is None else [proteinComparison.observedQValues, proteinComparison.qValues]
+  for row in zip(*(qvalColumns + [proteinComparison.posteriorErrorProbs, proteinComparison.proteins, proteinComparison.numPeptides, proteinComparison.proteinIdPEPs, proteinComparison.log2FoldChanges, proteinComparison.diffExpProbs, proteinComparison.quants, proteinComparison.peptides])):
+    qvals, (combinedPEP, protein, numPeptides, proteinIdPEP, log2FoldChange, diffExpProb, quants, peptides) = row[:-8], row[-8:]
+    writer.writerow(["%.4g" % x for x in qvals] + ["%.4g" % combinedPEP, protein, numPeptides, "%.4g" % proteinIdPEP, "%.4g" % log2FoldChange, "%.4g" % diffExpProb] + ["%.4g" % x for x in quants] + peptides)
 
+def getProteinPosteriorsHeaders(params):
+  return ["protein", "group:run"] + ['%.4g' % x for x in params['proteinQuantCandidates']]
+
+def getProteinPosteriorsRows(protein, posteriorDists, params):
+  pProteinQuantsList, _, _ = posteriorDists
+  return [[protein, run] + ['%.4g' % p for p in posterior] for run, posterior in zip(parsers.getRunIds(params), pProteinQuantsList)]
+
+def getGroupPosteriorsHeaders(params):
+  return ["protein", "group"] + ['%.4g' % x for x in params['proteinQuantCandidates']]
+
+def getGroupPosteriorsRows(protein, posteriorDists, params):
+  _, pProteinGroupQuants, _ = posteriorDists
+  numGroups = len(params['groups'])
+  return [[protein, params['groupLabels'][groupId]] + ['%.4g' % p for p in posterior] for groupId, posterior in zip(range(numGroups), pProteinGroupQuants)]
+
+def getFoldChangePosteriorsHeaders(params):
+  return ["protein", "comparison"] + ['%.4g' % x for x in params['proteinDiffCandidates']]
+
+def getFoldChangePosteriorsRows(protein, posteriorDists, params):
+  _, _, pProteinGroupDiffs = posteriorDists
+  numGroups = len(params['groups'])
+  return [[protein, params['groupLabels'][groupId1] + "_vs_" + params['groupLabels'][groupId2]] + ['%.4g' % p for p in pProteinGroupDiffs[(groupId1, groupId2)]] for groupId1, groupId2 in itertools.combinations(range(numGroups), 2)]
+
+# writes the rows of the --write_*_posteriors files while the posteriors are
+# calculated, so that the posterior distributions do not have to be kept in
+# memory. The rows of each protein are appended to a temporary file next to
+# the output file and are copied to the output file in the order of the 
+# protein output rows by finish
+class PosteriorWriter:
+  def __init__(self, params):
+    self.params = params
+    self.outputs = list()
+    for outputFile, description, getHeaders, getRows in [
+        (params['proteinPosteriorsOutput'], "protein posteriors", getProteinPosteriorsHeaders, getProteinPosteriorsRows),
+        (params['groupPosteriorsOutput'], "treatment group posteriors", getGroupPosteriorsHeaders, getGroupPosteriorsRows),
+        (params['foldChangePosteriorsOutput'], "fold change posteriors", getFoldChangePosteriorsHeaders, getFoldChangePosteriorsRows)]:
+      if len(outputFile) > 0:
+        spoolFile = tempfile.TemporaryFile(dir = os.path.dirname(os.path.abspath(outputFile)))
+        self.outputs.append((outputFile, description, getHeaders, getRows, spoolFile, dict()))
+    
+    self.buffer = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    self.bufferWriter = csv.writer(self.buffer, delimiter = '\t')
+  
+  # writes the posterior distributions of a protein and returns its posteriors
+  # without them
+  def addPosteriors(self, protein, posteriors):
+    bayesQuantRow, muGroupDiffs, probsBelowFoldChange, posteriorDists = posteriors
+    if posteriorDists is not None:
+      for _, _, _, getRows, spoolFile, offsets in self.outputs:
+        data = self.formatRows(getRows(protein, posteriorDists, self.params))
+        offsets[protein] = (spoolFile.tell(), len(data))
+        spoolFile.write(data)
+    return bayesQuantRow, muGroupDiffs, probsBelowFoldChange, None
+  
+  def formatRows(self, rows):
+    self.buffer.seek(0)
+    self.buffer.truncate()
+    self.bufferWriter.writerows(rows)
+    data = self.buffer.getvalue()
+    return data.encode("utf-8") if sys.version_info[0] >= 3 else data
+  
+  # returns the number of output files
+  def finish(self, proteinOutputRows):
+    for outputFile, description, getHeaders, _, spoolFile, offsets in self.outputs:
+      print("Writing %s to %s" % (description, outputFile))
+      with parsers.openTsvFile(outputFile) as f:
+        csv.writer(f, delimiter = '\t').writerow(getHeaders(self.params))
+        for row in proteinOutputRows:
+          protein = row[1]
+          if protein in offsets:
+            offset, length = offsets[protein]
+            spoolFile.seek(offset)
+            data = spoolFile.read(length)
+            f.write(data.decode("utf-8") if sys.version_info[0] >= 3 else data)
+      spoolFile.close()
+    return len(self.outputs)
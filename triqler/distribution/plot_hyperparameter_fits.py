@@ -7,8 +7,10 @@ import sys
 import warnings
 
 from ..triqler import __version__, __copyright__
-from .. import hyperparameters
-from .. import parsers
+from ..lazy_import import lazyImport
+
+hyperparameters = lazyImport("..hyperparameters", __package__)
+parsers = lazyImport("..parsers", __package__)
 
 def main():
   print('Triqler.distribution.plot_hyperparameter_fits version %s\n%s' % (__version__, __copyright__))
@@ -8,17 +8,16 @@ import warnings
 import itertools
 import textwrap
 
-import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from scipy.stats import f_oneway, gamma, norm
-from scipy.optimize import curve_fit
-
 from ..triqler import __version__, __copyright__
-from .. import parsers
-from .. import hyperparameters
-from .. import pgm
-from .. import diff_exp
+from ..lazy_import import lazyImport
+
+np = lazyImport("numpy")
+matplotlib = lazyImport("matplotlib")
+plt = lazyImport("matplotlib.pyplot")
+parsers = lazyImport("..parsers", __package__)
+hyperparameters = lazyImport("..hyperparameters", __package__)
+pgm = lazyImport("..pgm", __package__)
+diff_exp = lazyImport("..diff_exp", __package__)
 
 def main():
   print('Triqler.distribution.plot_posteriors version %s\n%s' % (__version__, __copyright__))
@@ -166,6 +165,8 @@ def getNaivePosteriorParams(peptQuantRows, peptidePEPThreshold, params, minQuant
   return naiveRatioMu, naiveRatioSigma, seenPeptides
     
 def plotPosteriorCalibration(peptQuantRows, peptidePEPThreshold, params, protein):
+  from scipy.stats import norm
+  
   minQuant = np.min(np.array([x.quant for x in peptQuantRows]))
   
   trueConcentrations = diff_exp.getTrueConcentrations(params["trueConcentrationsDict"], protein)
@@ -290,6 +291,8 @@ def printQuantRows(quantMatrix, quantRows):
   print("")
   
 def printStats(geoAvgQuantRow, groups):
+  from scipy.stats import f_oneway
+  
   print("\t".join(['%.2f' % x for x in geoAvgQuantRow]))
   
   args = parsers.getQuantGroups(geoAvgQuantRow, groups)
@@ -347,6 +350,9 @@ def plotViolin(pDifference, log2diff, label, color):
   plt.fill_betweenx(log2diff, pDifference, alpha = 0.5, label = label, color = color)
   
 def plotPosteriorProteinGroupsRatios(pProteinGroupQuants, params):
+  from scipy.stats import norm
+  from scipy.optimize import curve_fit
+  
   minProteinRatio, maxProteinRatio = max(params['proteinQuantCandidates']), min(params['proteinQuantCandidates'])
   
   print("Normal distribution fits for posterior distributions of treatment group relative abundances:")
@@ -0,0 +1,9 @@
+#!/usr/bin/python
+
+'''
+Exceptions raised by the Triqler pipeline. The command line interface turns 
+these into an error message and exit code, library users can catch them.
+'''
+
+class TriqlerError(Exception):
+  pass
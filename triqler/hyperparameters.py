@@ -8,59 +8,30 @@ import os
 import itertools
 
 import numpy as np
-from scipy.stats import hypsecant, gamma, norm, binom, t, cauchy
+from scipy.stats import norm, binom, t, cauchy
 from scipy.optimize import curve_fit
 
 from . import parsers
+from . import kernels
 
-def fitPriors(peptQuantRows, params, printImputedVals = False, plot = False):
+def fitPriors(peptQuantRows, params, printImputedVals = False, plot = False, proteinQuantIndex = None):
   params['proteinQuantCandidates'] = np.arange(-5.0, 5.0 + 1e-10, 0.01) # log10 of protein ratio  
   qc = params['proteinQuantCandidates']
   params['proteinDiffCandidates'] = np.linspace(2*qc[0], 2*qc[-1], len(qc)*2-1)
   
-  protQuantRows = parsers.filterAndGroupPeptides(peptQuantRows, lambda x : not x.protein[0].startswith(params['decoyPattern']))
+  # all statistics are computed on the concatenated quant matrices of all 
+  # target proteins, the rows of protein i are in proteinOffsets[i]:proteinOffsets[i+1]
+  if proteinQuantIndex is None:
+    proteinQuantIndex = parsers.getProteinQuantIndex(peptQuantRows)
+  _, proteinOffsets, quantRows, quantMatrix = parsers.getConcatenatedQuantMatrix(proteinQuantIndex, lambda protein : not protein.startswith(params['decoyPattern']))
   
-  imputedVals, imputedDiffs, observedXICValues, protQuants, protDiffs, protStdevsInGroup, protGroupDiffs = list(), list(), list(), list(), list(), list(), list()
-  quantRowsCollection = list()
-  for prot, quantRows in protQuantRows:
-    quantRows, quantMatrix = parsers.getQuantMatrix(quantRows)
-    
-    quantMatrixNormalized = [parsers.geoNormalize(row) for row in quantMatrix]
-    quantRowsCollection.append((quantRows, quantMatrix))
-    geoAvgQuantRow = getProteinQuant(quantMatrixNormalized, quantRows)
-    
-    protQuants.extend([np.log10(x) for x in geoAvgQuantRow if not np.isnan(x)])
-
-    args = parsers.getQuantGroups(geoAvgQuantRow, params["groups"], np.log10)
-    #means = list()
-    for group in args:
-      if np.count_nonzero(~np.isnan(group)) > 1:
-        protDiffs.extend(group - np.mean(group))
-        protStdevsInGroup.append(np.std(group))
-      #if np.count_nonzero(~np.isnan(group)) > 0:
-      #  means.append(np.mean(group))
-    
-    #if np.count_nonzero(~np.isnan(means)) > 1:
-    #  for mean in means:  
-    #    #protGroupDiffs.append(mean - np.mean(means))
-    #    protGroupDiffs.append(mean)
-    
-    quantMatrixFiltered = np.log10(np.array([x for x, y in zip(quantMatrix, quantRows) if y.combinedPEP < 1.0]))  
-    observedXICValues.extend(quantMatrixFiltered[~np.isnan(quantMatrixFiltered)])
-    
-    # counts number of NaNs per run, if there is only 1 non NaN in the column, we cannot use it for estimating the imputedDiffs distribution
-    numNonNaNs = np.count_nonzero(~np.isnan(quantMatrixFiltered), axis = 0)[np.newaxis,:]
-    xImps = imputeValues(quantMatrixFiltered, geoAvgQuantRow, np.log10(geoAvgQuantRow))
-    imputedDiffs.extend((xImps - quantMatrixFiltered)[(~np.isnan(quantMatrixFiltered)) & (np.array(numNonNaNs) > 1)])
-    #imputedVals.extend(xImps[(np.isnan(quantMatrixFiltered)) & (np.array(numNonNaNs) > 1)])
+  if params.get('hyperparameterSample', 0) > 0:
+    proteinIdxs = getStableProteinSample(proteinOffsets, quantRows, quantMatrix, params)
+    proteinOffsets, quantRows, quantMatrix = parsers.getProteinSubsetQuantMatrix(proteinOffsets, quantRows, quantMatrix, proteinIdxs)
   
-  fitLogitNormal(observedXICValues, params, plot)
+  observedXICValues, protQuants, imputedDiffs, protStdevsInGroup, protDiffs = getHyperparameterStatistics(proteinOffsets, quantRows, quantMatrix, params)
   
-  fitDist(protQuants, funcHypsec, "log10(protein ratio)", ["muProtein", "sigmaProtein"], params, plot)
-    
-  fitDist(imputedDiffs, funcHypsec, "log10(imputed xic / observed xic)", ["muFeatureDiff", "sigmaFeatureDiff"], params, plot)
-  
-  fitDist(protStdevsInGroup, funcGamma, "stdev log10(protein diff in group)", ["shapeInGroupStdevs", "scaleInGroupStdevs"], params, plot, x = np.arange(-0.1, 1.0, 0.005))
+  fitHyperparameters(observedXICValues, protQuants, imputedDiffs, protStdevsInGroup, params, plot)
   
   sigmaCandidates = np.arange(0.001, 3.0, 0.001)
   gammaCandidates = funcGamma(sigmaCandidates, params["shapeInGroupStdevs"], params["scaleInGroupStdevs"])
@@ -70,13 +41,137 @@ def fitPriors(peptQuantRows, params, printImputedVals = False, plot = False):
   params['proteinPrior'] = funcLogHypsec(params['proteinQuantCandidates'], params["muProtein"], params["sigmaProtein"])
   if "shapeInGroupStdevs" in params:
     params['inGroupDiffPrior'] = funcHypsec(params['proteinDiffCandidates'], 0, params['sigmaCandidates'][:, np.newaxis])
+    params['inGroupStdevPrior'] = funcGamma(params['sigmaCandidates'], params["shapeInGroupStdevs"], params["scaleInGroupStdevs"])
   else: # if we have technical replicates, we could use a delta function for the group scaling parameter to speed things up
     fitDist(protDiffs, funcHypsec, "log10(protein diff in group)", ["muInGroupDiffs", "sigmaInGroupDiffs"], params, plot)
     params['inGroupDiffPrior'] = funcHypsec(params['proteinDiffCandidates'], params['muInGroupDiffs'], params['sigmaInGroupDiffs'])
   
   #fitDist(protGroupDiffs, funcHypsec, "log10(protein diff between groups)", ["muProteinGroupDiffs", "sigmaProteinGroupDiffs"], params, plot)
   
-def fitLogitNormal(observedValues, params, plot):
+def getHyperparameterStatistics(proteinOffsets, quantRows, quantMatrix, params):
+  rowProteinIdxs = np.repeat(np.arange(len(proteinOffsets) - 1), np.diff(proteinOffsets))
+  
+  quantMatrixNormalized = quantMatrix / np.exp(np.nanmean(np.log(quantMatrix), axis = 1))[:, np.newaxis]
+  geoAvgQuantRows = getProteinQuants(quantMatrixNormalized, quantRows, proteinOffsets)
+  logGeoAvgQuantRows = np.log10(geoAvgQuantRows)
+  
+  protQuants = logGeoAvgQuantRows[~np.isnan(logGeoAvgQuantRows)]
+  
+  # in-group deviations and standard deviations, ordered by protein and then group
+  protDiffs, protStdevsInGroup = list(), list()
+  for group in params["groups"]:
+    groupQuants = logGeoAvgQuantRows[:, group]
+    hasMultipleQuants = np.count_nonzero(~np.isnan(groupQuants), axis = 1) > 1
+    
+    groupDiffs = groupQuants - np.nanmean(groupQuants, axis = 1)[:, np.newaxis]
+    groupDiffs[~hasMultipleQuants, :] = np.nan
+    protDiffs.append(groupDiffs)
+    
+    groupStdevs = np.nanstd(groupQuants, axis = 1)
+    groupStdevs[~hasMultipleQuants] = np.nan
+    protStdevsInGroup.append(groupStdevs)
+  protDiffs = np.hstack(protDiffs)
+  protDiffs = protDiffs[~np.isnan(protDiffs)]
+  protStdevsInGroup = np.vstack(protStdevsInGroup).T
+  protStdevsInGroup = protStdevsInGroup[~np.isnan(protStdevsInGroup)]
+  
+  # getProteinQuantIndex only retains rows with combinedPEP < 1.0
+  quantMatrixLog = np.log10(quantMatrix)
+  observedXICValues = quantMatrixLog[~np.isnan(quantMatrixLog)]
+  
+  # counts number of NaNs per run, if there is only 1 non NaN in the column, we cannot use it for estimating the imputedDiffs distribution
+  numNonNaNs = parsers.sumPerProtein((~np.isnan(quantMatrixLog)).astype(int), proteinOffsets)[rowProteinIdxs]
+  xImps = imputeValues(quantMatrixLog, geoAvgQuantRows[rowProteinIdxs], logGeoAvgQuantRows[rowProteinIdxs])
+  imputedDiffs = (xImps - quantMatrixLog)[(~np.isnan(quantMatrixLog)) & (numNonNaNs > 1)]
+  
+  return observedXICValues, protQuants, imputedDiffs, protStdevsInGroup, protDiffs
+
+def fitHyperparameters(observedXICValues, protQuants, imputedDiffs, protStdevsInGroup, params, plot = False, verbose = True):
+  fitLogitNormal(observedXICValues, params, plot, verbose)
+  
+  fitDist(protQuants, funcHypsec, "log10(protein ratio)", ["muProtein", "sigmaProtein"], params, plot, verbose = verbose)
+    
+  fitDist(imputedDiffs, funcHypsec, "log10(imputed xic / observed xic)", ["muFeatureDiff", "sigmaFeatureDiff"], params, plot, verbose = verbose)
+  
+  fitDist(protStdevsInGroup, funcGamma, "stdev log10(protein diff in group)", ["shapeInGroupStdevs", "scaleInGroupStdevs"], params, plot, x = np.arange(-0.1, 1.0, 0.005), verbose = verbose)
+
+###############################################
+## Subsampled hyperparameter estimation      ##
+###############################################
+
+# location parameters are compared relative to their scale parameter, 
+# all other parameters relative to their own magnitude
+hyperparameterScales = [("muDetect", "sigmaDetect"), ("sigmaDetect", "sigmaDetect"), 
+                        ("muXIC", "sigmaXIC"), ("sigmaXIC", "sigmaXIC"), 
+                        ("muProtein", "sigmaProtein"), ("sigmaProtein", "sigmaProtein"), 
+                        ("muFeatureDiff", "sigmaFeatureDiff"), ("sigmaFeatureDiff", "sigmaFeatureDiff"), 
+                        ("shapeInGroupStdevs", "shapeInGroupStdevs"), ("scaleInGroupStdevs", "scaleInGroupStdevs")]
+
+# grows a stratified random sample of proteins until the hyperparameters
+# fitted on disjoint samples agree within params['hyperparameterTolerance'],
+# returns the indices of the proteins in the union of the disjoint samples
+def getStableProteinSample(proteinOffsets, quantRows, quantMatrix, params, numDisjointSamples = 3, seed = 1):
+  numProteins = len(proteinOffsets) - 1
+  numPeptides = np.diff(proteinOffsets)
+  rng = np.random.RandomState(seed)
+  
+  sampleSize = params['hyperparameterSample']
+  while sampleSize * numDisjointSamples < numProteins:
+    samples = getStratifiedProteinSamples(numPeptides, sampleSize, numDisjointSamples, rng)
+    
+    sampleFits = list()
+    for proteinIdxs in samples:
+      sampleParams = { 'groups' : params['groups'] }
+      try:
+        sampleStatistics = getHyperparameterStatistics(*parsers.getProteinSubsetQuantMatrix(proteinOffsets, quantRows, quantMatrix, proteinIdxs), params = sampleParams)
+        fitHyperparameters(*sampleStatistics[:4], params = sampleParams, verbose = False)
+      except (RuntimeError, ValueError, TypeError):
+        sampleParams = dict() # fit failed, e.g. too few proteins
+      sampleFits.append(sampleParams)
+    
+    deviations = getHyperparameterDeviations(sampleFits)
+    maxDeviation = max(deviations.values())
+    print("  Hyperparameter stability with %d disjoint samples of %d proteins: max relative deviation = %.4f" % (numDisjointSamples, sampleSize, maxDeviation))
+    for varName, _ in hyperparameterScales:
+      print("    %s: %.4f" % (varName, deviations[varName]))
+    
+    if maxDeviation < params['hyperparameterTolerance']:
+      sampleProteinIdxs = np.sort(np.concatenate(samples))
+      print("  Estimating hyperparameters on a sample of %d out of %d proteins" % (len(sampleProteinIdxs), numProteins))
+      return sampleProteinIdxs
+    sampleSize *= 2
+  
+  print("  Hyperparameters did not stabilize on a subsample, estimating hyperparameters on all %d proteins" % (numProteins))
+  return np.arange(numProteins)
+
+# proteins are stratified by their number of peptides, which is heavy-tailed,
+# each stratum contributes proportionally to each of the disjoint samples
+def getStratifiedProteinSamples(numPeptides, sampleSize, numDisjointSamples, rng):
+  strata = np.floor(np.log2(numPeptides)).astype(int)
+  samples = [list() for _ in range(numDisjointSamples)]
+  for stratum in np.unique(strata):
+    stratumProteinIdxs = rng.permutation(np.nonzero(strata == stratum)[0])
+    stratumSampleSize = int(np.round(float(sampleSize) * len(stratumProteinIdxs) / len(numPeptides)))
+    stratumSampleSize = min([max([stratumSampleSize, 1]), len(stratumProteinIdxs) // numDisjointSamples])
+    for i in range(numDisjointSamples):
+      samples[i].extend(stratumProteinIdxs[i*stratumSampleSize:(i+1)*stratumSampleSize])
+  return [np.array(sorted(sample), dtype = int) for sample in samples]
+
+# returns the standard deviation of each hyperparameter over the disjoint 
+# samples relative to its scale
+def getHyperparameterDeviations(sampleFits):
+  deviations = dict()
+  for varName, scaleName in hyperparameterScales:
+    if not all(varName in sampleParams for sampleParams in sampleFits):
+      deviations[varName] = np.inf
+      continue
+    
+    vals = np.array([sampleParams[varName] for sampleParams in sampleFits])
+    scale = np.abs(np.mean([sampleParams[scaleName] for sampleParams in sampleFits]))
+    deviations[varName] = np.std(vals) / scale if scale > 0 else np.inf
+  return deviations
+
+def fitLogitNormal(observedValues, params, plot, verbose = True):
   m = np.mean(observedValues)
   s = np.std(observedValues)
   minBin, maxBin = m - 4*s, m + 4*s
@@ -87,21 +182,25 @@ def fitLogitNormal(observedValues, params, plot):
   
   resetXICHyperparameters = False
   if popt[0] < popt[2] - 5*popt[3] or popt[0] > popt[2] + 5*popt[3]:
-    print("  Warning: muDetect outside of expected region [", popt[2] - 5*popt[3] , ",", popt[2] + 5*popt[3], "]:", popt[0], ".")
+    if verbose:
+      print("  Warning: muDetect outside of expected region [", popt[2] - 5*popt[3] , ",", popt[2] + 5*popt[3], "]:", popt[0], ".")
     resetXICHyperparameters = True
   
   if popt[1] < 0.1 or popt[1] > 2.0:
-    print("  Warning: sigmaDetect outside of expected region [0.1,2.0]:" , popt[1], ".")
+    if verbose:
+      print("  Warning: sigmaDetect outside of expected region [0.1,2.0]:" , popt[1], ".")
     resetXICHyperparameters = True
   
   if resetXICHyperparameters:
-    print("    Resetting mu/sigmaDetect hyperparameters to default values of muDetect = muXIC - 1.0 and sigmaDetect = 0.3")
+    if verbose:
+      print("    Resetting mu/sigmaDetect hyperparameters to default values of muDetect = muXIC - 1.0 and sigmaDetect = 0.3")
     popt[1] = 0.3
     popt[0] = popt[2] - 1.0
   
   #print("  params[\"muDetectInit\"], params[\"sigmaDetectInit\"] = %f, %f" % (popt[0], popt[1]))
-  print("  params[\"muDetect\"], params[\"sigmaDetect\"] = %f, %f" % (popt[0], popt[1]))
-  print("  params[\"muXIC\"], params[\"sigmaXIC\"] = %f, %f" % (popt[2], popt[3]))
+  if verbose:
+    print("  params[\"muDetect\"], params[\"sigmaDetect\"] = %f, %f" % (popt[0], popt[1]))
+    print("  params[\"muXIC\"], params[\"sigmaXIC\"] = %f, %f" % (popt[2], popt[3]))
   #params["muDetectInit"], params["sigmaDetectInit"] = popt[0], popt[1]
   #popt[0], popt[1] = popt[2] - popt[3]*3, popt[3]*1.5
   params["muDetect"], params["sigmaDetect"] = popt[0], popt[1]
@@ -122,7 +221,7 @@ def fitLogitNormal(observedValues, params, plot):
     plt.legend()
     plt.tight_layout()
     
-def fitDist(ys, func, xlabel, varNames, params, plot, x = np.arange(-2,2,0.01)):
+def fitDist(ys, func, xlabel, varNames, params, plot, x = np.arange(-2,2,0.01), verbose = True):
   vals, bins = np.histogram(ys, bins = x, normed = True)
   bins = bins[:-1]
   popt, _ = curve_fit(func, bins, vals)
@@ -138,7 +237,8 @@ def fitDist(ys, func, xlabel, varNames, params, plot, x = np.arange(-2,2,0.01)):
     fitLabel = "gamma fit"
   else:
     fitLabel = "distribution fit"
-  print("  " + outputString % tuple(varNames + list(popt)))
+  if verbose:
+    print("  " + outputString % tuple(varNames + list(popt)))
   if plot:    
     import matplotlib.pyplot as plt
     plt.figure()
@@ -193,6 +293,19 @@ def getProteinQuant(quantMatrixNormalized, quantRows):
   geoAvgQuantRow = parsers.geoNormalize(geoAvgQuantRow)
   return geoAvgQuantRow
   
+# vectorized version of getProteinQuant over the proteins of a concatenated
+# quant matrix, returns a proteins x runs matrix
+def getProteinQuants(quantMatrixNormalized, quantRows, proteinOffsets):
+  weights = np.tile(np.array([1.0 - y.combinedPEP for y in quantRows])[:, np.newaxis], (1, quantMatrixNormalized.shape[1]))
+  weights[np.isnan(quantMatrixNormalized)] = np.nan
+  
+  weightSums = parsers.sumPerProtein(np.nan_to_num(weights), proteinOffsets)
+  weightSums[weightSums == 0] = np.nan
+  logQuantSums = parsers.sumPerProtein(np.nan_to_num(np.multiply(np.log(quantMatrixNormalized), weights)), proteinOffsets)
+  geoAvgQuantRows = np.exp(logQuantSums / weightSums)
+  geoAvgQuantRows /= np.exp(np.nanmean(np.log(geoAvgQuantRows), axis = 1))[:, np.newaxis]
+  return geoAvgQuantRows
+  
 def imputeValues(quantMatrixLog, proteinRatios, testProteinRatios):
   logIonizationEfficiencies = quantMatrixLog - np.log10(proteinRatios)
   
@@ -210,18 +323,18 @@ def funcNorm(x, mu, sigma):
   return norm.pdf(x, mu, sigma)
   
 def funcHypsec(x, mu, sigma):
-  return hypsecant.pdf(x, mu, sigma)
+  return kernels.hypsecPdf(x, mu, sigma)
   #return cauchy.pdf(x, mu, sigma)
   #return norm.pdf(x, mu, sigma)
 
 def funcLogHypsec(x, mu, sigma):
-  return hypsecant.logpdf(x, mu, sigma)
+  return kernels.hypsecLogPdf(x, mu, sigma)
   #return cauchy.logpdf(x, mu, sigma)
   #return norm.logpdf(x, mu, sigma)
   
 def funcGamma(x, shape, sigma):
-  return gamma.pdf(x, shape, 0.0, sigma)
+  return kernels.gammaPdf(x, shape, sigma)
   
 def logit(x, muLogit, sigmaLogit):
-  return 0.5 + 0.5 * np.tanh((np.array(x) - muLogit) / sigmaLogit)
+  return kernels.logit(x, muLogit, sigmaLogit)
 
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+'''
+Approximate posterior engine, selected with --engine laplace. The run-level
+posteriors are calculated on the grid as in pgm.getPosteriors, after which
+each of them is replaced by a normal distribution around its mode with the
+curvature of the log posterior at the mode. The hyperbolic secant in-group 
+deviation prior is a scale mixture of normal distributions, so that the 
+convolutions of the run-level posteriors with the prior, which dominate the
+time of the grid engine, become sums of normal densities that are evaluated
+on the grid directly. The fold change posteriors are then calculated from the
+treatment group posteriors as in the grid engine.
+
+Proteins with run-level posteriors that are not well approximated by a normal
+distribution, e.g. because they are multimodal, skewed, heavy-tailed or 
+truncated at the edge of the grid, are processed with the exact grid engine
+instead.
+'''
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.stats import norm
+from scipy.special import erfc
+
+from . import parsers
+from . import pgm
+
+# returns the same posteriors as pgm.getPosteriors and whether the laplace
+# approximation was used
+def getPosteriors(quantRowsOrig, params, quantMatrix = None):
+  if quantMatrix is None:
+    quantRows, quantMatrix = parsers.getQuantMatrix(quantRowsOrig)
+  else:
+    quantRows = quantRowsOrig
+  
+  pProteinQuantsList, bayesQuantRow = pgm.getPosteriorProteinRatios(quantMatrix, quantRows, params)
+  return getPosteriorsFromProteinRatios(pProteinQuantsList, bayesQuantRow, params)
+
+def getPosteriorsFromProteinRatios(pProteinQuantsList, bayesQuantRow, params):
+  runApproximations = getRunApproximations(pProteinQuantsList, params)
+  if runApproximations is None:
+    return pgm.getPosteriorsFromProteinRatios(pProteinQuantsList, bayesQuantRow, params), False
+  else:
+    return getPosteriorsFromApproximations(pProteinQuantsList, bayesQuantRow, runApproximations, params), True
+
+# returns the means and variances of the normal approximations of the
+# run-level posteriors, or None if any of them is multimodal, has a skewness 
+# larger than params['laplaceMaxSkewness'] in absolute value or differs by 
+# more than params['laplaceMaxRunDeviation'] in total variation distance from
+# its normal approximation
+def getRunApproximations(pProteinQuantsList, params):
+  qc = params['proteinQuantCandidates']
+  means, variances = list(), list()
+  for pProteinQuants in pProteinQuantsList:
+    if isMultimodal(pProteinQuants) or abs(getSkewness(qc, pProteinQuants)) > params.get('laplaceMaxSkewness', 0.5):
+      return None
+    
+    approximation = getLaplaceApproximation(qc, pProteinQuants)
+    if approximation is None:
+      return None
+    
+    mean, variance = approximation
+    if getTotalVariationDistance(getDiscretizedNormal(qc, mean, variance), pProteinQuants) > params.get('laplaceMaxRunDeviation', 0.05):
+      return None
+    
+    means.append(mean)
+    variances.append(variance)
+  return np.array(means), np.array(variances)
+
+# local maxima with less than minRelativeHeight of the global maximum are ignored
+def isMultimodal(pProteinQuants, minRelativeHeight = 0.01):
+  isPeak = np.r_[True, pProteinQuants[1:] > pProteinQuants[:-1]] & np.r_[pProteinQuants[:-1] >= pProteinQuants[1:], True]
+  return np.count_nonzero(isPeak & (pProteinQuants > minRelativeHeight * np.max(pProteinQuants))) > 1
+
+def getSkewness(candidates, pProteinQuants):
+  mean = np.sum(candidates * pProteinQuants)
+  variance = np.sum(pProteinQuants * (candidates - mean)**2)
+  return np.sum(pProteinQuants * (candidates - mean)**3) / variance**1.5
+
+# fits a parabola to the log posterior in the contiguous region around the
+# mode that lies within maxLogDrop of the maximum, i.e. about 1.4 standard
+# deviations for a normal distribution, so that the curvature is not affected
+# by the heavy tails of the run-level posteriors
+def getLaplaceApproximation(candidates, pProteinQuants, maxLogDrop = 1.0):
+  logP = np.log(pProteinQuants + np.nextafter(0, 1))
+  modeIdx = np.argmax(logP)
+  if modeIdx == 0 or modeIdx == len(logP) - 1:
+    return None
+  
+  outside = np.nonzero(logP < logP[modeIdx] - maxLogDrop)[0]
+  lowerIdx = max([x + 1 for x in outside[outside < modeIdx]] + [0])
+  upperIdx = min([x - 1 for x in outside[outside > modeIdx]] + [len(logP) - 1])
+  lowerIdx, upperIdx = min([lowerIdx, modeIdx - 1]), max([upperIdx, modeIdx + 1])
+  
+  a, b, _ = np.polyfit(candidates[lowerIdx:upperIdx+1] - candidates[modeIdx], logP[lowerIdx:upperIdx+1], 2)
+  if not a < 0.0:
+    return None
+  
+  return candidates[modeIdx] - b / (2*a), -1.0 / (2*a)
+
+def getTotalVariationDistance(p1, p2):
+  return 0.5 * np.sum(np.abs(p1 - p2))
+
+def getPosteriorsFromApproximations(pProteinQuantsList, bayesQuantRow, runApproximations, params):
+  means, variances = runApproximations
+  pProteinGroupQuants = [getPosteriorProteinGroupRatio(means[group], variances[group], params) for group in params['groups']]
+  return pgm.getPosteriorsFromGroupRatios(pProteinQuantsList, pProteinGroupQuants, bayesQuantRow, params)
+
+# same as pgm.getPosteriorProteinGroupRatio for normal run-level posteriors.
+# The convolution of a normal run-level posterior with a hyperbolic secant
+# prior with scale sigma is a mixture of normal distributions with variances 
+# runVariance + sigma^2 * mixtureVariances, see getHypsecScaleMixture
+def getPosteriorProteinGroupRatio(runMeans, runVariances, params):
+  if "shapeInGroupStdevs" in params:
+    sigmas = params['sigmaCandidates']
+    pSigmas = params['inGroupStdevPrior']
+    diffMean = 0.0
+  else:
+    sigmas = np.array([params['sigmaInGroupDiffs']])
+    pSigmas = np.ones(1)
+    diffMean = params['muInGroupDiffs']
+  
+  # the grid engine convolves with the prior density at the difference 
+  # candidates, which sums to more than one for priors narrower than the grid
+  # spacing, e.g. for the smallest in-group standard deviation candidates
+  dc = params['proteinDiffCandidates']
+  logPriorMasses = np.log(np.sum(np.atleast_2d(params['inGroupDiffPrior']), axis = 1) * (dc[1] - dc[0]))
+  
+  qc = params['proteinQuantCandidates']
+  mixtureVariances, mixtureWeights = getHypsecScaleMixture()
+  logPMus = np.zeros((len(sigmas), len(qc)))
+  for runMean, runVariance in zip(runMeans + diffMean, runVariances):
+    totalVariances = runVariance + sigmas[:,np.newaxis]**2 * mixtureVariances
+    densities = np.exp(-0.5 * (qc - runMean)**2 / totalVariances[:,:,np.newaxis]) / np.sqrt(2 * np.pi * totalVariances)[:,:,np.newaxis]
+    with np.errstate(divide = 'ignore'):
+      logPMus += np.log(np.einsum('k,skn->sn', mixtureWeights, densities)) + logPriorMasses[:,np.newaxis]
+  
+  logPMus -= np.max(logPMus)
+  pMus = np.dot(pSigmas, np.exp(logPMus))
+  return pMus / np.sum(pMus)
+
+# discretization of the hyperbolic secant distribution with unit scale, i.e. 
+# with density 1 / (pi cosh(x)), as a mixture of normal distributions with 
+# zero mean, returns the (variances, weights) of the mixture. The variance of
+# the mixture components follows the distribution of the time for a Brownian 
+# motion to leave (-pi/2, pi/2), which is discretized by a Gauss quadrature 
+# rule in the log of the variance. With 10 nodes, the density of the mixture
+# is within 2e-6 of the maximum density of the hyperbolic secant distribution
+_hypsecScaleMixtures = dict()
+
+def getHypsecScaleMixture(numNodes = 10):
+  if numNodes not in _hypsecScaleMixtures:
+    edges = np.geomspace(1e-4, 200.0, 20001)
+    cdf = getExitTimeCdf(edges)
+    cdf[0], cdf[-1] = 0.0, 1.0
+    logVariances, weights = getGaussQuadrature(np.log(np.sqrt(edges[1:] * edges[:-1])), np.diff(cdf), numNodes)
+    _hypsecScaleMixtures[numNodes] = (np.exp(logVariances), weights)
+  return _hypsecScaleMixtures[numNodes]
+
+# cumulative distribution function of the time for a standard Brownian motion
+# to leave (-pi/2, pi/2), using the series that converges fastest for small
+# and large times respectively
+def getExitTimeCdf(t, numTerms = 50):
+  k = np.arange(numTerms)[:,np.newaxis]
+  with np.errstate(divide = 'ignore'):
+    small = 2.0 * np.sum((-1.0)**k * erfc((2*k + 1) * np.pi / 2 / np.sqrt(2.0 * t)), axis = 0)
+  large = 1.0 - 4.0 / np.pi * np.sum((-1.0)**k / (2*k + 1) * np.exp(-(2*k + 1)**2 * t / 2.0), axis = 0)
+  return np.where(t < 1.0, small, large)
+
+# Gauss quadrature rule for the discrete distribution with the given weights
+# at the given points, using the Stieltjes procedure for the recurrence 
+# coefficients of the orthogonal polynomials and the Golub-Welsch algorithm
+def getGaussQuadrature(points, weights, numNodes):
+  alphas, betas = np.zeros(numNodes), np.zeros(numNodes)
+  pPrev, p = np.zeros_like(points), np.ones_like(points)
+  normPrev = 1.0
+  for j in range(numNodes):
+    pNorm = np.sum(weights * p * p)
+    alphas[j] = np.sum(weights * points * p * p) / pNorm
+    betas[j] = pNorm / normPrev
+    pPrev, p, normPrev = p, (points - alphas[j]) * p - (betas[j] if j > 0 else 0.0) * pPrev, pNorm
+  
+  jacobiMatrix = np.diag(alphas) + np.diag(np.sqrt(betas[1:]), 1) + np.diag(np.sqrt(betas[1:]), -1)
+  nodes, eigenvectors = np.linalg.eigh(jacobiMatrix)
+  return nodes, np.sum(weights) * eigenvectors[0]**2
+
+# probability mass of each grid cell, so that narrow distributions are still
+# represented correctly
+def getDiscretizedNormal(candidates, mean, variance):
+  halfStep = (candidates[1] - candidates[0]) / 2
+  pNormal = norm.cdf((candidates + halfStep - mean) / np.sqrt(variance)) - norm.cdf((candidates - halfStep - mean) / np.sqrt(variance))
+  return pNormal / np.sum(pNormal)
+
+# prints how many proteins used the approximation, returns the posteriors in
+# the format of pgm.getPosteriors
+def summarizeEngineResults(engineResults):
+  numApproximated = sum(1 for _, usedLaplace in engineResults if usedLaplace)
+  print("  Laplace approximation used for %d proteins, grid engine used for %d proteins" % (numApproximated, len(engineResults) - numApproximated))
+  return [posteriors for posteriors, _ in engineResults]
+
+def unitTest():
+  from . import hyperparameters
+  from .kernels import hypsecPdf
+  
+  x = np.linspace(-20.0, 20.0, 4001)
+  mixtureVariances, mixtureWeights = getHypsecScaleMixture()
+  pMixture = np.dot(mixtureWeights, np.exp(-0.5 * x**2 / mixtureVariances[:,np.newaxis]) / np.sqrt(2 * np.pi * mixtureVariances[:,np.newaxis]))
+  assert np.max(np.abs(pMixture - hypsecPdf(x, 0.0, 1.0))) < 2e-6 * hypsecPdf(0.0, 0.0, 1.0)
+  assert abs(np.sum(mixtureWeights) - 1.0) < 1e-9 and abs(np.dot(mixtureWeights, mixtureVariances) - (np.pi / 2)**2) < 1e-6
+  
+  # normal run-level posteriors give the same treatment group posteriors as
+  # the convolutions of the grid engine
+  params = dict()
+  params['proteinQuantCandidates'] = np.arange(-5.0, 5.0 + 1e-10, 0.01)
+  qc = params['proteinQuantCandidates']
+  params['proteinDiffCandidates'] = np.linspace(2*qc[0], 2*qc[-1], len(qc)*2-1)
+  params['sigmaCandidates'] = np.linspace(0.001, 0.3, 20)
+  params['shapeInGroupStdevs'], params['scaleInGroupStdevs'] = 2.2, 0.03
+  with np.errstate(over = 'ignore'):
+    params['inGroupDiffPrior'] = hyperparameters.funcHypsec(params['proteinDiffCandidates'], 0, params['sigmaCandidates'][:, np.newaxis])
+  params['inGroupStdevPrior'] = hyperparameters.funcGamma(params['sigmaCandidates'], params["shapeInGroupStdevs"], params["scaleInGroupStdevs"])
+  
+  runMeans, runVariances = np.array([0.1, 0.25, -0.05]), np.array([0.03, 0.05, 0.08])**2
+  pProteinQuantsList = [getDiscretizedNormal(qc, mean, variance) for mean, variance in zip(runMeans, runVariances)]
+  with np.errstate(divide = 'ignore'):
+    pExact = pgm.getPosteriorProteinGroupMuMarginalized(pProteinQuantsList, params)
+  pApprox = getPosteriorProteinGroupRatio(runMeans, runVariances, params)
+  print("max |diff| treatment group posterior: %.2e" % np.max(np.abs(pExact - pApprox)))
+  assert np.max(np.abs(pExact - pApprox)) < 1e-3 * np.max(pExact)
+
+if __name__ == "__main__":
+  unitTest()
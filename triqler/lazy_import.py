@@ -0,0 +1,40 @@
+#!/usr/bin/python
+
+'''
+Deferred module imports for the command line entry points. Importing numpy,
+scipy and matplotlib takes much longer than e.g. printing --help or rejecting
+invalid arguments, so modules that depend on them are only imported on the
+first attribute access of the placeholder returned by lazyImport.
+
+The entry points (triqler.py, the converters in convert/ and the plotting
+scripts in distribution/) import their heavy dependencies this way, so
+that --help and invalid arguments are handled without importing them.
+'''
+
+from __future__ import print_function
+
+import importlib
+
+# name can be relative to package, e.g. lazyImport(".pgm", __package__)
+def lazyImport(name, package = None):
+  return LazyModule(name, package)
+
+class LazyModule(object):
+  def __init__(self, name, package = None):
+    self.__dict__['_lazyName'] = name
+    self.__dict__['_lazyPackage'] = package
+    self.__dict__['_lazyModule'] = None
+  
+  def _load(self):
+    if self._lazyModule is None:
+      self.__dict__['_lazyModule'] = importlib.import_module(self._lazyName, self._lazyPackage)
+    return self._lazyModule
+  
+  def __getattr__(self, attr):
+    return getattr(self._load(), attr)
+  
+  def __setattr__(self, attr, value):
+    setattr(self._load(), attr, value)
+  
+  def __repr__(self):
+    return "<lazily imported module '%s'>" % self._lazyName
@@ -1,54 +1,289 @@
 from __future__ import print_function
 
+import os
 import sys
 import signal
 import warnings
-from multiprocessing import Pool
+import threading
+import multiprocessing
+from collections import namedtuple
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
 
+# statistics of a task returned alongside its output, used for the
+# --perf_report and --metrics_file statistics. The process id is None for
+# tasks evaluated in the main process
+WorkerStats = namedtuple("WorkerStats", "pid peakRSS busyTime counters")
+
+# backends that evaluate the tasks of MyPool, selected with --executor:
+#   process: multiprocessing.Pool, startMethod selects fork, forkserver or 
+#            spawn instead of the platform default
+#   thread:  pool of threads in the main process, which avoids pickling the
+#            task arguments. NumPy releases the GIL in most of the kernels
+#   serial:  evaluates each task immediately in the calling thread, e.g. for
+#            profiling and debugging
+#   futures: concurrent.futures.ProcessPoolExecutor, requires Python 3.7
+executorTypes = ['process', 'thread', 'serial', 'futures']
+
+# if sharedPool is given, its workers are used and they are not terminated by
+# checkPool, which allows multiple datasets to use the same workers, see 
+# batch.py. executor can also be a concurrent.futures.Executor, which is not
+# shut down by checkPool either
 class MyPool:
-  def __init__(self, processes = 1, warningFilter = "default"):
+  def __init__(self, processes = 1, warningFilter = "default", progressMetrics = None, sharedPool = None, executor = "process", startMethod = None):
     self.warningFilter = warningFilter
-    self.pool = Pool(processes, self.initWorker)
+    if sharedPool is not None:
+      self.pool, self.ownsPool, self.executor = sharedPool.pool, False, sharedPool.executor
+    elif not isinstance(executor, str):
+      self.pool, self.ownsPool, self.executor = FuturesExecutor(executor), False, executor
+    else:
+      self.pool, self.ownsPool, self.executor = getExecutor(executor, processes, warningFilter, startMethod), True, executor
+    self.processes = processes
+    self.mainProcessPool = None # threads for applyAsyncInMainProcess, created on first use
     self.results = []
-    
+    self.workerPeakRSS = dict() # peak RSS in MB per worker process id
+    self.workerPeakRSSLock = threading.Lock()
+    self.progressMetrics = progressMetrics
+    if self.progressMetrics is not None:
+      self.progressMetrics.startTasks()
+  
   def applyAsync(self, f, args):
-    r = self.pool.apply_async(f, args)
+    self.addTask()
+    r = self.pool.apply_async(runAndGetWorkerStats, [f, args], callback = self.completeTask)
+    self.results.append(r)
+  
+  # evaluates f(pool, *args) in a thread of the main process, its output is
+  # returned by checkPool in submission order like the other results. f can
+  # distribute its work over the worker processes with runSubtasks, while the
+  # workers continue with the tasks submitted by applyAsync. At most 
+  # `processes` of these tasks run at the same time
+  def applyAsyncInMainProcess(self, f, args):
+    if self.mainProcessPool is None:
+      self.mainProcessPool = ThreadPool(max([self.processes, 1]))
+    self.addTask()
+    r = self.mainProcessPool.apply_async(runAndGetWorkerStats, [f, [self] + list(args)], callback = self.completeTask, error_callback = self.failTask)
     self.results.append(r)
   
-  def initWorker(self):
-    return init_worker(self.warningFilter)
+  # evaluates f for each of the argument lists in argsList in the worker
+  # processes, waits for all of them and returns their outputs
+  def runSubtasks(self, f, argsList):
+    subtaskResults = [self.pool.apply_async(runAndGetWorkerStats, [f, args], callback = self.completeSubtask) for args in argsList]
+    outputs = list()
+    for res in subtaskResults:
+      output, workerStats = res.get()
+      self.updateWorkerPeakRSS(workerStats)
+      outputs.append(output)
+    return outputs
+  
+  def updateWorkerPeakRSS(self, workerStats):
+    if workerStats.pid is None:
+      return
+    with self.workerPeakRSSLock:
+      self.workerPeakRSS[workerStats.pid] = max([self.workerPeakRSS.get(workerStats.pid, 0.0), workerStats.peakRSS])
+  
+  def addTask(self):
+    if self.progressMetrics is not None:
+      self.progressMetrics.addTask()
+  
+  # called by the result handler thread as soon as a task finishes, i.e. not
+  # necessarily in submission order
+  def completeTask(self, result):
+    if self.progressMetrics is not None:
+      self.progressMetrics.completeTask(result[1])
+  
+  # counts a task that raised an exception as completed, the exception itself
+  # is raised by checkPool
+  def failTask(self, error):
+    if self.progressMetrics is not None:
+      self.progressMetrics.completeTask(WorkerStats(None, 0.0, 0.0, dict()))
   
-  def checkPool(self, printProgressEvery = -1):
+  def completeSubtask(self, result):
+    if self.progressMetrics is not None:
+      self.progressMetrics.completeTask(result[1], isSubtask = True)
+  
+  # tasks of a shared pool can be queued behind the tasks of other datasets 
+  # for a long time, so there is no timeout per task. If processOutput is 
+  # given, processOutput(taskIdx, output) is called for each output in 
+  # submission order as soon as it is available and its return value is kept
+  # instead of the output, e.g. to write large outputs to a file
+  def checkPool(self, printProgressEvery = -1, processOutput = None):
     try:
       outputs = list()
-      for res in self.results:
-        outputs.append(res.get(timeout = 1000))
+      for taskIdx, res in enumerate(self.results):
+        output, workerStats = res.get(timeout = 1000 if self.ownsPool else None)
+        self.results[taskIdx] = None # releases the output held by the result
+        if processOutput is not None:
+          output = processOutput(taskIdx, output)
+        outputs.append(output)
+        self.updateWorkerPeakRSS(workerStats)
         if printProgressEvery > 0 and len(outputs) % printProgressEvery == 0:
           print(" ", len(outputs),"/", len(self.results), "%.2f" % (float(len(outputs)) / len(self.results) * 100) + "%")
-      self.pool.close()
-      self.pool.join()
+      if self.ownsPool:
+        self.close()
+      else:
+        self.closeMainProcessPool()
       return outputs
     except (KeyboardInterrupt, SystemExit):
       print("Caught KeyboardInterrupt, terminating workers")
+      if self.mainProcessPool is not None:
+        self.mainProcessPool.terminate()
       self.pool.terminate()
       self.pool.join()
-      sys.exit()
+      raise
+  
+  def close(self):
+    self.closeMainProcessPool()
+    self.pool.close()
+    self.pool.join()
+  
+  def closeMainProcessPool(self):
+    if self.mainProcessPool is not None:
+      self.mainProcessPool.close()
+      self.mainProcessPool.join()
+      self.mainProcessPool = None
+
+# returns an object with the apply_async, close, terminate and join methods of
+# multiprocessing.Pool
+def getExecutor(executor, processes, warningFilter, startMethod = None):
+  context = multiprocessing.get_context(startMethod) if startMethod is not None else None
+  if executor == "process":
+    return (context or multiprocessing).Pool(processes, init_worker, [warningFilter])
+  elif executor == "thread":
+    return ThreadPool(processes)
+  elif executor == "serial":
+    return SerialExecutor()
+  elif executor == "futures":
+    from concurrent.futures import ProcessPoolExecutor
+    return FuturesExecutor(ProcessPoolExecutor(processes, mp_context = context, initializer = init_worker, initargs = [warningFilter]))
+  else:
+    raise ValueError("Unknown executor %s, choose from %s" % (executor, ", ".join(executorTypes)))
+
+class SerialExecutor:
+  def apply_async(self, f, args, callback = None):
+    result = FinishedResult(f(*args))
+    if callback is not None:
+      callback(result.output)
+    return result
+  
+  def close(self):
+    pass
+  
+  def terminate(self):
+    pass
+  
+  def join(self):
+    pass
+
+class FinishedResult:
+  def __init__(self, output):
+    self.output = output
+  
+  def get(self, timeout = None):
+    return self.output
 
+# adapts a concurrent.futures.Executor to the methods of multiprocessing.Pool
+# used by MyPool
+class FuturesExecutor:
+  def __init__(self, executor):
+    self.executor = executor
+  
+  def apply_async(self, f, args, callback = None):
+    future = self.executor.submit(f, *args)
+    if callback is not None:
+      future.add_done_callback(lambda x : callback(x.result()) if not x.cancelled() and x.exception() is None else None)
+    return FutureResult(future)
+  
+  def close(self):
+    pass
+  
+  def terminate(self):
+    if sys.version_info >= (3, 9):
+      self.executor.shutdown(wait = False, cancel_futures = True)
+    else:
+      self.executor.shutdown(wait = False)
+  
+  def join(self):
+    self.executor.shutdown(wait = True)
+
+class FutureResult:
+  def __init__(self, future):
+    self.future = future
+  
+  def get(self, timeout = None):
+    return self.future.result(timeout)
+
+# mimics multiprocessing's AsyncResult for a function evaluated in a thread of
+# the main process
+class ThreadResult:
+  def __init__(self, f, args, callback = None):
+    self.output, self.error = None, None
+    self.callback = callback
+    self.thread = threading.Thread(target = self.run, args = (f, args))
+    self.thread.daemon = True
+    self.thread.start()
+  
+  # the callback is also called if f raises an exception, which is then 
+  # raised by get()
+  def run(self, f, args):
+    start = timer()
+    try:
+      self.output = f(*args)
+    except Exception as e:
+      self.error = e
+    finally:
+      self.workerStats = WorkerStats(None, 0.0, timer() - start, dict())
+      if self.callback is not None:
+        self.callback((self.output, self.workerStats))
+  
+  def get(self, timeout = None):
+    self.thread.join(timeout)
+    if self.thread.is_alive():
+      raise TimeoutError
+    if self.error is not None:
+      raise self.error
+    return self.output, self.workerStats
 
 def init_worker(warningFilter):
+  from .progress_metrics import popCounters
+  
   # set warningFilter for the child processes
   warnings.simplefilter(warningFilter)
   
   # causes child processes to ignore SIGINT signal and lets main process handle
   # interrupts instead (https://noswap.com/blog/python-multiprocessing-keyboardinterrupt)
   signal.signal(signal.SIGINT, signal.SIG_IGN)
+  
+  # discard counters inherited from the main process
+  popCounters()
+
+# also returns the worker's process id, peak RSS, the time spent on the task
+# and the counters incremented during the task. The process id is None for 
+# the thread and serial executors, which run in the main process and add to
+# the counters of their analysis directly
+def runAndGetWorkerStats(f, args):
+  from .perf_report import getPeakRSS
+  from .progress_metrics import popCounters
+  start = timer()
+  output = f(*args)
+  if multiprocessing.current_process().name == "MainProcess":
+    return output, WorkerStats(None, 0.0, timer() - start, dict())
+  return output, WorkerStats(os.getpid(), getPeakRSS(), timer() - start, popCounters())
 
 def addOne(i):
   return i+1
 
+def addOneInSubtasks(processingPool, i):
+  return sum(processingPool.runSubtasks(addOne, [[i], [0]])) - 1
+
 def unitTest():
-  pool = MyPool(4)
-  for i in range(20):
-    pool.applyAsync(addOne, [i])
-  results = pool.checkPool()
-  print(results)
+  for executor in executorTypes:
+    pool = MyPool(4, executor = executor)
+    for i in range(20):
+      if i % 5 == 0:
+        pool.applyAsyncInMainProcess(addOneInSubtasks, [i])
+      else:
+        pool.applyAsync(addOne, [i])
+    results = pool.checkPool()
+    print(executor, results)
+    assert results == list(range(1, 21))
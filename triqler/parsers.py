@@ -13,7 +13,9 @@ import csv
 import os
 import itertools
 import re
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+
+from .errors import TriqlerError
 
 
 def getTsvReader(filename):
@@ -25,12 +27,15 @@ def getTsvReader(filename):
     return csv.reader(open(filename, 'rb'), delimiter = '\t')
 
 def getTsvWriter(filename):
+  return csv.writer(openTsvFile(filename), delimiter = '\t')
+
+def openTsvFile(filename):
   # Python 3
   if sys.version_info[0] >= 3:
-    return csv.writer(open(filename, 'w', newline = ''), delimiter = '\t')
+    return open(filename, 'w', newline = '')
   # Python 2
   else:
-    return csv.writer(open(filename, 'wb'), delimiter = '\t')
+    return open(filename, 'wb')
 
 ################################################
 ## input: filename <tab> group (one per line) ##
@@ -61,12 +66,12 @@ def parseFileList(inputFile):
   if len(sampleList) == 0:
     sampleList = fileList
   elif len(sampleList) != len(fileList):
-    sys.exit("Sample column was empty for some runs")
+    raise TriqlerError("ERROR: Sample column was empty for some runs")
   
   if len(fractionList) == 0:
     fractionList = [-1]*len(fileList)
   elif len(fractionList) != len(fileList):
-    sys.exit("Fraction column was empty for some runs")
+    raise TriqlerError("ERROR: Fraction column was empty for some runs")
   
   fileInfoList = [[x, getGroupLabel(idx, groups, groupNames), sampleList[idx], fractionList[idx]] for idx, x in enumerate(fileList)]
   return fileInfoList
@@ -174,6 +179,22 @@ def parseTriqlerInputFile(triqlerInputFile):
         proteins = getUniqueProteins(row[6:])
         yield TriqlerInputRow(row[0], row[1], int(row[2]), (i+1) * 100, 0.0, seenPeptChargePairs[key], float(row[3]), intensity, row[5], proteins)
 
+# applies the same conversions as parseTriqlerInputFile to rows that were 
+# generated in memory, e.g. by the converters, such that they do not have to 
+# be written to and parsed from a Triqler input file
+def prepareTriqlerInputRows(triqlerInputRows, hasLinkPEPs):
+  getUniqueProteins = lambda x : list(set([p for p in x if len(p.strip()) > 0]))
+  seenPeptChargePairs = dict()
+  for i, row in enumerate(triqlerInputRows):
+    if row.intensity > 0.0:
+      if hasLinkPEPs:
+        yield TriqlerInputRow(row.run, row.condition, int(row.charge), int(row.spectrumId), float(row.linkPEP), int(row.featureClusterId), float(row.searchScore), float(row.intensity), row.peptide, getUniqueProteins(row.proteins))
+      else:
+        key = (int(row.charge), row.peptide)
+        if key not in seenPeptChargePairs:
+          seenPeptChargePairs[key] = len(seenPeptChargePairs)
+        yield TriqlerInputRow(row.run, row.condition, int(row.charge), (i+1) * 100, 0.0, seenPeptChargePairs[key], float(row.searchScore), float(row.intensity), row.peptide, getUniqueProteins(row.proteins))
+
 def hasLinkPEPs(triqlerInputFile):
   reader = getTsvReader(triqlerInputFile)
   headers = next(reader)
@@ -184,13 +205,86 @@ def hasLinkPEPs(triqlerInputFile):
 #####################################
 
 def parsePosteriorFile(peptideQuantFile, refProtein = ""):
+  if len(refProtein) > 0:
+    for row in parsePosteriorFileIndexed(peptideQuantFile, refProtein):
+      yield row
+    return
+
   reader = getTsvReader(peptideQuantFile)
   headers = next(reader)
-  
+
   for row in reader:
     protein = row[0]
-    if len(refProtein) == 0 or refProtein in protein:
-      yield protein, row[1], np.array(list(map(float, row[2:])))
+    yield protein, row[1], np.array(list(map(float, row[2:])))
+
+# uses the sidecar index to only read the rows of matching proteins
+def parsePosteriorFileIndexed(posteriorFile, refProtein):
+  posteriorIndex = getPosteriorFileIndex(posteriorFile)
+  with open(posteriorFile, 'rb') as f:
+    for protein, offsets in posteriorIndex.items():
+      if refProtein not in protein:
+        continue
+      for startOffset, endOffset in offsets:
+        f.seek(startOffset)
+        block = f.read(endOffset - startOffset)
+        if sys.version_info[0] >= 3:
+          block = block.decode('utf-8')
+        for row in csv.reader(block.splitlines(), delimiter = '\t'):
+          yield row[0], row[1], np.array(list(map(float, row[2:])))
+
+def getPosteriorIndexFile(posteriorFile):
+  return posteriorFile + ".idx"
+
+# returns the index from the sidecar file, (re)building it if it is missing
+# or does not belong to the current version of the posterior file
+def getPosteriorFileIndex(posteriorFile):
+  posteriorIndexFile = getPosteriorIndexFile(posteriorFile)
+  if os.path.isfile(posteriorIndexFile) and os.path.getmtime(posteriorIndexFile) >= os.path.getmtime(posteriorFile):
+    fileSize, posteriorIndex = parsePosteriorIndexFile(posteriorIndexFile)
+    if fileSize == os.path.getsize(posteriorFile):
+      return posteriorIndex
+
+  print("Building posterior file index", posteriorIndexFile)
+  posteriorIndex = buildPosteriorFileIndex(posteriorFile)
+  try:
+    writePosteriorIndexFile(posteriorIndexFile, os.path.getsize(posteriorFile), posteriorIndex)
+  except (IOError, OSError):
+    print("Warning: could not write posterior file index", posteriorIndexFile)
+  return posteriorIndex
+
+# maps each protein to the byte ranges of its rows in a single pass over the
+# posterior file, only the protein column is decoded
+def buildPosteriorFileIndex(posteriorFile):
+  posteriorIndex = OrderedDict()
+  with open(posteriorFile, 'rb') as f:
+    offset = len(f.readline()) # header
+    for line in f:
+      protein = line.split(b'\t', 1)[0]
+      if sys.version_info[0] >= 3:
+        protein = protein.decode('utf-8')
+
+      offsets = posteriorIndex.setdefault(protein, [])
+      if len(offsets) > 0 and offsets[-1][1] == offset:
+        offsets[-1][1] = offset + len(line)
+      else:
+        offsets.append([offset, offset + len(line)])
+      offset += len(line)
+  return posteriorIndex
+
+def writePosteriorIndexFile(posteriorIndexFile, fileSize, posteriorIndex):
+  writer = getTsvWriter(posteriorIndexFile)
+  writer.writerow(["posterior_file_size", fileSize])
+  for protein, offsets in posteriorIndex.items():
+    for startOffset, endOffset in offsets:
+      writer.writerow([protein, startOffset, endOffset])
+
+def parsePosteriorIndexFile(posteriorIndexFile):
+  reader = getTsvReader(posteriorIndexFile)
+  fileSize = int(next(reader)[1])
+  posteriorIndex = OrderedDict()
+  for row in reader:
+    posteriorIndex.setdefault(row[0], []).append([int(row[1]), int(row[2])])
+  return fileSize, posteriorIndex
 
 ##############################
 ## Peptide quant row files  ##
@@ -298,6 +392,70 @@ def getQuantMatrix(quantRows, condenseChargeStates = True, retainBestChargeState
   quantMatrix = list(quantMatrix)
   return quantRows, quantMatrix
 
+# index of the condensed peptide quant rows of each protein, built once and 
+# shared by protein grouping, hyperparameter fitting and posterior dispatch.
+# Only the best charge state per (protein, clean peptide) is retained, ties are
+# resolved by input order. The rows of protein proteins[i] are in 
+# proteinOffsets[i]:proteinOffsets[i+1], ordered by combinedPEP and input order;
+# cleanPeptideIdxs contains the rank of the clean peptide sequence of each row
+ProteinQuantIndex = namedtuple("ProteinQuantIndex", "proteins proteinOffsets quantRows cleanPeptideIdxs")
+
+def getProteinQuantIndex(peptQuantRows):
+  validPqr = lambda x : len(x.protein) == 1 and x.protein[0] != "NA" and x.combinedPEP < 1.0
+  peptQuantRows = [x for x in peptQuantRows if validPqr(x)]
+  if len(peptQuantRows) == 0:
+    return ProteinQuantIndex(list(), np.zeros(1, dtype = int), list(), np.zeros(0, dtype = int))
+  
+  proteins, proteinIdxs = np.unique([x.protein[0] for x in peptQuantRows], return_inverse = True)
+  _, cleanPeptideIdxs = np.unique(getCleanPeptides([x.peptide for x in peptQuantRows]), return_inverse = True)
+  combinedPEPs = np.array([x.combinedPEP for x in peptQuantRows])
+  inputIdxs = np.arange(len(peptQuantRows))
+  
+  rowIdxs = np.lexsort((inputIdxs, combinedPEPs, cleanPeptideIdxs, proteinIdxs))
+  isBestChargeState = np.ones(len(rowIdxs), dtype = bool)
+  isBestChargeState[1:] = (np.diff(proteinIdxs[rowIdxs]) != 0) | (np.diff(cleanPeptideIdxs[rowIdxs]) != 0)
+  rowIdxs = rowIdxs[isBestChargeState]
+  
+  rowIdxs = rowIdxs[np.lexsort((rowIdxs, combinedPEPs[rowIdxs], proteinIdxs[rowIdxs]))]
+  
+  proteinOffsets = np.concatenate(([0], np.cumsum(np.bincount(proteinIdxs[rowIdxs], minlength = len(proteins)))))
+  return ProteinQuantIndex(list(proteins), proteinOffsets, [peptQuantRows[i] for i in rowIdxs], cleanPeptideIdxs[rowIdxs])
+
+# vectorized equivalent of calling getQuantMatrix on every protein of the 
+# protein quant index that passes the proteinFilter. The quant rows and quant 
+# matrices of these proteins are concatenated, the rows of protein i are in 
+# proteinOffsets[i]:proteinOffsets[i+1], ordered by combinedPEP and clean peptide
+def getConcatenatedQuantMatrix(proteinQuantIndex, proteinFilter = lambda x : True):
+  proteins, proteinOffsets, quantRows, cleanPeptideIdxs = proteinQuantIndex
+  proteinIdxs = np.array([i for i, protein in enumerate(proteins) if proteinFilter(protein)], dtype = int)
+  if len(proteinIdxs) == 0:
+    return list(), np.zeros(1, dtype = int), list(), np.zeros((0, 0))
+  
+  numPeptides = np.diff(proteinOffsets)[proteinIdxs]
+  subsetOffsets = np.concatenate(([0], np.cumsum(numPeptides)))
+  rowIdxs = np.arange(subsetOffsets[-1]) + np.repeat(proteinOffsets[proteinIdxs] - subsetOffsets[:-1], numPeptides)
+  
+  rowProteinIdxs = np.repeat(np.arange(len(proteinIdxs)), numPeptides)
+  combinedPEPs = np.array([quantRows[i].combinedPEP for i in rowIdxs])
+  rowIdxs = rowIdxs[np.lexsort((cleanPeptideIdxs[rowIdxs], combinedPEPs, rowProteinIdxs))]
+  
+  quantRows = [quantRows[i] for i in rowIdxs]
+  quantMatrix = np.array([x.quant for x in quantRows], dtype = float)
+  quantMatrix[~(quantMatrix > 0.0)] = np.nan
+  return [proteins[i] for i in proteinIdxs], subsetOffsets, quantRows, quantMatrix
+
+# selects the proteins with the given (sorted) indices from a concatenated 
+# quant matrix, returns the offsets, quant rows and quant matrix of the subset
+def getProteinSubsetQuantMatrix(proteinOffsets, quantRows, quantMatrix, proteinIdxs):
+  numPeptides = np.diff(proteinOffsets)[proteinIdxs]
+  subsetOffsets = np.concatenate(([0], np.cumsum(numPeptides)))
+  rowIdxs = np.arange(subsetOffsets[-1]) + np.repeat(proteinOffsets[proteinIdxs] - subsetOffsets[:-1], numPeptides)
+  return subsetOffsets, [quantRows[i] for i in rowIdxs], quantMatrix[rowIdxs]
+
+# sums the rows of each protein segment of a concatenated quant matrix
+def sumPerProtein(matrix, proteinOffsets):
+  return np.add.reduceat(matrix, proteinOffsets[:-1], axis = 0)
+
 def weightedGeomAvg(row, weights):
   weightSum = np.nansum(weights)
   if weightSum > 0:
@@ -311,6 +469,15 @@ def geomAvg(row):
 def geoNormalize(row):
   return row / geomAvg(row)
 
+# peptides occur multiple times, e.g. for different charge states, only apply
+# the regex substitution once per unique peptide
+def getCleanPeptides(peptides):
+  cleanPeptides = dict()
+  for peptide in peptides:
+    if peptide not in cleanPeptides:
+      cleanPeptides[peptide] = cleanPeptide(peptide)
+  return [cleanPeptides[peptide] for peptide in peptides]
+
 def cleanPeptide(peptide):
   if peptide[1] == "." and peptide[-2] == ".":
     peptide = peptide[2:-2]
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+'''
+Records wall clock time, CPU time, peak memory usage and item counts of the
+stages of the Triqler pipeline and writes them to a JSON report.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+try:
+  import resource
+except ImportError: # not available on Windows
+  resource = None
+
+# peak resident set size in MB of the current process (RUSAGE_SELF) or of its
+# largest terminated child process (RUSAGE_CHILDREN)
+def getPeakRSS(who = "self"):
+  if resource is None:
+    return float('nan')
+  rusage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+  # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+  if sys.platform == "darwin":
+    return rusage.ru_maxrss / 1024.0 / 1024.0
+  else:
+    return rusage.ru_maxrss / 1024.0
+
+def getCPUTime():
+  times = os.times()
+  return times[0] + times[1]
+
+class PerfReport:
+  def __init__(self):
+    self.start = timer()
+    self.stages = list()
+  
+  @contextmanager
+  def stage(self, name):
+    stage = self.getStage(name)
+    start, cpuStart = timer(), getCPUTime()
+    try:
+      yield stage
+    finally:
+      stage['wall_time_s'] += timer() - start
+      stage['cpu_time_s'] += getCPUTime() - cpuStart
+      stage['main_peak_rss_mb'] = getPeakRSS("self")
+  
+  # stages can be entered multiple times, e.g. for writing output files, in
+  # which case the times and item counts are accumulated
+  def getStage(self, name):
+    for stage in self.stages:
+      if stage['name'] == name:
+        return stage
+    stage = { 'name' : name, 'wall_time_s' : 0.0, 'cpu_time_s' : 0.0, 'main_peak_rss_mb' : 0.0, 'items' : 0,
+              'num_workers' : 0, 'worker_peak_rss_mb_max' : 0.0, 'worker_peak_rss_mb_sum' : 0.0 }
+    self.stages.append(stage)
+    return stage
+  
+  def toDict(self):
+    return { 'total_wall_time_s' : timer() - self.start,
+             'main_peak_rss_mb' : getPeakRSS("self"),
+             'children_peak_rss_mb' : getPeakRSS("children"),
+             'stages' : self.stages }
+  
+  def writeReport(self, reportFile, extraInfo = dict()):
+    report = dict(extraInfo)
+    report.update(self.toDict())
+    with open(reportFile, 'w') as f:
+      json.dump(report, f, indent = 2)
+  
+  def printSummary(self):
+    report = self.toDict()
+    print("Performance summary")
+    print("  %-24s %10s %10s %10s %14s %14s" % ("stage", "wall (s)", "cpu (s)", "items", "main RSS (MB)", "worker RSS (MB)"))
+    for stage in self.stages:
+      workerRSS = "%.1f" % stage['worker_peak_rss_mb_sum'] if stage['num_workers'] > 0 else "-"
+      print("  %-24s %10.2f %10.2f %10d %14.1f %14s" % (stage['name'], stage['wall_time_s'], stage['cpu_time_s'], stage['items'], stage['main_peak_rss_mb'], workerRSS))
+    print("  %-24s %10.2f" % ("total", report['total_wall_time_s']))
+
+# records the peak RSS per worker process of a multiprocessing_pool.MyPool
+def addWorkerPeakRSS(stage, workerPeakRSS):
+  if stage is not None and len(workerPeakRSS) > 0:
+    stage['num_workers'] = max([stage['num_workers'], len(workerPeakRSS)])
+    stage['worker_peak_rss_mb_max'] = max([stage['worker_peak_rss_mb_max']] + list(workerPeakRSS.values()))
+    stage['worker_peak_rss_mb_sum'] = max([stage['worker_peak_rss_mb_sum'], sum(workerPeakRSS.values())])
+
+class _NoStage:
+  def __enter__(self):
+    return None
+  
+  def __exit__(self, *args):
+    return False
+
+# context manager for timing a pipeline stage, which yields the stage record
+# or None if no performance report was requested in params['perfReport']. The
+# stage is also reported to params['progressMetrics'] if present
+def stage(params, name):
+  if params is not None and params.get('progressMetrics') is not None:
+    params['progressMetrics'].setStage(name)
+  
+  if params is not None and params.get('perfReport') is not None:
+    return params['perfReport'].stage(name)
+  else:
+    return _NoStage()
+
+def addItems(stage, numItems):
+  if stage is not None:
+    stage['items'] += numItems
@@ -5,18 +5,31 @@ from __future__ import print_function
 import itertools
 
 import numpy as np
-from scipy.stats import f_oneway, gamma
-from scipy.optimize import curve_fit
 
 from . import parsers
 from . import convolution_dp
-from . import hyperparameters
+from . import kernels
+from . import progress_metrics
 
-def getPosteriors(quantRowsOrig, params):
-  quantRows, quantMatrix = parsers.getQuantMatrix(quantRowsOrig)
+# quantRows and quantMatrix can be passed directly from 
+# parsers.getConcatenatedQuantMatrix, which avoids condensing the charge 
+# states again for every protein
+def getPosteriors(quantRowsOrig, params, quantMatrix = None):
+  if quantMatrix is None:
+    quantRows, quantMatrix = parsers.getQuantMatrix(quantRowsOrig)
+  else:
+    quantRows = quantRowsOrig
   
   pProteinQuantsList, bayesQuantRow = getPosteriorProteinRatios(quantMatrix, quantRows, params)
+  return getPosteriorsFromProteinRatios(pProteinQuantsList, bayesQuantRow, params)
+
+# group and fold change posteriors from the run-level posteriors, also used
+# by the laplace engine for proteins it cannot approximate
+def getPosteriorsFromProteinRatios(pProteinQuantsList, bayesQuantRow, params):
   pProteinGroupQuants = getPosteriorProteinGroupRatios(pProteinQuantsList, bayesQuantRow, params)
+  return getPosteriorsFromGroupRatios(pProteinQuantsList, pProteinGroupQuants, bayesQuantRow, params)
+
+def getPosteriorsFromGroupRatios(pProteinQuantsList, pProteinGroupQuants, bayesQuantRow, params):
   pProteinGroupDiffs, muGroupDiffs = getProteinGroupsDiffPosteriors(pProteinGroupQuants, params)
   
   probsBelowFoldChange = getProbBelowFoldChangeDict(pProteinGroupDiffs, params)
@@ -36,13 +49,32 @@ def getDummyPosteriors(params):
   posteriorDists = None
   return bayesQuantRow, muGroupDiffs, probsBelowFoldChange, posteriorDists
   
-def getPosteriorProteinRatios(quantMatrix, quantRows, params, maxIterations = 50, bayesQuantRow = None):
+# getPosteriorProteinRatioFunc replaces getPosteriorProteinRatio in the EM 
+# iterations on the full resolution grid, e.g. to distribute the runs over 
+# multiple processes
+def getPosteriorProteinRatios(quantMatrix, quantRows, params, maxIterations = 50, bayesQuantRow = None, getPosteriorProteinRatioFunc = None):
+  stride = getCoarseGridStride(params)
+  if stride > 1:
+    return getPosteriorProteinRatiosMultiResolution(quantMatrix, quantRows, params, stride, maxIterations)
+  
   numSamples = len(quantMatrix[0])
   bayesQuantRow = np.array([1.0]*numSamples)
+  pProteinQuantsList, bayesQuantRow, _, converged = iteratePosteriorProteinRatio(quantMatrix, quantRows, bayesQuantRow, params, maxIterations, getPosteriorProteinRatioFunc)
+  
+  if not converged:
+    print("Warning: failed to converge for protein", quantRows[0].protein[0])
+    progress_metrics.incrementCounter(params, 'proteins_not_converged')
+  
+  return pProteinQuantsList, bayesQuantRow
+
+def iteratePosteriorProteinRatio(quantMatrix, quantRows, bayesQuantRow, params, maxIterations, getPosteriorProteinRatioFunc = None):
+  if getPosteriorProteinRatioFunc is None:
+    getPosteriorProteinRatioFunc = getPosteriorProteinRatio
+  
   converged = False
   for iteration in range(maxIterations):  
     prevBayesQuantRow = np.copy(bayesQuantRow)
-    pProteinQuantsList, bayesQuantRow = getPosteriorProteinRatio(quantMatrix, quantRows, bayesQuantRow, params)
+    pProteinQuantsList, bayesQuantRow = getPosteriorProteinRatioFunc(quantMatrix, quantRows, bayesQuantRow, params)
     
     bayesQuantRow = parsers.geoNormalize(bayesQuantRow)
     
@@ -52,42 +84,55 @@ def getPosteriorProteinRatios(quantMatrix, quantRows, params, maxIterations = 50
       #print("Converged after iteration", iteration+1, quantRows[0].protein[0])
       break
   
-  if not converged:
-    print("Warning: failed to converge for protein", quantRows[0].protein[0])
-  
-  return pProteinQuantsList, bayesQuantRow
+  return pProteinQuantsList, bayesQuantRow, iteration + 1, converged
 
-def getPosteriorProteinRatio(quantMatrix, quantRows, geoAvgQuantRow, params):
+# the likelihoods of the imputed values are evaluated in chunks of peptides
+# and runs, so that the peak memory usage stays below params['maxChunkMemory']
+# (in MB) for large proteins. The log likelihoods of each run are accumulated
+# in the same order as for a single chunk, so the results do not depend on
+# the chunk size. If runSlice is given, only the posteriors of these runs are
+# returned, which allows the runs of large proteins to be processed in parallel
+def getPosteriorProteinRatio(quantMatrix, quantRows, geoAvgQuantRow, params, runSlice = None):
   numSamples = len(quantMatrix[0])
+  if runSlice is None:
+    runSlice = slice(0, numSamples)
   
+  logQuantMatrix = np.log10(np.array(quantMatrix))
   logGeoAvgs = np.log10([parsers.geomAvg(row) for row in quantMatrix])
   featDiffs = np.log10(quantMatrix) - logGeoAvgs[:,np.newaxis]
   pMissingGeomAvg = pMissing(logGeoAvgs, params["muDetect"], params["sigmaDetect"]) # Pr(f_grn = NaN | t_grn = 1)
   
-  pQuantIncorrectId = hyperparameters.funcHypsec(featDiffs, params["muFeatureDiff"], params["sigmaFeatureDiff"]) # Pr(f_grn = x | t_grn = 1)
+  pQuantIncorrectId = kernels.hypsecPdf(featDiffs, params["muFeatureDiff"], params["sigmaFeatureDiff"]) # Pr(f_grn = x | t_grn = 1)
   #pQuantIncorrectIdOld = hyperparameters.funcLogitNormal(np.log10(quantMatrix), params["muDetect"], params["sigmaDetect"], params["muXIC"], params["sigmaXIC"]) 
   
-  xImpsAll = imputeValues(quantMatrix, geoAvgQuantRow, params['proteinQuantCandidates'])
-  impDiffs = xImpsAll - np.log10(np.array(quantMatrix))[:,:,np.newaxis]
-  pDiffs = hyperparameters.funcHypsec(impDiffs, params["muFeatureDiff"], params["sigmaFeatureDiff"]) # Pr(f_grn = x | m_grn = 0, t_grn = 0)
+  meanLogIonEffs = getMeanLogIonizationEfficiencies(quantMatrix, geoAvgQuantRow)
+  
+  pProteinQuants = [params['proteinPrior'].copy() for j in range(runSlice.start, runSlice.stop)] # log likelihood
+  for rowSlice, sampleSlice in getLikelihoodChunks(len(quantMatrix), runSlice, len(params['proteinQuantCandidates']), params):
+    xImpsAll = meanLogIonEffs[rowSlice, sampleSlice, np.newaxis] + params['proteinQuantCandidates']
+    impDiffs = xImpsAll - logQuantMatrix[rowSlice, sampleSlice, np.newaxis]
+    pDiffs = kernels.hypsecPdf(impDiffs, params["muFeatureDiff"], params["sigmaFeatureDiff"]) # Pr(f_grn = x | m_grn = 0, t_grn = 0)
+    del impDiffs
+    
+    for j in range(sampleSlice.start, sampleSlice.stop):
+      for i in range(rowSlice.start, rowSlice.stop):
+        row = quantMatrix[i]
+        linkPEP = quantRows[i].linkPEP[j]
+        identPEP = quantRows[i].identificationPEP[j]
+        if identPEP < 1.0:
+          chunkI, chunkJ = i - rowSlice.start, j - sampleSlice.start
+          pMissings = pMissing(xImpsAll[chunkI,chunkJ,:], params["muDetect"], params["sigmaDetect"]) # Pr(f_grn = NaN | m_grn = 1, t_grn = 0)
+          if np.isnan(row[j]):
+            likelihood = pMissings * (1.0 - identPEP) * (1.0 - linkPEP) + pMissingGeomAvg[i] * (identPEP * (1.0 - linkPEP) + linkPEP)
+          else:
+            likelihood = (1.0 - pMissings) * pDiffs[chunkI,chunkJ,:] * (1.0 - identPEP) * (1.0 - linkPEP) + (1.0 - pMissingGeomAvg[i]) * (pQuantIncorrectId[i][j] * identPEP * (1.0 - linkPEP) + linkPEP)
+          
+          if np.min(likelihood) == 0.0:
+            likelihood += np.nextafter(0,1)
+          pProteinQuants[j - runSlice.start] += np.log(likelihood)
   
   pProteinQuantsList, bayesQuantRow = list(), list()
-  for j in range(numSamples):
-    pProteinQuant = params['proteinPrior'].copy() # log likelihood
-    for i, row in enumerate(quantMatrix):
-      linkPEP = quantRows[i].linkPEP[j]
-      identPEP = quantRows[i].identificationPEP[j]
-      if identPEP < 1.0:
-        pMissings = pMissing(xImpsAll[i,j,:], params["muDetect"], params["sigmaDetect"]) # Pr(f_grn = NaN | m_grn = 1, t_grn = 0)
-        if np.isnan(row[j]):
-          likelihood = pMissings * (1.0 - identPEP) * (1.0 - linkPEP) + pMissingGeomAvg[i] * (identPEP * (1.0 - linkPEP) + linkPEP)
-        else:
-          likelihood = (1.0 - pMissings) * pDiffs[i,j,:] * (1.0 - identPEP) * (1.0 - linkPEP) + (1.0 - pMissingGeomAvg[i]) * (pQuantIncorrectId[i][j] * identPEP * (1.0 - linkPEP) + linkPEP)
-        
-        if np.min(likelihood) == 0.0:
-          likelihood += np.nextafter(0,1)
-        pProteinQuant += np.log(likelihood)
-        
+  for pProteinQuant in pProteinQuants:
     pProteinQuant -= np.max(pProteinQuant)
     pProteinQuant = np.exp(pProteinQuant) / np.sum(np.exp(pProteinQuant))
     pProteinQuantsList.append(pProteinQuant)
@@ -97,32 +142,60 @@ def getPosteriorProteinRatio(quantMatrix, quantRows, geoAvgQuantRow, params):
   
   return pProteinQuantsList, bayesQuantRow
 
+# yields (rowSlice, sampleSlice) blocks of the peptides x runSlice matrix, 
+# such that the imputed values, their differences to the observed values and 
+# their likelihoods for one block together fit in params['maxChunkMemory'] MB.
+# Row blocks are yielded in increasing order for each run
+def getLikelihoodChunks(numRows, runSlice, numCandidates, params):
+  numSamples = runSlice.stop - runSlice.start
+  maxCells = int(params.get('maxChunkMemory', 256) * 1024 * 1024 / (3 * 8 * numCandidates))
+  if maxCells >= numRows * numSamples:
+    yield slice(0, numRows), runSlice
+  elif maxCells >= numSamples:
+    rowsPerChunk = maxCells // numSamples
+    for rowStart in range(0, numRows, rowsPerChunk):
+      yield slice(rowStart, min([rowStart + rowsPerChunk, numRows])), runSlice
+  else:
+    samplesPerChunk = max([1, maxCells])
+    for sampleStart in range(runSlice.start, runSlice.stop, samplesPerChunk):
+      for rowStart in range(numRows):
+        yield slice(rowStart, rowStart + 1), slice(sampleStart, min([sampleStart + samplesPerChunk, runSlice.stop]))
+
 def imputeValues(quantMatrix, proteinRatios, testProteinRatios):
+  meanLogIonEff = getMeanLogIonizationEfficiencies(quantMatrix, proteinRatios)
+  
+  logImputedVals = np.tile(meanLogIonEff[:, :, np.newaxis], (1, 1, len(testProteinRatios))) + testProteinRatios
+  return logImputedVals
+
+# mean log ionization efficiency of each peptide over the other runs, the 
+# imputed log values are obtained by adding the log protein ratios
+def getMeanLogIonizationEfficiencies(quantMatrix, proteinRatios):
   logIonizationEfficiencies = np.log10(quantMatrix) - np.log10(proteinRatios)
   
   numNonZeros = np.count_nonzero(~np.isnan(logIonizationEfficiencies), axis = 1)[:,np.newaxis] - ~np.isnan(logIonizationEfficiencies)
   np.nan_to_num(logIonizationEfficiencies, False)
-  meanLogIonEff = (np.nansum(logIonizationEfficiencies, axis = 1)[:,np.newaxis] - logIonizationEfficiencies) / numNonZeros
-  
-  logImputedVals = np.tile(meanLogIonEff[:, :, np.newaxis], (1, 1, len(testProteinRatios))) + testProteinRatios
-  return logImputedVals
+  return (np.nansum(logIonizationEfficiencies, axis = 1)[:,np.newaxis] - logIonizationEfficiencies) / numNonZeros
 
 def pMissing(x, muLogit, sigmaLogit):
-  return 1.0 - hyperparameters.logit(x, muLogit, sigmaLogit) + np.nextafter(0, 1)
+  return 1.0 - kernels.logit(x, muLogit, sigmaLogit) + np.nextafter(0, 1)
 
 def getPosteriorProteinGroupRatios(pProteinQuantsList, bayesQuantRow, params):
   numGroups = len(params["groups"])
   
   pProteinGroupQuants = list()
   for groupId in range(numGroups):
-    filteredProteinQuantsList = np.array([x for j, x in enumerate(pProteinQuantsList) if j in params['groups'][groupId]])
-    if "shapeInGroupStdevs" in params:
-      pMu = getPosteriorProteinGroupMuMarginalized(filteredProteinQuantsList, params)
-    else:
-      pMu = getPosteriorProteinGroupMu(params['inGroupDiffPrior'], filteredProteinQuantsList, params)
-    pProteinGroupQuants.append(pMu)
+    pProteinGroupQuants.append(getPosteriorProteinGroupRatio(pProteinQuantsList, groupId, params))
   
   return pProteinGroupQuants
+
+def getPosteriorProteinGroupRatio(pProteinQuantsList, groupId, params):
+  filteredProteinQuantsList = np.array([x for j, x in enumerate(pProteinQuantsList) if j in params['groups'][groupId]])
+  if getCoarseGridStride(params) > 1:
+    return getPosteriorProteinGroupMuMultiResolution(filteredProteinQuantsList, params, getCoarseGridStride(params))
+  elif "shapeInGroupStdevs" in params:
+    return getPosteriorProteinGroupMuMarginalized(filteredProteinQuantsList, params)
+  else:
+    return getPosteriorProteinGroupMu(params['inGroupDiffPrior'], filteredProteinQuantsList, params)
   
 def getPosteriorProteinGroupMu(pDiffPrior, pProteinQuantsList, params):
   pMus = np.zeros_like(params['proteinQuantCandidates'])
@@ -140,7 +213,7 @@ def getPosteriorProteinGroupMuMarginalized(pProteinQuantsList, params):
     for idx, pDiffPrior in enumerate(params['inGroupDiffPrior']):
       pMus[idx,:] += np.log(np.convolve(pDiffPrior, pProteinQuants, mode = 'valid'))
   
-  pSigmas = hyperparameters.funcGamma(params['sigmaCandidates'], params["shapeInGroupStdevs"], params["scaleInGroupStdevs"]) # prior
+  pSigmas = params['inGroupStdevPrior'] # prior
   pMus = np.log(np.dot(pSigmas, np.exp(pMus)))
   
   pMus -= np.max(pMus)
@@ -152,7 +225,10 @@ def getProteinGroupsDiffPosteriors(pProteinGroupQuants, params):
   numGroups = len(params['groups'])  
   pProteinGroupDiffs, muGroupDiffs = dict(), dict()
   for groupId1, groupId2 in itertools.combinations(range(numGroups), 2):
-    pDifference = np.convolve(pProteinGroupQuants[groupId1], pProteinGroupQuants[groupId2][::-1])
+    if getCoarseGridStride(params) > 1:
+      pDifference = convolveNonzeroRegions(pProteinGroupQuants[groupId1], pProteinGroupQuants[groupId2][::-1])
+    else:
+      pDifference = np.convolve(pProteinGroupQuants[groupId1], pProteinGroupQuants[groupId2][::-1])
     pProteinGroupDiffs[(groupId1,groupId2)] = pDifference
     muGroupDiffs[(groupId1,groupId2)], _ = np.log2(getPosteriorParams(params['proteinDiffCandidates'], pDifference) + np.nextafter(0, 1))
   return pProteinGroupDiffs, muGroupDiffs
@@ -201,3 +277,127 @@ def getPosteriorParams(proteinQuantCandidates, pProteinQuants):
     
     return eValueNew, [10**(eValue - np.sqrt(variance)), 10**(eValue + np.sqrt(variance))]
 
+###############################################
+## Multi-resolution grid evaluation          ##
+###############################################
+
+# number of grid points per coarse grid point for params['coarseGridStep'], 
+# a stride of 1 disables the multi-resolution evaluation
+def getCoarseGridStride(params):
+  qc = params['proteinQuantCandidates']
+  return max([1, int(np.round(params.get('coarseGridStep', 0.0) / (qc[1] - qc[0])))])
+
+# the EM iterations run on the coarse grid until convergence, after which the
+# final iterations run on the full resolution grid restricted to the region
+# holding all but params['coarseGridTolerance'] of the coarse posterior mass.
+# The posteriors are zero outside of this region
+def getPosteriorProteinRatiosMultiResolution(quantMatrix, quantRows, params, stride, maxIterations):
+  numSamples = len(quantMatrix[0])
+  numCandidates = len(params['proteinQuantCandidates'])
+  tolerance = params.get('coarseGridTolerance', 1e-6)
+  
+  coarseIdxs = np.arange(0, numCandidates, stride)
+  bayesQuantRow = np.array([1.0]*numSamples)
+  pCoarseQuantsList, bayesQuantRow, numIterations, _ = iteratePosteriorProteinRatio(quantMatrix, quantRows, bayesQuantRow, getSubGridParams(params, coarseIdxs), max([maxIterations - 1, 1]))
+  
+  fineIdxs = getMassRegion(pCoarseQuantsList, coarseIdxs, numCandidates, tolerance)
+  pFineQuantsList, bayesQuantRow, _, converged = iteratePosteriorProteinRatio(quantMatrix, quantRows, bayesQuantRow, getSubGridParams(params, fineIdxs), max([maxIterations - numIterations, 1]))
+  
+  # the posteriors moved out of the refined region, use the full grid instead
+  if len(fineIdxs) < numCandidates and max(max(x[0], x[-1]) for x in pFineQuantsList) > tolerance:
+    fineIdxs = np.arange(numCandidates)
+    pFineQuantsList, bayesQuantRow, _, converged = iteratePosteriorProteinRatio(quantMatrix, quantRows, bayesQuantRow, params, max([maxIterations - numIterations, 1]))
+  
+  if not converged:
+    print("Warning: failed to converge for protein", quantRows[0].protein[0])
+    progress_metrics.incrementCounter(params, 'proteins_not_converged')
+  
+  pProteinQuantsList = list()
+  for pFineQuants in pFineQuantsList:
+    pProteinQuants = np.zeros(numCandidates)
+    pProteinQuants[fineIdxs] = pFineQuants
+    pProteinQuantsList.append(pProteinQuants)
+  
+  return pProteinQuantsList, bayesQuantRow
+
+def getSubGridParams(params, idxs):
+  subGridParams = dict(params)
+  subGridParams['proteinQuantCandidates'] = params['proteinQuantCandidates'][idxs]
+  subGridParams['proteinPrior'] = params['proteinPrior'][idxs]
+  return subGridParams
+
+# contiguous range of full resolution grid indices that covers all but 
+# tolerance of the mass of each of the coarse posteriors, padded by one coarse
+# grid point on each side
+def getMassRegion(pCoarseList, coarseIdxs, numCandidates, tolerance):
+  lowerIdx, upperIdx = len(coarseIdxs) - 1, 0
+  for pCoarse in pCoarseList:
+    cumMass = np.cumsum(pCoarse) / np.sum(pCoarse)
+    lowerIdx = min([lowerIdx, np.searchsorted(cumMass, tolerance / 2)])
+    upperIdx = max([upperIdx, np.searchsorted(cumMass, 1.0 - tolerance / 2)])
+  lowerIdx, upperIdx = max([lowerIdx - 1, 0]), min([upperIdx + 1, len(coarseIdxs) - 1])
+  
+  upperFineIdx = coarseIdxs[upperIdx] if upperIdx < len(coarseIdxs) - 1 else numCandidates - 1
+  return np.arange(coarseIdxs[lowerIdx], upperFineIdx + 1)
+
+# a first pass on the coarse grid locates the group mean posterior, which is
+# then evaluated at full resolution in the region holding its mass. Only the
+# nonzero region of the run-level posteriors enters the convolutions
+def getPosteriorProteinGroupMuMultiResolution(pProteinQuantsList, params, stride):
+  numCandidates = len(params['proteinQuantCandidates'])
+  
+  coarseIdxs = np.arange(0, numCandidates, stride)
+  pCoarseMus = getLogPosteriorProteinGroupMuAt(pProteinQuantsList, coarseIdxs[0], coarseIdxs[-1], stride, params)
+  pCoarseMus = np.exp(pCoarseMus - np.max(pCoarseMus))
+  
+  fineIdxs = getMassRegion([pCoarseMus], coarseIdxs, numCandidates, params.get('coarseGridTolerance', 1e-6))
+  pFineMus = getLogPosteriorProteinGroupMuAt(pProteinQuantsList, fineIdxs[0], fineIdxs[-1], 1, params)
+  pFineMus = np.exp(pFineMus - np.max(pFineMus))
+  
+  pMus = np.zeros(numCandidates)
+  pMus[fineIdxs] = pFineMus / np.sum(pFineMus)
+  return pMus
+
+# unnormalized log posterior of the group mean at every stride-th grid index 
+# from lowerMuIdx up to upperMuIdx. With a stride of 1, this is equal to 
+# getPosteriorProteinGroupMu(Marginalized) at those indices, otherwise the 
+# run-level posteriors are summed and the in-group difference prior is 
+# averaged over the coarse grid cells, so that narrow distributions are not
+# missed between the coarse grid points
+def getLogPosteriorProteinGroupMuAt(pProteinQuantsList, lowerMuIdx, upperMuIdx, stride, params):
+  numCandidates = len(params['proteinQuantCandidates'])
+  pDiffPriors = np.atleast_2d(params['inGroupDiffPrior'])
+  if stride > 1:
+    cell = np.ones(stride)
+    pDiffPriors = np.array([np.convolve(pDiffPrior, cell / stride, mode = 'same') for pDiffPrior in pDiffPriors])
+    pProteinQuantsList = [np.convolve(pProteinQuants, cell, mode = 'same') for pProteinQuants in pProteinQuantsList]
+  numMus = (upperMuIdx - lowerMuIdx) // stride + 1
+  
+  pMus = np.zeros((len(pDiffPriors), numMus))
+  for pProteinQuants in pProteinQuantsList:
+    nonzeroIdxs = np.nonzero(pProteinQuants[::stride])[0]
+    pNonzeroQuants = pProteinQuants[::stride][nonzeroIdxs[0]:nonzeroIdxs[-1] + 1]
+    
+    # 'valid' convolution with the in-group difference prior between the 
+    # differences of the first mu and the last nonzero quant and of the last
+    # mu and the first nonzero quant
+    startIdx = lowerMuIdx - (nonzeroIdxs[-1] * stride) + numCandidates - 1
+    endIdx = upperMuIdx - (nonzeroIdxs[0] * stride) + numCandidates - 1
+    for idx, pDiffPrior in enumerate(pDiffPriors):
+      pMus[idx,:] += np.log(np.convolve(pDiffPrior[startIdx:endIdx+1:stride], pNonzeroQuants, mode = 'valid'))
+  
+  if "shapeInGroupStdevs" in params:
+    pSigmas = params['inGroupStdevPrior'] # prior
+    return np.log(np.dot(pSigmas, np.exp(pMus)))
+  else:
+    return pMus[0]
+
+# convolution of two posteriors that are zero outside of a contiguous region
+def convolveNonzeroRegions(p1, p2):
+  nonzeroIdxs1, nonzeroIdxs2 = np.nonzero(p1)[0], np.nonzero(p2)[0]
+  lowerIdx1, upperIdx1 = nonzeroIdxs1[0], nonzeroIdxs1[-1] + 1
+  lowerIdx2, upperIdx2 = nonzeroIdxs2[0], nonzeroIdxs2[-1] + 1
+  
+  pConvolved = np.zeros(len(p1) + len(p2) - 1)
+  pConvolved[lowerIdx1 + lowerIdx2:upperIdx1 + upperIdx2 - 1] = np.convolve(p1[lowerIdx1:upperIdx1], p2[lowerIdx2:upperIdx2])
+  return pConvolved
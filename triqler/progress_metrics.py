@@ -0,0 +1,224 @@
+#!/usr/bin/python
+
+'''
+Periodically rewrites a status file with the progress of a running Triqler
+job, so that long-running jobs can be monitored and hung jobs detected. The
+file is written in the Prometheus text format if its name ends with .prom,
+e.g. for the textfile collector of the node exporter, and in JSON format
+otherwise. The file is replaced atomically, so that readers never see a
+partially written file.
+'''
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+
+from .perf_report import getPeakRSS
+
+# increments a counter of the analysis, e.g. for proteins that did not 
+# converge, if a metrics file was requested, see triqler.runFromArgs
+def incrementCounter(params, name, value = 1):
+  if params is not None and params.get('progressCounters') is not None:
+    params['progressCounters'].increment(name, value)
+
+# counters of one analysis. A copy that was sent to a worker process adds to
+# the counters of the worker process instead, which are returned after every
+# task, see multiprocessing_pool.runAndGetWorkerStats, as a worker process
+# only runs one task at a time
+class Counters:
+  def __init__(self, names = ()):
+    self.pid = os.getpid()
+    self.counts = dict((name, 0) for name in names)
+    self.lock = threading.Lock()
+  
+  def increment(self, name, value = 1):
+    if os.getpid() != self.pid:
+      incrementWorkerCounter(name, value)
+      return
+    with self.lock:
+      self.counts[name] = self.counts.get(name, 0) + value
+  
+  def toDict(self):
+    with self.lock:
+      return dict(self.counts)
+  
+  def __getstate__(self):
+    return { 'pid' : self.pid }
+  
+  def __setstate__(self, state):
+    self.__init__()
+    self.pid = state['pid']
+
+# counters of the current task of a worker process
+_counters = dict()
+_countersLock = threading.Lock()
+
+def incrementWorkerCounter(name, value = 1):
+  with _countersLock:
+    _counters[name] = _counters.get(name, 0) + value
+
+def popCounters():
+  with _countersLock:
+    counters = dict(_counters)
+    _counters.clear()
+  return counters
+
+# (name, help text) of the counters that are always reported
+counterDescriptions = [
+  ('proteins_not_converged', 'Number of proteins for which the EM iterations of the run-level posteriors did not converge'),
+]
+
+class ProgressMetrics:
+  def __init__(self, metricsFile, interval = 10.0):
+    self.metricsFile = metricsFile
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.startTimestamp = time.time()
+    self.lastProgressTimestamp = self.startTimestamp
+    self.stage = "starting"
+    self.counters = Counters([name for name, _ in counterDescriptions])
+    self.startTasks()
+    
+    self.stopEvent = threading.Event()
+    self.thread = threading.Thread(target = self.run)
+    self.thread.daemon = True
+    self.thread.start()
+  
+  def run(self):
+    self.write()
+    while not self.stopEvent.wait(self.interval):
+      self.write()
+  
+  # writes the final state, e.g. "finished" or "failed"
+  def stop(self, stage):
+    self.stopEvent.set()
+    self.thread.join()
+    self.setStage(stage)
+  
+  def setStage(self, stage):
+    with self.lock:
+      self.stage = stage
+    self.write()
+  
+  # resets the task statistics for a new pool of worker processes
+  def startTasks(self):
+    with self.lock:
+      self.tasksStartTimestamp = time.time()
+      self.numTasks, self.numCompletedTasks = 0, 0
+      self.workerBusyTime, self.workerPeakRSS = dict(), dict()
+  
+  def addTask(self):
+    with self.lock:
+      self.numTasks += 1
+  
+  # subtasks are parts of a task, e.g. blocks of runs of a large protein, that
+  # only contribute to the worker statistics
+  def completeTask(self, workerStats, isSubtask = False):
+    with self.lock:
+      self.lastProgressTimestamp = time.time()
+      if not isSubtask:
+        self.numCompletedTasks += 1
+      if workerStats.pid is not None:
+        self.workerBusyTime[workerStats.pid] = self.workerBusyTime.get(workerStats.pid, 0.0) + workerStats.busyTime
+        self.workerPeakRSS[workerStats.pid] = max([self.workerPeakRSS.get(workerStats.pid, 0.0), workerStats.peakRSS])
+    for name, value in workerStats.counters.items():
+      self.counters.increment(name, value)
+  
+  def toDict(self):
+    now = time.time()
+    with self.lock:
+      tasksElapsed = max([now - self.tasksStartTimestamp, 1e-9])
+      throughput = self.numCompletedTasks / tasksElapsed
+      eta = (self.numTasks - self.numCompletedTasks) / throughput if throughput > 0 else None
+      workers = [{ 'pid' : pid, 'utilization' : min([1.0, self.workerBusyTime[pid] / tasksElapsed]), 'peak_rss_mb' : self.workerPeakRSS[pid] } for pid in sorted(self.workerBusyTime)]
+      
+      metrics = { 'stage' : self.stage,
+                  'start_timestamp' : self.startTimestamp,
+                  'update_timestamp' : now,
+                  'last_progress_timestamp' : self.lastProgressTimestamp,
+                  'proteins_total' : self.numTasks,
+                  'proteins_completed' : self.numCompletedTasks,
+                  'throughput_proteins_per_s' : throughput,
+                  'eta_s' : eta,
+                  'main_peak_rss_mb' : getPeakRSS("self"),
+                  'workers' : workers }
+      metrics.update(self.counters.toDict())
+    return metrics
+  
+  def write(self):
+    metrics = self.toDict()
+    tmpFile = self.metricsFile + ".tmp"
+    try:
+      with open(tmpFile, 'w') as f:
+        if self.metricsFile.endswith(".prom"):
+          f.write(toPrometheusText(metrics))
+        else:
+          json.dump(metrics, f, indent = 2)
+      if hasattr(os, 'replace'):
+        os.replace(tmpFile, self.metricsFile)
+      else: # python 2
+        os.rename(tmpFile, self.metricsFile)
+    except (IOError, OSError) as e:
+      print("Warning: could not write metrics file %s: %s" % (self.metricsFile, e))
+
+def toPrometheusText(metrics):
+  lines = list()
+  def addMetric(name, helpText, samples, metricType = "gauge"):
+    lines.append("# HELP triqler_%s %s" % (name, helpText))
+    lines.append("# TYPE triqler_%s %s" % (name, metricType))
+    for labels, value in samples:
+      labelText = "{" + ",".join('%s="%s"' % (k, v) for k, v in labels) + "}" if len(labels) > 0 else ""
+      lines.append("triqler_%s%s %s" % (name, labelText, "NaN" if value is None else repr(float(value))))
+  
+  addMetric("stage_info", "Current stage of the Triqler pipeline", [([('stage', metrics['stage'])], 1)])
+  addMetric("start_timestamp_seconds", "Start time of the job in seconds since the epoch", [([], metrics['start_timestamp'])])
+  addMetric("update_timestamp_seconds", "Time of the last update of this file in seconds since the epoch", [([], metrics['update_timestamp'])])
+  addMetric("last_progress_timestamp_seconds", "Time at which the last task finished in seconds since the epoch", [([], metrics['last_progress_timestamp'])])
+  addMetric("proteins_total", "Number of protein posterior tasks submitted in the current stage", [([], metrics['proteins_total'])])
+  addMetric("proteins_completed", "Number of protein posterior tasks completed in the current stage", [([], metrics['proteins_completed'])])
+  addMetric("throughput_proteins_per_second", "Protein posterior tasks completed per second in the current stage", [([], metrics['throughput_proteins_per_s'])])
+  addMetric("eta_seconds", "Estimated time until all protein posterior tasks of the current stage are completed", [([], metrics['eta_s'])])
+  addMetric("main_peak_rss_megabytes", "Peak resident set size of the main process", [([], metrics['main_peak_rss_mb'])])
+  addMetric("worker_utilization_ratio", "Fraction of the time of the current stage that a worker process spent on completed tasks", [([('pid', w['pid'])], w['utilization']) for w in metrics['workers']])
+  addMetric("worker_peak_rss_megabytes", "Peak resident set size of a worker process", [([('pid', w['pid'])], w['peak_rss_mb']) for w in metrics['workers']])
+  for name, helpText in counterDescriptions:
+    addMetric(name + "_total", helpText, [([], metrics[name])], metricType = "counter")
+  return "\n".join(lines) + "\n"
+
+# sets the current stage if a metrics file was requested in
+# params['progressMetrics']
+def setStage(params, stage):
+  if params is not None and params.get('progressMetrics') is not None:
+    params['progressMetrics'].setStage(stage)
+
+def stop(params, stage):
+  if params is not None and params.get('progressMetrics') is not None:
+    params['progressMetrics'].stop(stage)
+
+def unitTest():
+  import tempfile
+  from .multiprocessing_pool import WorkerStats
+  
+  metricsDir = tempfile.mkdtemp()
+  for fileName in ["status.json", "status.prom"]:
+    progressMetrics = ProgressMetrics(os.path.join(metricsDir, fileName), interval = 0.01)
+    progressMetrics.setStage("posteriors")
+    for i in range(4):
+      progressMetrics.addTask()
+    progressMetrics.completeTask(WorkerStats(123, 50.0, 0.5, { 'proteins_not_converged' : 1 }))
+    incrementCounter({ 'progressCounters' : progressMetrics.counters }, 'proteins_not_converged')
+    incrementCounter(dict(), 'proteins_not_converged') # no metrics file requested
+    time.sleep(0.05)
+    progressMetrics.stop("finished")
+    print(open(os.path.join(metricsDir, fileName)).read())
+  
+  metrics = json.load(open(os.path.join(metricsDir, "status.json")))
+  assert metrics['stage'] == "finished" and metrics['proteins_completed'] == 1 and metrics['proteins_total'] == 4
+  assert metrics['proteins_not_converged'] == 2
+  assert 'triqler_proteins_not_converged_total 2.0' in open(os.path.join(metricsDir, "status.prom")).read()
+
+if __name__ == "__main__":
+  unitTest()
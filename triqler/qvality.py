@@ -11,6 +11,9 @@ import sys
 
 import numpy as np
 import bisect
+from scipy.linalg import solve_banded
+
+from .errors import TriqlerError
 
 tao = 2.0 / (1 + np.sqrt(5.0)) # inverse of golden section
 scaleAlpha = 1
@@ -25,24 +28,24 @@ numLambda = 100
 maxLambda = 0.5
 
 # this function returns PEPs in ascending order (lowest PEP first)
-def getQvaluesFromScores(targetScores, decoyScores, includePEPs = False, includeDecoys = False, tdcInput = False, pi0 = 1.0, plotRegressionCurve = False):
+def getQvaluesFromScores(targetScores, decoyScores, includePEPs = False, includeDecoys = False, tdcInput = False, pi0 = 1.0, plotRegressionCurve = False, numBins = 500):
   if type(targetScores) is not np.ndarray:
     targetScores = np.array(targetScores)
   if type(decoyScores) is not np.ndarray:
     decoyScores = np.array(decoyScores)
   
   if len(targetScores) == 0:
-    sys.exit("ERROR: no target hits available for PEP calculation")
+    raise TriqlerError("ERROR: no target hits available for PEP calculation")
   
   if len(decoyScores) == 0:
-    sys.exit("ERROR: no decoy hits available for PEP calculation")
+    raise TriqlerError("ERROR: no decoy hits available for PEP calculation")
   
   targetScores.sort()
   decoyScores.sort()
   allScores = np.concatenate((targetScores, decoyScores))
   allScores.sort()
   
-  medians, negatives, sizes = binData(allScores, decoyScores)
+  medians, negatives, sizes = binData(allScores, decoyScores, numBins)
   medians, negatives, sizes = np.array(medians), np.array(negatives), np.array(sizes)
   
   # sort in descending order, highest score first
@@ -75,9 +78,11 @@ def getQvaluesFromScores(targetScores, decoyScores, includePEPs = False, include
     plt.show()
   return None, probs
   
-def getQvaluesFromPvalues(pvalues, includePEPs = False):
+# rng is used for the bootstrap samples of the pi0 estimation, by default the
+# global numpy random state
+def getQvaluesFromPvalues(pvalues, includePEPs = False, rng = None):
   targetScores = sorted(pvalues)
-  pi0 = estimatePi0(targetScores)
+  pi0 = estimatePi0(targetScores, rng = rng)
   if VERB > 2:
     print("Estimating pi0 = %f" % pi0)
   
@@ -95,23 +100,22 @@ def monotonize(peps):
   return np.minimum(1.0, np.maximum.accumulate(peps))
 
 def binData(allScores, decoyScores, numBins = 500):
-  binEdges = list(map(lambda x : int(np.floor(x)), np.linspace(0, len(allScores), numBins+1)))
-  bins = list()
-  startIdx = 0
-  for endIdx in binEdges[1:]:
-    if startIdx < endIdx:
-      while endIdx < len(allScores) and allScores[endIdx-1] == allScores[endIdx]:
-        endIdx += 1
-      bins.append(allScores[startIdx:endIdx])
-      startIdx = endIdx
-  
-  results = list()
-  for b in bins:
-    m = np.median(b)
-    numNegs = np.searchsorted(decoyScores, b[-1], side = 'right') - np.searchsorted(decoyScores, b[0], side = 'left')
-    numTot = len(b)
-    results.append([m, numNegs, numTot])
-  return zip(*results)
+  binEdges = np.floor(np.linspace(0, len(allScores), numBins+1)).astype(int)
+  binEdges = binEdges[binEdges > 0]
+  
+  # extend bins to the end of a run of tied scores
+  endIdxs = np.searchsorted(allScores, allScores[binEdges - 1], side = 'right')
+  binEdges = np.unique(np.concatenate(([0], endIdxs)))
+  startIdxs, endIdxs = binEdges[:-1], binEdges[1:]
+  
+  sizes = endIdxs - startIdxs
+  
+  # allScores is sorted, so the median is the middle element of each bin, or
+  # the mean of the two middle elements for bins of even size
+  medians = (allScores[startIdxs + (sizes - 1) // 2] + allScores[startIdxs + sizes // 2]) / 2
+  
+  negatives = np.searchsorted(decoyScores, allScores[endIdxs - 1], side = 'right') - np.searchsorted(decoyScores, allScores[startIdxs], side = 'left')
+  return medians, negatives, sizes
 
 def roughnessPenaltyIRLS(medians, negatives, sizes):
   Q, R = initQR(medians)
@@ -121,10 +125,11 @@ def roughnessPenaltyIRLS(medians, negatives, sizes):
   p1 = 1.0 - tao
   p2 = tao
   
-  cv1 = evaluateSlope(medians, negatives, sizes, variables, -scaleAlpha * np.log(p1))
-  cv2 = evaluateSlope(medians, negatives, sizes, variables, -scaleAlpha * np.log(p2))
+  # each evaluation is warm-started from the spline of the previous alpha
+  cv1, variables = evaluateSlope(medians, negatives, sizes, variables, -scaleAlpha * np.log(p1))
+  cv2, variables = evaluateSlope(medians, negatives, sizes, variables, -scaleAlpha * np.log(p2))
   
-  alpha = alphaLinearSearchBA(0.0, 1.0, p1, p2, cv1, cv2, medians, negatives, sizes, variables)
+  alpha, variables = alphaLinearSearchBA(0.0, 1.0, p1, p2, cv1, cv2, medians, negatives, sizes, variables)
   if VERB > 3:
     print("Alpha selected to be", alpha)
   variables = iterativeReweightedLeastSquares(medians, negatives, sizes, variables, alpha)
@@ -141,7 +146,7 @@ def alphaLinearSearchBA(min_p, max_p, p1, p2, cv1, cv2, medians, negatives, size
     p2 = min_p + tao * (max_p - min_p)
     oldCV = cv1
     cv1 = cv2
-    cv2 = evaluateSlope(medians, negatives, sizes, variables, -1*scaleAlpha*np.log(p2))
+    cv2, variables = evaluateSlope(medians, negatives, sizes, variables, -1*scaleAlpha*np.log(p2))
     if VERB > 3:
       print("New point with alpha=", -scaleAlpha*np.log(p2), ", giving slopeScore=", cv2)
   else:
@@ -151,11 +156,11 @@ def alphaLinearSearchBA(min_p, max_p, p1, p2, cv1, cv2, medians, negatives, size
     p1 = min_p + (1 - tao) * (max_p - min_p)
     oldCV = cv2
     cv2 = cv1
-    cv1 = evaluateSlope(medians, negatives, sizes, variables, -1*scaleAlpha*np.log(p1))
+    cv1, variables = evaluateSlope(medians, negatives, sizes, variables, -1*scaleAlpha*np.log(p1))
     if VERB > 3:
       print("New point with alpha=", -scaleAlpha*np.log(p1), ", giving slopeScore=", cv1)
   if (oldCV - min(cv1, cv2)) / oldCV < 1e-5 or abs(p2 - p1) < 1e-10:
-    return -scaleAlpha*np.log(p1) if cv1 < cv2 else -scaleAlpha*np.log(p2)
+    return (-scaleAlpha*np.log(p1) if cv1 < cv2 else -scaleAlpha*np.log(p2)), variables
   return alphaLinearSearchBA(min_p, max_p, p1, p2, cv1, cv2, medians, negatives, sizes, variables)
 
 def evaluateSlope(medians, negatives, sizes, variables, alpha):
@@ -185,17 +190,17 @@ def evaluateSlope(medians, negatives, sizes, variables, alpha):
   if VERB > 3:
     print("mixg=", mixg, ", maxg=", maxg, ", maxBA=", maxSlope, " at ix=", slopeix, ", alpha=", alpha)
   
-  return maxSlope * weightSlope + alpha
+  return maxSlope * weightSlope + alpha, variables
 
 def iterativeReweightedLeastSquares(medians, negatives, sizes, variables, alpha, epsilon = stepEpsilon, maxiter = 50):
   Q, R, g, w, z, gamma, p, gnew = variables
   for it in range(maxiter):
     g = gnew
     p, z, w = calcPZW(g, negatives, sizes)
-    aWiQ = np.multiply((alpha / w)[:,None], Q)
-    M = R + Q.T.dot(aWiQ)
-    gamma = np.linalg.solve(M, Q.T.dot(z))
-    gnew = z - aWiQ.dot(gamma)
+    aWi = alpha / w
+    M = R + bandedQtDQ(Q, aWi)
+    gamma = solve_banded((2, 2), M, bandedQtDot(Q, z), overwrite_ab = True, check_finite = False)
+    gnew = z - aWi * bandedQDot(Q, gamma)
     gnew = np.minimum(gRange, np.maximum(-1*gRange, gnew))
     difference = g - gnew
     step = np.linalg.norm(difference) / len(medians)
@@ -227,20 +232,46 @@ def initg(negatives, sizes):
   gnew = np.log(p / (1-p))
   return g, w, z, gamma, p, gnew
   
+# Q (n x n-2) and R (n-2 x n-2) are stored by their diagonals, Q[k] holds the
+# entries Q[i+k,i] and R is stored in the (2,2) banded format of 
+# scipy.linalg.solve_banded, i.e. R[2-k,i+k] holds the entries R[i,i+k]
 def initQR(medians):
   n = len(medians)
   dx = medians[1:] - medians[:-1]
-  Q = np.zeros((n, n -2))
-  Q[range(n-2), range(n-2)] = 1.0 / dx[:-1]
-  Q[range(1,n-1), range(n-2)] = - 1.0 / dx[:-1] - 1.0 / dx[1:]
-  Q[range(2,n), range(n-2)] = 1.0 / dx[1:]
-  
-  R = np.zeros((n-2, n-2))
-  R[range(n-2), range(n-2)] = (dx[:-1] + dx[1:]) / 3
-  R[range(n-3), range(1,n-2)] = dx[1:-1] / 6
-  R[range(1,n-2), range(n-3)] = dx[1:-1] / 6
+  Q = np.zeros((3, n - 2))
+  Q[0] = 1.0 / dx[:-1]
+  Q[1] = - 1.0 / dx[:-1] - 1.0 / dx[1:]
+  Q[2] = 1.0 / dx[1:]
+  
+  R = np.zeros((5, n - 2))
+  R[2] = (dx[:-1] + dx[1:]) / 3
+  R[1,1:] = dx[1:-1] / 6
+  R[3,:-1] = dx[1:-1] / 6
   return Q, R
 
+# returns Q.T.dot(np.diag(d)).dot(Q) in (2,2) banded format, which is 
+# symmetric and pentadiagonal
+def bandedQtDQ(Q, d):
+  M = np.zeros((5, Q.shape[1]))
+  M[2] = d[:-2] * Q[0]**2 + d[1:-1] * Q[1]**2 + d[2:] * Q[2]**2
+  M[1,1:] = d[1:-2] * Q[1,:-1] * Q[0,1:] + d[2:-1] * Q[2,:-1] * Q[1,1:]
+  M[0,2:] = d[2:-2] * Q[2,:-2] * Q[0,2:]
+  M[3,:-1] = M[1,1:]
+  M[4,:-2] = M[0,2:]
+  return M
+
+# returns Q.T.dot(x)
+def bandedQtDot(Q, x):
+  return Q[0] * x[:-2] + Q[1] * x[1:-1] + Q[2] * x[2:]
+
+# returns Q.dot(x)
+def bandedQDot(Q, x):
+  y = np.zeros(len(x) + 2)
+  y[:-2] += Q[0] * x
+  y[1:-1] += Q[1] * x
+  y[2:] += Q[2] * x
+  return y
+
 def splineEval(scores, medians, variables):
   _, _, g, _, _, gamma, _, _ = variables
   #score = np.exp(score)
@@ -270,41 +301,37 @@ def splineEval(scores, medians, variables):
   
   return scores
 
-def estimatePi0(pvalues, numBoot = 100):
+def estimatePi0(pvalues, numBoot = 100, rng = None):
   pvalues = np.array(pvalues)
-  lambdas, pi0s = list(), list()
   numPvals = len(pvalues)
   
-  for lambdaIdx in range(numLambda + 1):
-    l = ((lambdaIdx + 1.0) /  numLambda) * maxLambda
-    startIdx = np.searchsorted(pvalues, l)
-    Wl = numPvals - startIdx
-    pi0 = Wl / (1.0 - l) / numPvals
-    if pi0 > 0.0:
-      lambdas.append(l)
-      pi0s.append(pi0)
+  lambdas = ((np.arange(numLambda + 1) + 1.0) / numLambda) * maxLambda
+  Wls = numPvals - np.searchsorted(pvalues, lambdas)
+  pi0s = Wls / (1.0 - lambdas) / numPvals
+  lambdas, pi0s = lambdas[pi0s > 0.0], pi0s[pi0s > 0.0]
   
   if len(pi0s) == 0:
     print("Error in the input data: too good separation between target and decoy PSMs.\nImpossible to estimate pi0, setting pi0 = 1")
     return 1.0
   
-  minPi0 = min(pi0s)
+  minPi0 = np.min(pi0s)
   
-  mse = [0.0] * len(pi0s)
-  # Examine which lambda level is most stable under bootstrap
+  # Examine which lambda level is most stable under bootstrap, evaluating all
+  # lambdas at once
+  mse = np.zeros(len(pi0s))
+  Wls = numPvals - np.searchsorted(pvalues, lambdas)
   for boot in range(numBoot):
-    pBoot = bootstrap(pvalues)
+    pBoot = bootstrap(pvalues, rng = rng)
     n = len(pBoot)
-    for idx, l in enumerate(lambdas):
-      startIdx = np.searchsorted(pvalues, l)
-      Wl = numPvals - startIdx
-      pi0Boot = Wl / n / (1 - l)
-      # Estimated mean-squared error.
-      mse[idx] += (pi0Boot - minPi0) * (pi0Boot - minPi0)
+    pi0sBoot = Wls / n / (1.0 - lambdas)
+    # Estimated mean-squared error.
+    mse += (pi0sBoot - minPi0) * (pi0sBoot - minPi0)
   return max([min([pi0s[np.argmin(mse)], 1.0]), 0.0])
 
-def bootstrap(allVals, maxSize = 1000):
-  return sorted(np.random.choice(allVals, min([len(allVals), maxSize]), replace = False))
+def bootstrap(allVals, maxSize = 1000, rng = None):
+  if rng is None:
+    rng = np.random
+  return sorted(rng.choice(allVals, min([len(allVals), maxSize]), replace = False))
   
 def getQvaluesFromPvaluesQvality(pvalues, includePEPs = False):
   fdp, pvalFile = tempfile.mkstemp()
@@ -389,7 +416,7 @@ def countBelowFDR(peps, qvalThreshold):
 
 def getPEPFromScoreLambda(targetScores, decoyScores):
   if len(decoyScores) == 0:
-    sys.exit("ERROR: No decoy hits found, check if the correct decoy prefix was specified with the --decoy_pattern flag")
+    raise TriqlerError("ERROR: No decoy hits found, check if the correct decoy prefix was specified with the --decoy_pattern flag")
   
   targetScores = np.array(targetScores)
   decoyScores = np.array(decoyScores)
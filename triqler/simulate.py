@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+'''
+Generate synthetic Triqler input files with known ground truth, following the
+generative model used by Triqler. Rows are written one protein at a time, so
+that arbitrarily large files can be generated with constant memory usage. The
+output is deterministic for a given seed.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+
+import numpy as np
+
+from . import parsers
+from .triqler import __version__, __copyright__
+
+def main():
+  print('Triqler.simulate version %s\n%s' % (__version__, __copyright__))
+  print('Issued command:', os.path.basename(__file__) + " " + " ".join(map(str, sys.argv[1:])))
+  
+  args, params = parseArgs()
+  
+  simulateTriqlerInput(args.out_file, args.truth_file, params)
+
+def parseArgs():
+  import argparse
+  apars = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  
+  apars.add_argument('--out_file', default = "triqler_input.tsv", metavar='OUT',
+                     help='Path to triqler input file (writing in TSV format).')
+  
+  apars.add_argument('--truth_file', default = "", metavar='T_OUT',
+                     help='Path to ground truth file with the true log2 protein ratio per treatment group. By default, this is OUT with suffix .truth.tsv.')
+  
+  apars.add_argument('--num_proteins', type=int, default=1000, metavar='N',
+                     help='Number of target proteins.')
+  
+  apars.add_argument('--num_decoys', type=int, default=-1, metavar='N',
+                     help='Number of decoy proteins. By default, this is equal to the number of target proteins.')
+  
+  apars.add_argument('--num_runs', type=int, default=9, metavar='N',
+                     help='Number of runs, divided as equally as possible over the treatment groups.')
+  
+  apars.add_argument('--num_groups', type=int, default=3, metavar='N',
+                     help='Number of treatment groups.')
+  
+  apars.add_argument('--diff_exp_fraction', type=float, default=0.1, metavar='F',
+                     help='Fraction of target proteins that are differentially abundant in one of the treatment groups.')
+  
+  apars.add_argument('--fold_change', type=float, default=1.0, metavar='F',
+                     help='Absolute log2 fold change of differentially abundant proteins.')
+  
+  apars.add_argument('--peptide_zipf_exponent', type=float, default=1.8, metavar='A',
+                     help='Exponent of the heavy-tailed Zipf distribution of the number of peptides per protein.')
+  
+  apars.add_argument('--max_peptides', type=int, default=200, metavar='N',
+                     help='Maximum number of peptides per protein.')
+  
+  apars.add_argument('--skip_link_pep',
+                     help='Write the simple input format without spectrumId, linkPEP and featureClusterId columns.',
+                     action='store_true')
+  
+  apars.add_argument('--decoy_pattern', default = "decoy_", metavar='P',
+                     help='Prefix for decoy proteins.')
+  
+  apars.add_argument('--seed', type=int, default=1, metavar='S',
+                     help='Seed for the random number generator.')
+  
+  # ------------------------------------------------
+  args = apars.parse_args()
+  
+  if len(args.truth_file) == 0:
+    args.truth_file = args.out_file + ".truth.tsv"
+  
+  params = getDefaultSimulationParams()
+  params['numProteins'] = args.num_proteins
+  params['numDecoys'] = args.num_decoys if args.num_decoys >= 0 else args.num_proteins
+  params['numRuns'] = args.num_runs
+  params['numGroups'] = args.num_groups
+  params['diffExpFraction'] = args.diff_exp_fraction
+  params['foldChange'] = args.fold_change
+  params['peptideZipfExponent'] = args.peptide_zipf_exponent
+  params['maxPeptides'] = args.max_peptides
+  params['simpleOutputFormat'] = args.skip_link_pep
+  params['decoyPattern'] = args.decoy_pattern
+  params['seed'] = args.seed
+  
+  if params['numGroups'] < 2:
+    sys.exit("ERROR: --num_groups should be >= 2")
+  
+  if params['numRuns'] < 2*params['numGroups']:
+    sys.exit("ERROR: --num_runs should be at least twice --num_groups")
+  
+  if params['peptideZipfExponent'] <= 1.0:
+    sys.exit("ERROR: --peptide_zipf_exponent should be > 1.0")
+  
+  return args, params
+
+# hyperparameters of the generative model, all in log10 space. The values are
+# in the range of the estimates on the iPRG2016 data set
+def getDefaultSimulationParams():
+  params = dict()
+  params['muDetect'], params['sigmaDetect'] = 4.5, 0.3
+  params['muXIC'], params['sigmaXIC'] = 5.0, 0.7
+  params['sigmaFeatureDiff'] = 0.07
+  params['sigmaInGroup'] = 0.03
+  params['secondChargeStateProb'] = 0.3
+  params['incorrectIdentProb'] = 0.1 # fraction of target PSMs that are incorrect
+  params['correctScoreShift'] = 3.0 # search score difference between correct and incorrect PSMs
+  params['matchBetweenRunsProb'] = 0.5 # fraction of quantifications transferred from another run
+  params['meanLinkPEP'] = 0.1
+  return params
+
+def getRunsAndConditions(numRuns, numGroups):
+  groupIdxs = np.arange(numRuns) * numGroups // numRuns
+  return [("run%d" % (runIdx+1), "%d:group%d" % (groupIdx+1, groupIdx+1)) for runIdx, groupIdx in enumerate(groupIdxs)], groupIdxs
+
+def simulateTriqlerInput(triqlerInputFile, truthFile, params):
+  rng = np.random.RandomState(params['seed'])
+  runConds, groupIdxs = getRunsAndConditions(params['numRuns'], params['numGroups'])
+  
+  writer = parsers.getTsvWriter(triqlerInputFile)
+  if params['simpleOutputFormat']:
+    writer.writerow(parsers.TriqlerSimpleInputRowHeaders)
+  else:
+    writer.writerow(parsers.TriqlerInputRowHeaders)
+  
+  truthWriter = parsers.getTsvWriter(truthFile)
+  truthWriter.writerow(["protein", "num_peptides", "diff_exp"] + ["log2_ratio_group%d" % (groupIdx+1) for groupIdx in range(params['numGroups'])])
+  
+  # targets and decoys are interleaved, so that any prefix of the output is a
+  # representative sample
+  numProteins = params['numProteins'] + params['numDecoys']
+  isDecoys = np.zeros(numProteins, dtype = bool)
+  isDecoys[rng.choice(numProteins, params['numDecoys'], replace = False)] = True
+  
+  counters = { 'peptide' : 0, 'spectrum' : 0, 'featureCluster' : 0, 'rows' : 0 }
+  targetIdx, decoyIdx = 0, 0
+  for proteinIdx, isDecoy in enumerate(isDecoys):
+    if proteinIdx % 100000 == 0:
+      print("  Simulating protein", proteinIdx, "of", numProteins)
+  
+    if isDecoy:
+      decoyIdx += 1
+      protein = params['decoyPattern'] + "protein%d" % decoyIdx
+    else:
+      targetIdx += 1
+      protein = "protein%d" % targetIdx
+  
+    numPeptides = min([rng.zipf(params['peptideZipfExponent']), params['maxPeptides']])
+    log10GroupRatios = simulateGroupRatios(isDecoy, params, rng)
+    rows = simulateProteinRows(protein, isDecoy, numPeptides, log10GroupRatios[groupIdxs], runConds, counters, params, rng)
+    writer.writerows(rows)
+    counters['rows'] += len(rows)
+  
+    if not isDecoy:
+      truthWriter.writerow([protein, numPeptides, int(np.any(log10GroupRatios != 0.0))] + ["%.4f" % (x / np.log10(2)) for x in log10GroupRatios])
+  
+  print("Wrote", counters['rows'], "rows for", params['numProteins'], "target and", params['numDecoys'], "decoy proteins to", triqlerInputFile)
+  print("Wrote ground truth to", truthFile)
+
+# returns the true log10 protein ratio per treatment group, differentially
+# abundant proteins are up- or downregulated in a single treatment group
+def simulateGroupRatios(isDecoy, params, rng):
+  log10GroupRatios = np.zeros(params['numGroups'])
+  if not isDecoy and rng.random_sample() < params['diffExpFraction']:
+    sign = 1.0 if rng.random_sample() < 0.5 else -1.0
+    log10GroupRatios[rng.randint(params['numGroups'])] = sign * params['foldChange'] * np.log10(2)
+  return log10GroupRatios
+
+# hyperbolic secant distributed samples, matching hyperparameters.funcHypsec
+def hypsecRandom(sigma, size, rng):
+  return sigma * np.log(np.tan(np.pi / 2 * rng.uniform(np.nextafter(0, 1), 1.0, size)))
+
+def simulateProteinRows(protein, isDecoy, numPeptides, log10RunGroupRatios, runConds, counters, params, rng):
+  numRuns = len(runConds)
+  log10ProteinRatios = log10RunGroupRatios + rng.normal(0.0, params['sigmaInGroup'], numRuns)
+  
+  numCharges = 1 + (rng.random_sample(numPeptides) < params['secondChargeStateProb'])
+  peptides = np.repeat(getPeptideSequences(counters['peptide'], numPeptides, rng), numCharges)
+  counters['peptide'] += numPeptides
+  charges = np.concatenate([np.arange(2, 2 + n) for n in numCharges])
+  numFeatures = len(charges)
+  
+  # log10 intensity = ionization efficiency + protein ratio + feature noise,
+  # where the signal of a peptide is split over its charge states and
+  # missing values follow the logit detection curve
+  log10IonEffs = np.repeat(rng.normal(params['muXIC'], params['sigmaXIC'], numPeptides), numCharges) - np.log10(numCharges)[np.repeat(np.arange(numPeptides), numCharges)]
+  log10Intensities = log10IonEffs[:, np.newaxis] + log10ProteinRatios + hypsecRandom(params['sigmaFeatureDiff'], (numFeatures, numRuns), rng)
+  isDetected = rng.random_sample((numFeatures, numRuns)) < 0.5 + 0.5 * np.tanh((log10Intensities - params['muDetect']) / params['sigmaDetect'])
+  
+  # incorrect identifications have search scores from the same distribution as
+  # decoys and an intensity unrelated to the protein ratio
+  isCorrect = (rng.random_sample((numFeatures, numRuns)) >= params['incorrectIdentProb']) & (not isDecoy)
+  searchScores = rng.normal(0.0, 1.0, (numFeatures, numRuns)) + isCorrect * params['correctScoreShift']
+  incorrectIntensities = rng.normal(params['muXIC'], params['sigmaXIC'], (numFeatures, numRuns))
+  log10Intensities = np.where(isCorrect, log10Intensities, incorrectIntensities)
+  
+  # quantifications transferred by match-between-runs share the spectrumId and
+  # search score of the first run with its own identification
+  hasDetection = np.any(isDetected, axis = 1)
+  firstRunIdxs = np.argmax(isDetected, axis = 1)
+  spectrumIds = counters['spectrum'] + 1 + np.arange(numFeatures * numRuns).reshape(numFeatures, numRuns)
+  counters['spectrum'] += numFeatures * numRuns
+  linkPEPs = np.zeros((numFeatures, numRuns))
+  isTransferred = rng.random_sample((numFeatures, numRuns)) < params['matchBetweenRunsProb']
+  if not params['simpleOutputFormat']:
+    isTransferred[np.arange(numFeatures), firstRunIdxs] = False
+    firstRunSpectrumIds = spectrumIds[np.arange(numFeatures), firstRunIdxs]
+    firstRunScores = searchScores[np.arange(numFeatures), firstRunIdxs]
+    spectrumIds = np.where(isTransferred, firstRunSpectrumIds[:, np.newaxis], spectrumIds)
+    searchScores = np.where(isTransferred, firstRunScores[:, np.newaxis], searchScores)
+    linkPEPs[isTransferred] = rng.beta(1.0, 1.0 / params['meanLinkPEP'] - 1.0, np.count_nonzero(isTransferred))
+  
+  featureClusterIds = counters['featureCluster'] + np.cumsum(hasDetection)
+  counters['featureCluster'] += np.count_nonzero(hasDetection)
+  
+  featureIdxs, runIdxs = np.nonzero(isDetected)
+  runs = [runConds[runIdx][0] for runIdx in runIdxs]
+  conditions = [runConds[runIdx][1] for runIdx in runIdxs]
+  scores = ["%.4f" % x for x in searchScores[featureIdxs, runIdxs]]
+  intensities = ["%.2f" % x for x in 10**log10Intensities[featureIdxs, runIdxs]]
+  # numpy scalars are slow to convert to strings by the csv writer
+  peptides, charges = peptides[featureIdxs].tolist(), charges[featureIdxs].tolist()
+  if params['simpleOutputFormat']:
+    return [[run, condition, charge, score, intensity, peptide, protein] for run, condition, charge, score, intensity, peptide in zip(runs, conditions, charges, scores, intensities, peptides)]
+  else:
+    linkPEPs = ["%.4f" % x for x in linkPEPs[featureIdxs, runIdxs]]
+    return [[run, condition, charge, spectrumId, linkPEP, featureClusterId, score, intensity, peptide, protein] for run, condition, charge, spectrumId, linkPEP, featureClusterId, score, intensity, peptide in zip(runs, conditions, charges, spectrumIds[featureIdxs, runIdxs].tolist(), linkPEPs, featureClusterIds[featureIdxs].tolist(), scores, intensities, peptides)]
+
+aminoAcids = np.array(list("ACDEFGHILMNPQSTVWY")) # excluding K and R, which are used as flanking residues
+
+# the peptide index is encoded in the sequence, which guarantees that no
+# peptides are shared between proteins
+def getPeptideSequences(firstPeptideIdx, numPeptides, rng, prefixLength = 4):
+  prefixes = aminoAcids[rng.randint(len(aminoAcids), size = (numPeptides, prefixLength))]
+  peptides = list()
+  for peptideIdx, prefix in zip(range(firstPeptideIdx, firstPeptideIdx + numPeptides), prefixes):
+    suffix = ""
+    while True:
+      suffix += aminoAcids[peptideIdx % len(aminoAcids)]
+      peptideIdx //= len(aminoAcids)
+      if peptideIdx == 0:
+        break
+    peptides.append("K." + "".join(prefix) + suffix + "K.A")
+  return peptides
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+'''
+Measures the startup time of the Triqler command line entry points and of the
+imports needed by the worker processes, each in a fresh interpreter. The
+median time in excess of the startup time of the bare interpreter is compared
+to a budget per command, so that regressions, e.g. a new module-level import
+of scipy or matplotlib, are caught before a release:
+
+  python -m triqler.startup_benchmark
+
+Exits with an error if any command exceeds its budget.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import subprocess
+from timeit import default_timer as timer
+
+# (description, interpreter arguments, budget in seconds on top of the bare
+# interpreter startup time)
+startupCommands = [
+  ("triqler --help", ["-m", "triqler", "--help"], 0.15),
+  ("triqler batch --help", ["-m", "triqler", "batch", "--help"], 0.15),
+  ("triqler.distribution.plot_posteriors --help", ["-m", "triqler.distribution.plot_posteriors", "--help"], 0.15),
+  ("triqler.distribution.plot_hyperparameter_fits --help", ["-m", "triqler.distribution.plot_hyperparameter_fits", "--help"], 0.15),
+  ("triqler.convert.maxquant --help", ["-m", "triqler.convert.maxquant", "--help"], 0.15),
+  ("triqler.convert.quandenser --help", ["-m", "triqler.convert.quandenser", "--help"], 0.15),
+  ("triqler.convert.dinosaur --help", ["-m", "triqler.convert.dinosaur", "--help"], 0.15),
+  ("grid engine worker imports", ["-c", "import triqler.pgm, triqler.multiprocessing_pool"], 0.5),
+]
+
+def main():
+  args = parseArgs()
+  
+  baseline = getMedianTime(["-c", "pass"], args.repeats)
+  print("Bare interpreter startup: %.3f s" % baseline)
+  print("  %-55s %10s %10s" % ("command", "excess (s)", "budget (s)"))
+  
+  overBudget = list()
+  for description, interpreterArgs, budget in startupCommands:
+    excess = getMedianTime(interpreterArgs, args.repeats) - baseline
+    print("  %-55s %10.3f %10.3f%s" % (description, excess, budget, "  OVER BUDGET" if excess > budget else ""))
+    if excess > budget:
+      overBudget.append(description)
+    
+    if args.slowest_imports > 0:
+      printSlowestImports(interpreterArgs, args.slowest_imports)
+  
+  if len(overBudget) > 0:
+    sys.exit("ERROR: startup time budget exceeded for: %s" % ", ".join(overBudget))
+
+def parseArgs():
+  import argparse
+  apars = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  
+  apars.add_argument('--repeats', type=int, default=7, metavar='N',
+                     help='Number of times each command is timed, the median is reported.')
+  
+  apars.add_argument('--slowest_imports', type=int, default=0, metavar='N',
+                     help='Print the N modules with the largest cumulative import time for each command, requires Python 3.7 or later.')
+  
+  args = apars.parse_args()
+  
+  if args.repeats < 1:
+    sys.exit("ERROR: --repeats should be >= 1")
+  
+  return args
+
+def getMedianTime(interpreterArgs, repeats):
+  times = list()
+  with open(os.devnull, 'w') as devnull:
+    for _ in range(repeats):
+      start = timer()
+      subprocess.call([sys.executable] + interpreterArgs, stdout = devnull, stderr = devnull)
+      times.append(timer() - start)
+  return sorted(times)[len(times) // 2]
+
+def printSlowestImports(interpreterArgs, numImports):
+  process = subprocess.Popen([sys.executable, "-X", "importtime"] + interpreterArgs, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+  _, importTimes = process.communicate()
+  
+  cumulativeTimes = list()
+  for line in importTimes.splitlines():
+    cols = line.split("|")
+    if line.startswith("import time:") and len(cols) == 3 and cols[1].strip().isdigit():
+      cumulativeTimes.append((int(cols[1]) / 1e6, cols[2].strip()))
+  
+  for cumulativeTime, module in sorted(cumulativeTimes, reverse = True)[:numImports]:
+    print("      %8.3f s  %s" % (cumulativeTime, module))
+
+if __name__ == "__main__":
+  main()
@@ -16,35 +16,68 @@ import csv
 import multiprocessing
 import warnings
 
-import numpy as np
+from . import perf_report
+from . import progress_metrics
+from .errors import TriqlerError
+from .lazy_import import lazyImport
 
-from . import parsers
-from . import qvality
-from . import hyperparameters
-from . import multiprocessing_pool as pool
-from . import pgm
-from . import diff_exp
+np = lazyImport("numpy")
+parsers = lazyImport(".parsers", __package__)
+qvality = lazyImport(".qvality", __package__)
+hyperparameters = lazyImport(".hyperparameters", __package__)
+pool = lazyImport(".multiprocessing_pool", __package__)
+pgm = lazyImport(".pgm", __package__)
+laplace = lazyImport(".laplace", __package__)
+diff_exp = lazyImport(".diff_exp", __package__)
 
 def main():
   print('Triqler version %s\n%s' % (__version__, __copyright__))
   print('Issued command:', os.path.basename(__file__) + " " + " ".join(map(str, sys.argv[1:])))
   
+  if len(sys.argv) > 1 and sys.argv[1] == "batch":
+    from . import batch
+    batch.main(sys.argv[2:])
+    return
+  
   args, params = parseArgs()
   
   params['warningFilter'] = "ignore"
   with warnings.catch_warnings():
     warnings.simplefilter(params['warningFilter'])
-    runTriqler(params, args.in_file, args.out_file)
+    try:
+      runFromArgs(args, params)
+    except TriqlerError as e:
+      sys.exit(str(e))
+
+# runs the conversion, if requested, and the Triqler pipeline for the parsed
+# command line arguments
+def runFromArgs(args, params):
+  if len(params['metricsOutput']) > 0:
+    params['progressMetrics'] = progress_metrics.ProgressMetrics(params['metricsOutput'], params['metricsInterval'])
+    params['progressCounters'] = params['progressMetrics'].counters
+  
+  try:
+    if params['converter'] is not None:
+      triqlerInputFile, triqlerInputRows = convertToTriqlerInputRows(args, params)
+      runTriqler(params, triqlerInputFile, args.out_file, triqlerInputRows)
+    else:
+      runTriqler(params, args.in_file, args.out_file)
+    progress_metrics.stop(params, "finished")
+  except BaseException:
+    progress_metrics.stop(params, "failed")
+    raise
 
-def parseArgs():
+# argv defaults to the command line arguments, i.e. sys.argv[1:]
+def parseArgs(argv = None, prog = None):
   import argparse
-  apars = argparse.ArgumentParser(
+  apars = argparse.ArgumentParser(prog = prog,
       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-  apars.add_argument('in_file', default=None, metavar = "IN_FILE",
+  apars.add_argument('in_file', default=None, metavar = "IN_FILE", nargs='?',
                      help='''List of PSMs with abundances (not log transformed!) 
                              and search engine score. See README for a detailed 
-                             description of the columns.
+                             description of the columns. Can be omitted if one 
+                             of the --from_* options is used.
                           ''')
   
   apars.add_argument('--out_file', default = "proteins.tsv", metavar='OUT', 
@@ -66,6 +99,12 @@ def parseArgs():
   apars.add_argument('--num_threads', type=int, default=multiprocessing.cpu_count(), metavar='N', 
                      help='Number of threads, by default this is equal to the number of CPU cores available on the device.')
   
+  apars.add_argument('--executor', default = 'process', metavar='X', choices = pool.executorTypes,
+                     help='Backend that evaluates the protein posteriors with --num_threads workers: "process" uses a multiprocessing pool of worker processes, "thread" a pool of threads in the main process, which avoids copying the data to the workers, "serial" evaluates all proteins in the main thread, e.g. for profiling and debugging, and "futures" uses a concurrent.futures process pool (Python 3.7 or later).')
+  
+  apars.add_argument('--start_method', default = None, metavar='S', choices = ['fork', 'forkserver', 'spawn'],
+                     help='Start method of the worker processes of the "process" and "futures" executors. By default, the platform default is used.')
+  
   apars.add_argument('--ttest',
                      help='Use t-test for evaluating differential expression instead of posterior probabilities.',
                      action='store_true')
@@ -83,8 +122,67 @@ def parseArgs():
   apars.add_argument('--write_fold_change_posteriors', default = '', metavar='F_OUT',
                      help='Write raw data of fold change posteriors to the specified file in TSV format.')
   
+  apars.add_argument('--perf_report', default = '', metavar='PERF_OUT',
+                     help='Write wall clock time, CPU time, peak memory usage and item counts per pipeline stage to the specified file in JSON format and print a summary.')
+  
+  apars.add_argument('--metrics_file', default = '', metavar='METRICS_OUT',
+                     help='Periodically rewrite the specified file with the current stage, the number of completed proteins, throughput, estimated time remaining, utilization and peak memory usage of the worker processes and the number of proteins that did not converge. The file is written in the Prometheus text format if its name ends with .prom, e.g. for the textfile collector of the node exporter, and in JSON format otherwise.')
+  
+  apars.add_argument('--metrics_interval', type=float, default=10.0, metavar='T',
+                     help='Number of seconds between updates of --metrics_file.')
+  
+  apars.add_argument('--engine', default = 'grid', metavar='E', choices = ['grid', 'laplace'],
+                     help='Posterior engine. The grid engine calculates all posteriors on a dense grid. The laplace engine approximates the run-level posteriors by normal distributions and calculates the treatment group posteriors in closed form, which is faster but approximate; proteins with run-level posteriors that deviate from their normal approximation by more than --laplace_max_run_deviation, or that are skewed, are still processed by the grid engine.')
+  
+  apars.add_argument('--laplace_max_skewness', type=float, default=0.5, metavar='S',
+                     help='Maximum absolute skewness of the run-level posteriors of a protein for the laplace engine to use the normal approximation.')
+  apars.add_argument('--laplace_max_run_deviation', type=float, default=0.05, metavar='D',
+                     help='Maximum total variation distance between a run-level posterior and its normal approximation for the laplace engine to use the normal approximation for the protein.')
+  
+  apars.add_argument('--coarse_grid_step', type=float, default=0.0, metavar='S',
+                     help='Locate the posteriors on a coarse grid with spacing S in log10 units, e.g. 0.05, and only evaluate the region holding the posterior mass at full resolution. By default, all posteriors are evaluated on the full resolution grid.')
+  
+  apars.add_argument('--engine_check', type=int, default=20, metavar='N',
+                     help='Number of proteins for which the results of the laplace engine or --coarse_grid_step are compared to the exact grid engine, discrepancies are reported. Set to 0 to skip the check.')
+  
+  apars.add_argument('--split_protein_cost', type=int, default=50000, metavar='C',
+                     help='Distribute the runs and treatment groups of proteins with at least C peptides x runs over the worker processes, so that very large proteins do not delay the end of the run. Set to 0 to process every protein in a single worker. Not used in combination with --coarse_grid_step.')
+  
+  apars.add_argument('--max_chunk_memory', type=float, default=256.0, metavar='M',
+                     help='Maximum memory in MB used by each worker for evaluating the likelihoods of the imputed values of a protein. Proteins with many peptides and runs are processed in chunks of peptides and runs that fit in this budget; the results do not depend on it.')
+  
+  apars.add_argument('--hyperparameter_sample', type=int, default=0, metavar='N', 
+                     help='Estimate the hyperparameters on a stratified random sample of proteins, starting with N proteins per sample and doubling until the estimates on disjoint samples are stable. By default, all proteins are used.')
+  
+  apars.add_argument('--hyperparameter_tolerance', type=float, default=0.05, metavar='T', 
+                     help='Maximum relative deviation of the hyperparameters between disjoint protein samples for --hyperparameter_sample.')
+  
+  converterNamed = apars.add_argument_group('converter arguments', 'Convert the output of a quantification package directly to Triqler input rows in memory instead of reading IN_FILE.')
+  
+  converterNamed.add_argument('--from_maxquant', default = '', metavar='EVIDENCE',
+                     help='MaxQuant evidence.txt file.')
+  
+  converterNamed.add_argument('--from_quandenser', default = '', metavar='CLUSTERS',
+                     help='Quandenser output file with feature groups, requires --psm_files.')
+  
+  converterNamed.add_argument('--from_dinosaur', default = '', metavar='MAP_FILES',
+                     help='Files containing the mapping of scan numbers to precursor information from the add-dinosaur-precursors script, separated by commas, requires --psm_files.')
+  
+  converterNamed.add_argument('--file_list_file', default = '', metavar='L', 
+                     help='Simple text file with spectrum file names in first column and condition in second column.')
+  
+  converterNamed.add_argument('--psm_files', default = '', metavar='TARGET,DECOY', 
+                     help='Percolator PSM output files, separated commas. Both target and decoy output files are needed, with the target file(s) specified first.')
+  
+  converterNamed.add_argument('--skip_normalization',
+                     help='Skip retention-time based intensity normalization.',
+                     action='store_true')
+  
+  converterNamed.add_argument('--write_triqler_input', default = '', metavar='TRIQLER_IN',
+                     help='Also write the converted rows to the specified Triqler input file.')
+  
   # ------------------------------------------------
-  args = apars.parse_args()
+  args = apars.parse_args(argv)
   
   params = dict()
   params['warningFilter'] = "default"
@@ -93,29 +191,131 @@ def parseArgs():
   params['minSamples'] = args.min_samples
   params['decoyPattern'] = args.decoy_pattern
   params['numThreads'] = args.num_threads
+  params['executor'] = args.executor
+  params['startMethod'] = args.start_method
   params['writeSpectrumQuants'] = args.write_spectrum_quants
   params['proteinPosteriorsOutput'] = args.write_protein_posteriors
   params['groupPosteriorsOutput'] = args.write_group_posteriors
   params['foldChangePosteriorsOutput'] = args.write_fold_change_posteriors
+  params['perfReportOutput'] = args.perf_report
+  params['metricsOutput'] = args.metrics_file
+  params['metricsInterval'] = args.metrics_interval
+  params['hyperparameterSample'] = args.hyperparameter_sample
+  params['hyperparameterTolerance'] = args.hyperparameter_tolerance
+  params['engine'] = args.engine
+  params['laplaceMaxSkewness'] = args.laplace_max_skewness
+  params['laplaceMaxRunDeviation'] = args.laplace_max_run_deviation
+  params['coarseGridStep'] = args.coarse_grid_step
+  params['engineCheckSample'] = args.engine_check
+  params['maxChunkMemory'] = args.max_chunk_memory
+  params['splitProteinCost'] = args.split_protein_cost
   params['returnPosteriors'] = len(params['proteinPosteriorsOutput']) > 0 or len(params['groupPosteriorsOutput']) > 0 or len(params['foldChangePosteriorsOutput']) > 0
   
+  converters = [(name, inFile) for name, inFile in [('maxquant', args.from_maxquant), ('quandenser', args.from_quandenser), ('dinosaur', args.from_dinosaur)] if len(inFile) > 0]
+  params['converter'] = converters[0][0] if len(converters) > 0 else None
+  if len(converters) > 1:
+    sys.exit("ERROR: only one of --from_maxquant, --from_quandenser and --from_dinosaur can be specified")
+  elif len(converters) == 0 and args.in_file is None:
+    sys.exit("ERROR: IN_FILE or one of --from_maxquant, --from_quandenser and --from_dinosaur should be specified")
+  elif len(converters) == 1:
+    if args.in_file is not None:
+      sys.exit("ERROR: IN_FILE cannot be combined with --from_%s" % params['converter'])
+    if len(args.file_list_file) == 0:
+      sys.exit("ERROR: --from_%s requires --file_list_file" % params['converter'])
+    if params['converter'] != 'maxquant' and len(args.psm_files) == 0:
+      sys.exit("ERROR: --from_%s requires --psm_files" % params['converter'])
+  
   if params['minSamples'] < 2:
     sys.exit("ERROR: --min_samples should be >= 2")
   
+  if params['hyperparameterSample'] < 0:
+    sys.exit("ERROR: --hyperparameter_sample should be >= 0")
+  
+  if params['metricsInterval'] <= 0.0:
+    sys.exit("ERROR: --metrics_interval should be > 0")
+  
+  if params['coarseGridStep'] < 0.0:
+    sys.exit("ERROR: --coarse_grid_step should be >= 0")
+  
+  if params['laplaceMaxRunDeviation'] <= 0.0:
+    sys.exit("ERROR: --laplace_max_run_deviation should be > 0")
+  
+  if params['engineCheckSample'] < 0:
+    sys.exit("ERROR: --engine_check should be >= 0")
+  
+  if params['maxChunkMemory'] <= 0.0:
+    sys.exit("ERROR: --max_chunk_memory should be > 0")
+  
+  if params['splitProteinCost'] < 0:
+    sys.exit("ERROR: --split_protein_cost should be >= 0")
+  
+  if params['startMethod'] is not None and params['executor'] not in ['process', 'futures']:
+    sys.exit("ERROR: --start_method can only be used with --executor process or futures")
+  
   return args, params
   
-def runTriqler(params, triqlerInputFile, triqlerOutputFile):  
+# converts the output of a quantification package to Triqler input rows in
+# memory, returns the file name used as prefix for the intermediate files
+def convertToTriqlerInputRows(args, params):
+  from .convert import helpers
+  
+  progress_metrics.setStage(params, "converting")
+  
+  convertParams = dict()
+  convertParams['skipNormalization'] = args.skip_normalization
+  convertParams['plotScatter'] = False
+  convertParams['numThreads'] = params['numThreads']
+  if params['converter'] == 'maxquant':
+    from .convert import maxquant
+    convertParams['simpleOutputFormat'] = True
+    convertParams['skipMBR'] = False
+    triqlerInputFile = args.from_maxquant
+    triqlerInputRows = maxquant.convertMqToTriqlerInputRows(args.file_list_file, args.from_maxquant, convertParams)
+  elif params['converter'] == 'quandenser':
+    from .convert import quandenser
+    convertParams['simpleOutputFormat'] = False
+    convertParams['retainUnidentified'] = False
+    triqlerInputFile = args.from_quandenser
+    triqlerInputRows = quandenser.convertQuandenserToTriqlerInputRows(args.file_list_file, args.from_quandenser, args.psm_files.split(","), convertParams)
+  elif params['converter'] == 'dinosaur':
+    from .convert import dinosaur
+    convertParams['simpleOutputFormat'] = True
+    convertParams['skipMBR'] = True
+    triqlerInputFile = args.from_dinosaur.split(",")[0]
+    triqlerInputRows = dinosaur.convertDinosaurToTriqlerInputRows(args.file_list_file, args.from_dinosaur.split(","), args.psm_files.split(","), convertParams)
+  
+  if len(args.write_triqler_input) > 0:
+    triqlerInputFile = args.write_triqler_input
+    triqlerInputRows = list(triqlerInputRows)
+    print("Writing Triqler input file:", triqlerInputFile)
+    helpers.writeTriqlerInputRows(triqlerInputFile, triqlerInputRows, convertParams)
+  
+  params['hasLinkPEPs'] = not convertParams['simpleOutputFormat']
+  return triqlerInputFile, parsers.prepareTriqlerInputRows(triqlerInputRows, params['hasLinkPEPs'])
+
+# if triqlerInputRows is given, e.g. from convertToTriqlerInputRows, these are
+# used instead of parsing triqlerInputFile and params['hasLinkPEPs'] should be 
+# set. The intermediate files are then written with triqlerInputFile as prefix
+def runTriqler(params, triqlerInputFile, triqlerOutputFile, triqlerInputRows = None):  
   from timeit import default_timer as timer
 
   start = timer()
-
-  if not os.path.isfile(triqlerInputFile):
-    sys.exit("Could not locate input file %s. Check if the path is correct." % triqlerInputFile)
   
-  params['hasLinkPEPs'] = parsers.hasLinkPEPs(triqlerInputFile)
-  if triqlerInputFile.endswith(".pqr.tsv"):
-    params['fileList'], params['groups'], params['groupLabels'], peptQuantRows = parsers.parsePeptideQuantFile(triqlerInputFile)
+  if len(params.get('perfReportOutput', '')) > 0:
+    params['perfReport'] = perf_report.PerfReport()
+  
+  if triqlerInputRows is not None:
+    peptQuantRowFile = triqlerInputFile + ".pqr.tsv"
+    peptQuantRows = convertTriqlerInputToPeptQuantRows(triqlerInputFile, peptQuantRowFile, params, triqlerInputRows)
+  elif not os.path.isfile(triqlerInputFile):
+    raise TriqlerError("Could not locate input file %s. Check if the path is correct." % triqlerInputFile)
+  elif triqlerInputFile.endswith(".pqr.tsv"):
+    params['hasLinkPEPs'] = parsers.hasLinkPEPs(triqlerInputFile)
+    with perf_report.stage(params, "parsing") as stage:
+      params['fileList'], params['groups'], params['groupLabels'], peptQuantRows = parsers.parsePeptideQuantFile(triqlerInputFile)
+      perf_report.addItems(stage, len(peptQuantRows))
   else:
+    params['hasLinkPEPs'] = parsers.hasLinkPEPs(triqlerInputFile)
     peptQuantRowFile = triqlerInputFile + ".pqr.tsv"
     peptQuantRows = convertTriqlerInputToPeptQuantRows(triqlerInputFile, peptQuantRowFile, params)
   
@@ -126,137 +326,184 @@ def runTriqler(params, triqlerInputFile, triqlerOutputFile):
 
   end = timer()
   print("Triqler execution took", end - start, "seconds wall clock time")
-
-def convertTriqlerInputToPeptQuantRows(triqlerInputFile, peptQuantRowFile, params):
-  peptQuantRowMap, getPEPFromScore, params['fileList'], params['groupLabels'], params['groups'] = groupTriqlerRowsByFeatureGroup(triqlerInputFile, params['decoyPattern'])
   
-  if params['hasLinkPEPs'] and params['writeSpectrumQuants']:
-    _, spectrumQuantRows, intensityDiv = _selectBestFeaturesPerRunAndPeptide(
-        peptQuantRowMap, getPEPFromScore, params, 
-        groupingKey = lambda x : x.spectrumId)
-    spectrumQuantRows = _divideIntensities(spectrumQuantRows, intensityDiv)
-    spectrumQuantRows = _updateIdentPEPs(spectrumQuantRows, params['decoyPattern'], params['hasLinkPEPs'])
+  if params.get('perfReport') is not None:
+    params['perfReport'].printSummary()
+    print("Writing performance report to", params['perfReportOutput'])
+    params['perfReport'].writeReport(params['perfReportOutput'], { 'version' : __version__, 'input_file' : triqlerInputFile, 'num_threads' : params['numThreads'] })
+
+# the peptide quant rows are not written if peptQuantRowFile is None
+def convertTriqlerInputToPeptQuantRows(triqlerInputFile, peptQuantRowFile, params, triqlerInputRows = None):
+  peptQuantRowMap, getPEPFromScore, params['fileList'], params['groupLabels'], params['groups'] = groupTriqlerRowsByFeatureGroup(triqlerInputFile, params['decoyPattern'], params, triqlerInputRows)
+  
+  # the spectrum-level rows are selected in the same traversal of the feature
+  # groups as the peptide-level rows and written on a background thread
+  writeSpectrumQuants = params['hasLinkPEPs'] and params['writeSpectrumQuants']
+  groupingKeys = [lambda x : x.peptide]
+  if writeSpectrumQuants:
+    groupingKeys.append(lambda x : x.spectrumId)
+  
+  with perf_report.stage(params, "feature_selection") as stage:
+    selectedFeatures = _selectBestFeaturesPerRun(peptQuantRowMap, getPEPFromScore, params, groupingKeys)
+  
+  specQuantRowWriter = None
+  if writeSpectrumQuants:
+    _, spectrumQuantRows, intensityDiv = selectedFeatures[1]
+    with perf_report.stage(params, "peptide_peps") as stage:
+      spectrumQuantRows = _updateIdentPEPs(spectrumQuantRows, params['decoyPattern'], params['hasLinkPEPs'], intensityDiv)
+      perf_report.addItems(stage, len(spectrumQuantRows))
     
     specQuantRowFile = triqlerInputFile + ".sqr.tsv"
     print("Writing spectrum quant rows to file:", specQuantRowFile)
-    parsers.printPeptideQuantRows(specQuantRowFile, parsers.getRunIds(params), spectrumQuantRows)
+    # written in a thread, errors are raised by specQuantRowWriter.get()
+    specQuantRowWriter = pool.ThreadResult(parsers.printPeptideQuantRows, [specQuantRowFile, parsers.getRunIds(params), spectrumQuantRows])
   
-  spectrumToFeatureMatch, peptideQuantRows, intensityDiv = _selectBestFeaturesPerRunAndPeptide(peptQuantRowMap, getPEPFromScore, params)
-  peptideQuantRows = _selectBestPeptideQuantRowPerFeatureGroup(spectrumToFeatureMatch, peptideQuantRows)
-  peptideQuantRows = _divideIntensities(peptideQuantRows, intensityDiv)
-  peptideQuantRows = _updateIdentPEPs(peptideQuantRows, params['decoyPattern'], params['hasLinkPEPs'])
+  with perf_report.stage(params, "feature_selection") as stage:
+    spectrumToFeatureMatch, peptideQuantRows, intensityDiv = selectedFeatures[0]
+    peptideQuantRows = list(_selectBestPeptideQuantRowPerFeatureGroup(spectrumToFeatureMatch, peptideQuantRows))
+    perf_report.addItems(stage, len(peptideQuantRows))
   
-  print("Writing peptide quant rows to file:", peptQuantRowFile)
-  parsers.printPeptideQuantRows(peptQuantRowFile, parsers.getRunIds(params), peptideQuantRows)
+  with perf_report.stage(params, "peptide_peps") as stage:
+    peptideQuantRows = _updateIdentPEPs(peptideQuantRows, params['decoyPattern'], params['hasLinkPEPs'], intensityDiv)
+    perf_report.addItems(stage, len(peptideQuantRows))
+  
+  if peptQuantRowFile is not None:
+    with perf_report.stage(params, "output_writing") as stage:
+      print("Writing peptide quant rows to file:", peptQuantRowFile)
+      parsers.printPeptideQuantRows(peptQuantRowFile, parsers.getRunIds(params), peptideQuantRows)
+      perf_report.addItems(stage, len(peptideQuantRows))
+  
+  if specQuantRowWriter is not None:
+    with perf_report.stage(params, "output_writing") as stage:
+      specQuantRowWriter.get()
+      perf_report.addItems(stage, len(spectrumQuantRows))
   
   return peptideQuantRows
 
-def groupTriqlerRowsByFeatureGroup(triqlerInputFile, decoyPattern):
-  print("Parsing triqler input file")
-  
-  peptQuantRowMap = collections.defaultdict(list)
-  seenSpectra = set()
-  targetScores, decoyScores = list(), list()
-  runCondPairs = list()
-  for i, trqRow in enumerate(parsers.parseTriqlerInputFile(triqlerInputFile)):
-    if i % 1000000 == 0:
-      print("  Reading row", i)
-    
-    peptQuantRowMap[trqRow.featureClusterId].append(trqRow)
-    if (trqRow.run, trqRow.condition) not in runCondPairs:
-      runCondPairs.append((trqRow.run, trqRow.condition))
+def groupTriqlerRowsByFeatureGroup(triqlerInputFile, decoyPattern, params = None, triqlerInputRows = None):
+  if triqlerInputRows is None:
+    print("Parsing triqler input file")
+    triqlerInputRows = parsers.parseTriqlerInputFile(triqlerInputFile)
+  else:
+    print("Converting input to triqler input rows")
+  
+  with perf_report.stage(params, "parsing") as stage:
+    peptQuantRowMap = collections.defaultdict(list)
+    seenSpectra = set()
+    targetScores, decoyScores = list(), list()
+    runCondPairs = list()
+    for i, trqRow in enumerate(triqlerInputRows):
+      if i % 1000000 == 0:
+        print("  Reading row", i)
+      
+      peptQuantRowMap[trqRow.featureClusterId].append(trqRow)
+      if (trqRow.run, trqRow.condition) not in runCondPairs:
+        runCondPairs.append((trqRow.run, trqRow.condition))
+      
+      if not np.isnan(trqRow.searchScore) and trqRow.spectrumId not in seenSpectra:
+        if _isDecoy(trqRow.proteins, decoyPattern):
+          decoyScores.append(trqRow.searchScore)
+        else:
+          targetScores.append(trqRow.searchScore)
+        seenSpectra.add(trqRow.spectrumId)
+    perf_report.addItems(stage, sum(len(x) for x in peptQuantRowMap.values()))
     
-    if not np.isnan(trqRow.searchScore) and trqRow.spectrumId not in seenSpectra:
-      if _isDecoy(trqRow.proteins, decoyPattern):
-        decoyScores.append(trqRow.searchScore)
-      else:
-        targetScores.append(trqRow.searchScore)
-      seenSpectra.add(trqRow.spectrumId)
-  
-  fileList, groupLabels, groups = _getFilesAndGroups(runCondPairs)
+    fileList, groupLabels, groups = _getFilesAndGroups(runCondPairs)
   
   print("Calculating identification PEPs")
-  getPEPFromScore = qvality.getPEPFromScoreLambda(targetScores, decoyScores)
+  with perf_report.stage(params, "psm_qvality") as stage:
+    getPEPFromScore = qvality.getPEPFromScoreLambda(targetScores, decoyScores)
+    perf_report.addItems(stage, len(targetScores) + len(decoyScores))
     
   return peptQuantRowMap, getPEPFromScore, fileList, groupLabels, groups
 
 def _selectBestFeaturesPerRunAndPeptide(peptQuantRowMap, getPEPFromScore, params, groupingKey = lambda x : x.peptide):
+  return _selectBestFeaturesPerRun(peptQuantRowMap, getPEPFromScore, params, [groupingKey])[0]
+
+# selects the best feature per run for each of the groupingKeys in a single
+# traversal of the feature groups, returns a (spectrumToFeatureMatch, 
+# peptideQuantRows, intensityDiv) tuple per groupingKey
+def _selectBestFeaturesPerRun(peptQuantRowMap, getPEPFromScore, params, groupingKeys):
   print("Selecting best feature per run and spectrum")
   numRuns = len(params['fileList'])
+  fileIdxs = dict((run, fileIdx) for fileIdx, run in enumerate(params['fileList']))
   
-  minIntensity = 1e100
-  noSpectrum = 0
-  peptideQuantRows = list()
-  spectrumToFeatureMatch = dict() # stores the best peptideQuantRow per (protein, spectrumIdx)-pair
+  minIntensities = [1e100]*len(groupingKeys)
+  noSpectrums = [0]*len(groupingKeys)
+  peptideQuantRowsList = [list() for _ in groupingKeys]
+  spectrumToFeatureMatches = [dict() for _ in groupingKeys] # stores the best peptideQuantRow per (protein, spectrumIdx)-pair
   for featureGroupIdx, trqRows in peptQuantRowMap.items():
     if featureGroupIdx % 100000 == 0:
       print("  featureGroupIdx:", featureGroupIdx)
     
-    bestFeaturesPerRun = _selectBestFeaturesPerFeatureGroup(trqRows, 
-        getPEPFromScore, params['fileList'], groupingKey, numRuns)
+    # the PEPs only depend on the feature, not on the grouping
+    scoredRows = list()
+    for trqRow in trqRows:
+      identPEP = getPEPFromScore(trqRow.searchScore)
+      scoredRows.append((fileIdxs[trqRow.run], _combinePEPs(trqRow.linkPEP, identPEP), identPEP, trqRow))
     
-    for gKey in bestFeaturesPerRun:
-      numRunsPresent = sum(1 for x in bestFeaturesPerRun[gKey] if x[0] < 1.01)
-      if numRunsPresent < params['minSamples']:
-        continue
+    for k, groupingKey in enumerate(groupingKeys):
+      bestFeaturesPerRun = _selectBestFeaturesPerFeatureGroup(scoredRows, groupingKey, numRuns)
       
-      pqr = _convertFeatureGroupToPeptideQuantRow(bestFeaturesPerRun[gKey], 
-          getPEPFromScore, featureGroupIdx, numRuns)
-      
-       # some feature clusters might not have a spectrum associated with them
-      if pqr.spectrum == 0:
-        noSpectrum += 1
-        pqr = pqr._replace(spectrum = -100 * noSpectrum)
-      
-      peptideQuantRows.append(pqr)
-      
-      minIntensity = min(minIntensity, min([x for x in pqr.quant if x > 0.0]))
-      
-      # combinedPEP field temporarily contains SVM score
-      identPEP = getPEPFromScore(pqr.combinedPEP)
-      peptLinkErrorProb = 1.0 - np.prod([1.0 - x for x in pqr.linkPEP if x < 1.01])
-      combinedPEP = _combinePEPs(identPEP, peptLinkErrorProb)
-      
-      # multiple featureGroups can be associated with the same consensus spectrum
-      # when two or more analytes match closely in prec m/z and retention time;
-      # choose the best featureGroup per (peptide, spectrum)-pair based on combinedPEP
-      # note that chimeric spectra can still be associated with multiple peptideQuantRows, 
-      # as the protein is included in the key
-      key = (",".join(pqr.protein), pqr.spectrum / 100)
-      if combinedPEP < spectrumToFeatureMatch.get(key, (-1, -1, 1.01))[2]:
-        spectrumToFeatureMatch[key] = (pqr.spectrum, featureGroupIdx, combinedPEP)
+      for gKey in bestFeaturesPerRun:
+        numRunsPresent = sum(1 for x in bestFeaturesPerRun[gKey] if x[0] < 1.01)
+        if numRunsPresent < params['minSamples']:
+          continue
+        
+        pqr = _convertFeatureGroupToPeptideQuantRow(bestFeaturesPerRun[gKey], 
+            featureGroupIdx, numRuns)
+        
+         # some feature clusters might not have a spectrum associated with them
+        if pqr.spectrum == 0:
+          noSpectrums[k] += 1
+          pqr = pqr._replace(spectrum = -100 * noSpectrums[k])
+        
+        peptideQuantRowsList[k].append(pqr)
+        
+        minIntensities[k] = min(minIntensities[k], min([x for x in pqr.quant if x > 0.0]))
+        
+        # combinedPEP field temporarily contains SVM score
+        identPEP = getPEPFromScore(pqr.combinedPEP)
+        peptLinkErrorProb = 1.0 - np.prod([1.0 - x for x in pqr.linkPEP if x < 1.01])
+        combinedPEP = _combinePEPs(identPEP, peptLinkErrorProb)
+        
+        # multiple featureGroups can be associated with the same consensus spectrum
+        # when two or more analytes match closely in prec m/z and retention time;
+        # choose the best featureGroup per (peptide, spectrum)-pair based on combinedPEP
+        # note that chimeric spectra can still be associated with multiple peptideQuantRows, 
+        # as the protein is included in the key
+        key = (",".join(pqr.protein), pqr.spectrum / 100)
+        if combinedPEP < spectrumToFeatureMatches[k].get(key, (-1, -1, 1.01))[2]:
+          spectrumToFeatureMatches[k][key] = (pqr.spectrum, featureGroupIdx, combinedPEP)
   
   # divide intensities by a power of 10 for increased readability of peptide 
   # output file, make sure that the lowest intensity retains two significant 
   # digits after printing with two digits after the decimal point
-  intensityDiv = np.power(10, np.floor(np.log10(minIntensity))+1)
+  intensityDivs = [np.power(10, np.floor(np.log10(minIntensity))+1) for minIntensity in minIntensities]
   
-  return spectrumToFeatureMatch, peptideQuantRows, intensityDiv
+  return list(zip(spectrumToFeatureMatches, peptideQuantRowsList, intensityDivs))
 
-def _selectBestFeaturesPerFeatureGroup(trqRows, getPEPFromScore, fileList, groupingKey, numRuns):
-  # groupingKey => array([linkPEP, triqlerInputRow])
-  bestFeaturesPerRun = collections.defaultdict(lambda : [(1.01, None)]*numRuns)
+# scoredRows contains (fileIdx, combinedPEP, identPEP, triqlerInputRow) tuples
+def _selectBestFeaturesPerFeatureGroup(scoredRows, groupingKey, numRuns):
+  # groupingKey => array([combinedPEP, identPEP, triqlerInputRow])
+  bestFeaturesPerRun = collections.defaultdict(lambda : [(1.01, 1.01, None)]*numRuns)
   
-  for trqRow in trqRows:
-    fileIdx = fileList.index(trqRow.run)
+  for fileIdx, combinedPEP, identPEP, trqRow in scoredRows:
     gKey = groupingKey(trqRow)      
-    bestPEPForRun, bestTrqRowForRun = bestFeaturesPerRun[gKey][fileIdx]
-
-    combinedPEP = _combinePEPs(trqRow.linkPEP, getPEPFromScore(trqRow.searchScore))
+    bestPEPForRun, _, bestTrqRowForRun = bestFeaturesPerRun[gKey][fileIdx]
     
     samePEPhigherIntensity = (combinedPEP == bestPEPForRun and 
         trqRow.intensity > bestTrqRowForRun.intensity)
     if combinedPEP < bestPEPForRun or samePEPhigherIntensity:
-      bestFeaturesPerRun[gKey][fileIdx] = (combinedPEP, trqRow)
+      bestFeaturesPerRun[gKey][fileIdx] = (combinedPEP, identPEP, trqRow)
   
   return bestFeaturesPerRun
 
-def _convertFeatureGroupToPeptideQuantRow(bestFeaturesPerRun, getPEPFromScore, 
-    featureGroupIdx, numRuns):
+def _convertFeatureGroupToPeptideQuantRow(bestFeaturesPerRun, featureGroupIdx, numRuns):
   intensities, linkPEPs, identPEPs = [0.0]*numRuns, [1.01]*numRuns, [1.01]*numRuns
   first = True
   svmScore = -1e9
-  for fileIdx, (_, trqRow) in enumerate(bestFeaturesPerRun):
+  for fileIdx, (_, identPEP, trqRow) in enumerate(bestFeaturesPerRun):
     if trqRow == None:
       continue
     
@@ -268,7 +515,7 @@ def _convertFeatureGroupToPeptideQuantRow(bestFeaturesPerRun, getPEPFromScore,
     
     intensities[fileIdx] = trqRow.intensity
     linkPEPs[fileIdx] = trqRow.linkPEP #_combinePEPs(linkPEP, identPEP)
-    identPEPs[fileIdx] = getPEPFromScore(trqRow.searchScore)
+    identPEPs[fileIdx] = identPEP
   
   # fill in PEPs for missing values
   linkPEPs = _setMissingAsMax(linkPEPs)
@@ -294,11 +541,11 @@ def _getFilesAndGroups(runCondPairs):
       groups[groupLabels.index(cond)].append(len(fileList) - 1)
   
   if len(fileList) < 2:
-    sys.exit("ERROR: There should be at least two runs.")
+    raise TriqlerError("ERROR: There should be at least two runs.")
   elif len(groups) < 2:
-    sys.exit("ERROR: At least two conditions (treatment groups) should be specified.")
+    raise TriqlerError("ERROR: At least two conditions (treatment groups) should be specified.")
   elif min([len(g) for g in groups]) < 2:
-    sys.exit("ERROR: Each condition (treatment group) should have at least two runs.")
+    raise TriqlerError("ERROR: Each condition (treatment group) should have at least two runs.")
   
   return fileList, groupLabels, groups
 
@@ -317,29 +564,31 @@ def _selectBestPeptideQuantRowPerFeatureGroup(spectrumToFeatureMatch, peptideQua
   
   return peptideQuantRows
 
-def _divideIntensities(peptideQuantRows, intensityDiv = 1e6):
-  print("Dividing intensities by %g for increased readability" % intensityDiv)
-  newPeptideQuantRows = list()
-  for row in peptideQuantRows:
-    row = row._replace(quant = list(map(lambda x : x/intensityDiv, row.quant)))
-    newPeptideQuantRows.append(row)
-  return newPeptideQuantRows
-
 def doPickedProteinQuantification(peptQuantRows, params, proteinModifier, getEvalFeatures):
-  notPickedProteinOutputRows = _groupPeptideQuantRowsByProtein(
-      peptQuantRows, proteinModifier, params['decoyPattern'])
-  
-  np.random.shuffle(notPickedProteinOutputRows)
-  notPickedProteinOutputRows = sorted(notPickedProteinOutputRows, key = lambda x : x[0], reverse = True)
-  
-  print("Calculating protein-level identification PEPs")
-  pickedProteinOutputRows, proteinPEPs = _pickedProteinStrategy(notPickedProteinOutputRows, params['decoyPattern'])  
+  with perf_report.stage(params, "protein_grouping") as stage:
+    proteinQuantIndex = parsers.getProteinQuantIndex(peptQuantRows)
+    
+    notPickedProteinOutputRows = _groupPeptideQuantRowsByProtein(
+        proteinQuantIndex, proteinModifier, params['decoyPattern'])
+    
+    # ties in the protein score are broken randomly, using params['rng'] if 
+    # given and the global numpy random state otherwise
+    params.get('rng', np.random).shuffle(notPickedProteinOutputRows)
+    notPickedProteinOutputRows = sorted(notPickedProteinOutputRows, key = lambda x : x[0], reverse = True)
+    
+    print("Calculating protein-level identification PEPs")
+    pickedProteinOutputRows, proteinPEPs = _pickedProteinStrategy(notPickedProteinOutputRows, params['decoyPattern'])  
+    perf_report.addItems(stage, len(pickedProteinOutputRows))
   
   print("Fitting hyperparameters")
-  hyperparameters.fitPriors(peptQuantRows, params)
+  with perf_report.stage(params, "fit_priors") as stage:
+    hyperparameters.fitPriors(peptQuantRows, params, proteinQuantIndex = proteinQuantIndex)
+    perf_report.addItems(stage, len(proteinQuantIndex.quantRows))
   
   print("Calculating protein posteriors")
-  posteriors = getPosteriors(pickedProteinOutputRows, proteinPEPs, params)
+  with perf_report.stage(params, "posteriors") as stage:
+    posteriors = getPosteriors(pickedProteinOutputRows, proteinPEPs, params, proteinQuantIndex, stage)
+    perf_report.addItems(stage, len(posteriors))
   
   proteinQuantRows = _updateProteinQuantRows(pickedProteinOutputRows, posteriors, proteinPEPs, getEvalFeatures, params)
   
@@ -363,31 +612,17 @@ def _updateProteinQuantRows(pickedProteinOutputRows, posteriors, proteinPEPs,
   proteinQuantRows = sorted(proteinQuantRows, key = lambda x : (x[0], x[1]))
   return proteinQuantRows
 
-def _groupPeptideQuantRowsByProtein(peptQuantRows, proteinModifier, decoyPattern):
-  protQuantRows = parsers.filterAndGroupPeptides(peptQuantRows)
+def _groupPeptideQuantRowsByProtein(proteinQuantIndex, proteinModifier, decoyPattern):
+  proteins, proteinOffsets, quantRows, _ = proteinQuantIndex
   
   proteinRows = list()
-  for prot, quantRows in protQuantRows:
-    psmIdx = 0
-    quantRows = sorted(quantRows, key = lambda x : x.combinedPEP)
-    seenPeptides = set()
-    usablePeptides = 0
-    filteredQuantRows = list()
-    for quantRow in quantRows:
-      cleanPeptide = parsers.cleanPeptide(quantRow.peptide)
-      if cleanPeptide not in seenPeptides:
-        seenPeptides.add(cleanPeptide)
-        usablePeptides += 1
-        filteredQuantRows.append(quantRow)
-
-    if usablePeptides < 1:
-      continue
-    else:
-      quantRows = filteredQuantRows
+  for prot, startIdx, endIdx in zip(proteins, proteinOffsets[:-1], proteinOffsets[1:]):
+    # the index only contains the best charge state per peptide, sorted by combinedPEP
+    protQuantRows = quantRows[startIdx:endIdx]
     protein = proteinModifier(prot)
-    numPeptides = usablePeptides
-
-    proteinOutputRow = (_getProteinScore(quantRows), list(quantRows[psmIdx].linkPEP), protein, quantRows, numPeptides)
+    numPeptides = len(protQuantRows)
+    
+    proteinOutputRow = (_getProteinScore(protQuantRows), list(protQuantRows[0].linkPEP), protein, protQuantRows, numPeptides)
     proteinRows.append(proteinOutputRow)
   
   return proteinRows
@@ -416,26 +651,140 @@ def _pickedProteinStrategy(notPickedProteinOutputRows, decoyPattern):
   _, proteinPEPs = qvality.getQvaluesFromScores(targetScores, decoyScores, includePEPs = True, includeDecoys = True, tdcInput = True)
   
   if len(np.nonzero(proteinPEPs < 1.0)) == 0:
-    sys.exit("ERROR: No proteins could be identified with a PEP below 1.0, cannot calculate posteriors.")
+    raise TriqlerError("ERROR: No proteins could be identified with a PEP below 1.0, cannot calculate posteriors.")
   else:
     print("  Identified", qvality.countBelowFDR(proteinPEPs, 0.01), "proteins at 1% FDR")
   
   return pickedProteinOutputRows, proteinPEPs
 
-def getPosteriors(pickedProteinOutputRows, peps, params):
-  processingPool = pool.MyPool(processes = params['numThreads'], warningFilter = params['warningFilter'])
+def getPosteriors(pickedProteinOutputRows, peps, params, proteinQuantIndex = None, perfStage = None):
+  if proteinQuantIndex is None:
+    proteinQuantIndex = parsers.getProteinQuantIndex([x for row in pickedProteinOutputRows for x in row[2]])
+  proteins, proteinOffsets, concatQuantRows, concatQuantMatrix = parsers.getConcatenatedQuantMatrix(proteinQuantIndex)
+  proteinIdxMap = dict(zip(proteins, range(len(proteins))))
+  
+  # the performance report, progress metrics, executor, shared pool of the 
+  # batch mode and random state are only needed in the main process
+  workerParams = dict(params)
+  workerParams.pop('perfReport', None)
+  workerParams.pop('rng', None)
+  workerParams.pop('progressMetrics', None)
+  workerParams.pop('executor', None)
+  workerParams.pop('sharedPool', None)
+  workerParams.pop('posteriorWriter', None)
+  
+  # the results of approximate engines are compared to the exact grid engine
+  # for an evenly spread sample of proteins
+  useLaplace = params.get('engine', 'grid') == 'laplace'
+  if useLaplace or pgm.getCoarseGridStride(params) > 1:
+    numQuantified = sum(1 for proteinIdPEP in peps if proteinIdPEP < 1.0)
+    engineCheckIdxs = _getEngineCheckIdxs(numQuantified, params.get('engineCheckSample', 0))
+  else:
+    engineCheckIdxs = set()
+  referenceParams = dict(workerParams, engine = 'grid', coarseGridStep = 0.0, returnPosteriors = False)
+  
+  if pgm.getCoarseGridStride(params) > 1:
+    print("  Evaluating posteriors on a coarse grid with step %g first, the refined regions hold all but %g of the posterior mass" % (params['coarseGridStep'], params.get('coarseGridTolerance', 1e-6)))
+  
+  # proteins with more peptides x runs than params['splitProteinCost'] are 
+  # distributed over the workers instead of occupying a single one
+  splitProteinCost = params.get('splitProteinCost', 0)
+  if params['numThreads'] <= 1 or pgm.getCoarseGridStride(params) > 1 or params.get('executor', 'process') == 'serial':
+    splitProteinCost = 0
+  numSplitProteins = 0
+  
+  processingPool = pool.MyPool(processes = params['numThreads'], warningFilter = params['warningFilter'], progressMetrics = params.get('progressMetrics'), sharedPool = params.get('sharedPool'), executor = params.get('executor', 'process'), startMethod = params.get('startMethod'))
   addDummyPosteriors = 0
+  engineChecks = list()
+  posteriorProteins = list()
   for (linkPEP, protein, quantRows, numPeptides), proteinIdPEP in zip(pickedProteinOutputRows, peps):  
     if proteinIdPEP < 1.0:
-      processingPool.applyAsync(pgm.getPosteriors, [quantRows, params])
+      proteinIdx = proteinIdxMap[quantRows[0].protein[0]]
+      startIdx, endIdx = proteinOffsets[proteinIdx], proteinOffsets[proteinIdx+1]
+      if len(processingPool.results) in engineCheckIdxs:
+        engineChecks.append((len(processingPool.results), startIdx, endIdx))
+      posteriorProteins.append(protein)
+      
+      if splitProteinCost > 0 and (endIdx - startIdx) * len(params['fileList']) >= splitProteinCost:
+        processingPool.applyAsyncInMainProcess(_getSplitPosteriors, [concatQuantRows[startIdx:endIdx], workerParams, concatQuantMatrix[startIdx:endIdx]])
+        numSplitProteins += 1
+      elif useLaplace:
+        processingPool.applyAsync(laplace.getPosteriors, [concatQuantRows[startIdx:endIdx], workerParams, concatQuantMatrix[startIdx:endIdx]])
+      else:
+        processingPool.applyAsync(pgm.getPosteriors, [concatQuantRows[startIdx:endIdx], workerParams, concatQuantMatrix[startIdx:endIdx]])
     else:
       addDummyPosteriors += 1
-    #pgm.getPosteriors(quantRows, params) # for debug mode
-  posteriors = processingPool.checkPool(printProgressEvery = 50)
+  
+  if numSplitProteins > 0:
+    print("  Distributing the runs and treatment groups of %d proteins with at least %d peptides x runs over the workers" % (numSplitProteins, splitProteinCost))
+  
+  numPosteriors = len(processingPool.results)
+  for _, startIdx, endIdx in engineChecks:
+    processingPool.applyAsync(pgm.getPosteriors, [concatQuantRows[startIdx:endIdx], referenceParams, concatQuantMatrix[startIdx:endIdx]])
+  
+  # the posterior distributions for the --write_*_posteriors options are 
+  # written as soon as a protein is completed instead of being kept in memory
+  posteriorWriter = params.get('posteriorWriter')
+  def writePosteriorDists(taskIdx, output):
+    if posteriorWriter is None or taskIdx >= numPosteriors:
+      return output
+    elif useLaplace:
+      return posteriorWriter.addPosteriors(posteriorProteins[taskIdx], output[0]), output[1]
+    else:
+      return posteriorWriter.addPosteriors(posteriorProteins[taskIdx], output)
+  
+  posteriors = processingPool.checkPool(printProgressEvery = 50, processOutput = writePosteriorDists)
+  perf_report.addWorkerPeakRSS(perfStage, processingPool.workerPeakRSS)
+  posteriors, referencePosteriors = posteriors[:numPosteriors], posteriors[numPosteriors:]
+  if useLaplace:
+    posteriors = laplace.summarizeEngineResults(posteriors)
+  
+  if len(engineChecks) > 0:
+    checkedProteins = [concatQuantRows[startIdx].protein[0] for _, startIdx, _ in engineChecks]
+    _printEngineCheck(checkedProteins, [posteriors[i] for i, _, _ in engineChecks], referencePosteriors)
+  
   posteriors.extend([pgm.getDummyPosteriors(params)] * addDummyPosteriors)
   
   return posteriors
   
+# gives the same results as pgm.getPosteriors or laplace.getPosteriors, but 
+# each EM iteration is split into blocks of runs and the treatment group 
+# posteriors are calculated per group, all of which are evaluated by the 
+# workers of processingPool
+def _getSplitPosteriors(processingPool, quantRows, params, quantMatrix):
+  numRuns = len(quantMatrix[0])
+  runSlices = [slice(runIdxs[0], runIdxs[-1] + 1) for runIdxs in np.array_split(np.arange(numRuns), min([params['numThreads'], numRuns]))]
+  
+  def getPosteriorProteinRatio(quantMatrix, quantRows, geoAvgQuantRow, params):
+    outputs = processingPool.runSubtasks(pgm.getPosteriorProteinRatio, [[quantMatrix, quantRows, geoAvgQuantRow, params, runSlice] for runSlice in runSlices])
+    return [x for pProteinQuantsList, _ in outputs for x in pProteinQuantsList], [x for _, bayesQuantRow in outputs for x in bayesQuantRow]
+  
+  pProteinQuantsList, bayesQuantRow = pgm.getPosteriorProteinRatios(quantMatrix, quantRows, params, getPosteriorProteinRatioFunc = getPosteriorProteinRatio)
+  
+  if params.get('engine', 'grid') == 'laplace':
+    return processingPool.runSubtasks(laplace.getPosteriorsFromProteinRatios, [[pProteinQuantsList, bayesQuantRow, params]])[0]
+  
+  pProteinGroupQuants = processingPool.runSubtasks(pgm.getPosteriorProteinGroupRatio, [[pProteinQuantsList, groupId, params] for groupId in range(len(params['groups']))])
+  return pgm.getPosteriorsFromGroupRatios(pProteinQuantsList, pProteinGroupQuants, bayesQuantRow, params)
+
+# proteins for the agreement check are spread evenly over the protein list
+def _getEngineCheckIdxs(numProteins, numChecks):
+  if numChecks <= 0 or numProteins == 0:
+    return set()
+  return set(np.unique(np.linspace(0, numProteins - 1, min([numChecks, numProteins])).astype(int)))
+
+def _printEngineCheck(proteins, posteriors, referencePosteriors, maxProbDiff = 0.05, maxLog2FoldChangeDiff = 0.1):
+  deviations = list()
+  for protein, (_, muGroupDiffs, probsBelowFoldChange, _), (_, muGroupDiffsRef, probsBelowFoldChangeRef, _) in zip(proteins, posteriors, referencePosteriors):
+    deviations.append((protein, 
+        max(abs(probsBelowFoldChange[k] - probsBelowFoldChangeRef[k]) for k in probsBelowFoldChange),
+        max(abs(muGroupDiffs[k] - muGroupDiffsRef[k]) for k in muGroupDiffs)))
+  
+  print("  Agreement check against the exact grid engine on %d proteins: max |diff prob below fold change| = %.4f, max |diff log2 fold change| = %.4f" % (len(deviations), max(x[1] for x in deviations), max(x[2] for x in deviations)))
+  for protein, probDiff, log2FoldChangeDiff in deviations:
+    if probDiff > maxProbDiff or log2FoldChangeDiff > maxLog2FoldChangeDiff:
+      print("    Warning: approximate and exact posteriors disagree for protein %s: |diff prob below fold change| = %.4f, |diff log2 fold change| = %.4f" % (protein, probDiff, log2FoldChangeDiff))
+
 def selectComparisonBayes(proteinOutputRows, comparisonKey, tTest = False):
   proteinOutputRowsUpdatedPEP = list()
   for (linkPEP, protein, quantRows, evalFeatures, numPeptides, proteinPEP, bayesQuantRow, posteriorDists) in proteinOutputRows:
@@ -453,7 +802,8 @@ def selectComparisonBayes(proteinOutputRows, comparisonKey, tTest = False):
   return proteinOutputRowsUpdatedPEP
 
 # calculate peptide-level identification FDRs and update the linkPEPs with this estimate
-def _updateIdentPEPs(peptideQuantRows, decoyPattern, hasLinkPEPs):
+# if intensityDiv is given, the intensities are divided by it in the same pass
+def _updateIdentPEPs(peptideQuantRows, decoyPattern, hasLinkPEPs, intensityDiv = None):
   print("Calculating peptide-level identification PEPs")
   
   scoreIdxPairs = list()
@@ -470,6 +820,10 @@ def _updateIdentPEPs(peptideQuantRows, decoyPattern, hasLinkPEPs):
   _, identPEPs = qvality.getQvaluesFromScores(targetScores, decoyScores, includePEPs = True, includeDecoys = True, tdcInput = True)
   
   print("  Identified", qvality.countBelowFDR(identPEPs, 0.01), "peptides at 1% FDR")
+  
+  if intensityDiv is not None:
+    print("Dividing intensities by %g for increased readability" % intensityDiv)
+  
   newPeptideQuantRows = list()
   i = 0
   for row in peptideQuantRows:
@@ -478,10 +832,11 @@ def _updateIdentPEPs(peptideQuantRows, decoyPattern, hasLinkPEPs):
       identPEP = identPEPs[scoreIdxs[i]]
       i += 1
     
+    quant = row.quant if intensityDiv is None else [x / intensityDiv for x in row.quant]
     if hasLinkPEPs:
-      newPeptideQuantRows.append(row._replace(combinedPEP = identPEP)) # using consensus spectra
+      newPeptideQuantRows.append(row._replace(combinedPEP = identPEP, quant = quant)) # using consensus spectra
     else:
-      newPeptideQuantRows.append(row._replace(combinedPEP = identPEP, identificationPEP = [_combinePEPs(identPEP, x) for x in row.identificationPEP]))
+      newPeptideQuantRows.append(row._replace(combinedPEP = identPEP, quant = quant, identificationPEP = [_combinePEPs(identPEP, x) for x in row.identificationPEP]))
   return newPeptideQuantRows
 
 def _isDecoy(proteins, decoyPattern):